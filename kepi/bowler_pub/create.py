@@ -22,6 +22,8 @@ import kepi.bowler_pub
 import kepi.bowler_pub.utils as bowler_utils
 import kepi.sombrero_sendpub.fetch as sombrero_fetch
 import kepi.sombrero_sendpub.collections as sombrero_collections
+import kepi.sombrero_sendpub.models as sombrero_models
+from kepi.sombrero_sendpub.resolution import resolving
 
 def create(fields,
         address = None):
@@ -48,7 +50,10 @@ def create(fields,
         return
 
     try:
-        result = deserialise(fields)
+        # Each address is looked up once, however many
+        # handlers ask for it.
+        with resolving():
+            result = deserialise(fields)
         return result
     except Exception as e:
         logger.info("%s: can't deserialise: %s",
@@ -192,6 +197,18 @@ def on_create(fields, address):
 
 def on_note(fields, address):
 
+    if bowler_utils.is_local(fields.get('id', None)):
+        # This is one of our own statuses, being delivered
+        # locally. It already exists, so we don't create it.
+
+        logger.debug("%s: local status; not creating",
+                address)
+
+        return sombrero_fetch.fetch(
+                fields['id'],
+                expected_type = trilby_models.Status,
+                )
+
     logger.debug("Looking up actor: %s",
             fields['attributedTo'])
 
@@ -261,6 +278,8 @@ def on_note(fields, address):
 
         logger.debug('%s: adding tags', address)
 
+        mentions = []
+
         for tag in fields['tag']:
 
             if 'type' not in tag or 'href' not in tag:
@@ -273,11 +292,18 @@ def on_note(fields, address):
                         address, tag)
                 continue
 
+            mentions.append(tag['href'])
+
+        # Look them all up at once, rather than one at a time.
+        people = sombrero_fetch.fetch_many(mentions,
+                expected_type = trilby_models.Person)
+
+        for href in mentions:
+
             logger.debug('%s:   -- %s',
-                    address, tag['href'])
+                    address, href)
 
-            whom = sombrero_fetch.fetch(tag['href'],
-                    expected_type = trilby_models.Person)
+            whom = people[href]
 
             if whom is None:
                 logger.debug('%s:     -- not found',
@@ -344,6 +370,24 @@ def on_announce(fields, address):
 
     return reblog
 
+def _note_shared_inbox(url):
+    """
+    Records a remote server's shared inbox in its Instance.
+    """
+
+    if bowler_utils.is_local(url):
+        return
+
+    instance = sombrero_models.Instance.for_hostname(
+            urlparse(url).netloc,
+            )
+
+    if instance.shared_inbox != url:
+        instance.shared_inbox = url
+        instance.save(
+                update_fields = ['shared_inbox'],
+                )
+
 def on_person(fields, address,
         update_existing = False):
 
@@ -387,10 +431,20 @@ def on_person(fields, address,
                     fieldname,
                     fields[fieldsname])
 
-    # A shared inbox takes priority over a personal inbox
+    # A shared inbox takes priority over a personal inbox.
+    # But it must be on their own host; otherwise anyone could
+    # redirect what we send to someone else's server.
     if 'endpoints' in fields:
         if 'sharedInbox' in fields['endpoints']:
-            user.inbox_url = fields['endpoints']['sharedInbox']
+            shared_inbox = fields['endpoints']['sharedInbox']
+
+            if urlparse(shared_inbox).netloc==urlparse(fields['id']).netloc:
+                user.inbox_url = shared_inbox
+                _note_shared_inbox(user.inbox_url)
+            else:
+                logger.info('%s: ignoring shared inbox %s, '+\
+                        'which is on another host',
+                        address, shared_inbox)
 
     if 'publicKey' in fields:
         key = fields['publicKey']
@@ -402,6 +456,14 @@ def on_person(fields, address,
                                 f"({key['owner']} for {user.remote_url})")
 
         if 'id' in key:
+            # Otherwise they could claim to own the key
+            # of someone on another host.
+            if urlparse(key['id']).netloc != \
+                    urlparse(user.remote_url).netloc:
+                raise ValueError(
+                        f"Remote user's key is on another host "
+                                f"({key['id']} for {user.remote_url})")
+
             user.key_name = key['id']
 
         if 'publicKeyPem' in key:
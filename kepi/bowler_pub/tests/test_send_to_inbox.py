@@ -5,6 +5,8 @@ from django.test import Client
 from urllib.parse import urlparse
 from kepi.trilby_api.tests import create_local_person
 from kepi.trilby_api.models import Status
+from kepi.sombrero_sendpub.cache import fetch_cache
+from kepi.sombrero_sendpub.keys import key_cache
 import httpretty
 import json
 import logging
@@ -49,6 +51,11 @@ class Tests(TestCase):
         settings.KEPI['LOCAL_OBJECT_HOSTNAME'] = 'testserver'
         settings.ALLOWED_HOSTS = ['testserver']
 
+        # Anything cached by one test would outlive its rollback.
+        for cache in [fetch_cache, key_cache]:
+            cache.clear()
+            self.addCleanup(cache.clear)
+
     def _send(self,
             message,
             recipient = None,
@@ -96,13 +103,14 @@ class Tests(TestCase):
             if 'actor' not in fields:
                 fields['actor'] = BOB_ID
 
-        response = post_test_message(
-                path = path,
-                host = INBOX_HOST,
-                secret = senderKeys['private'],
-                content = content,
-                fields = fields,
-                )
+        with self.captureOnCommitCallbacks(execute=True):
+            response = post_test_message(
+                    path = path,
+                    host = INBOX_HOST,
+                    secret = senderKeys['private'],
+                    content = content,
+                    fields = fields,
+                    )
 
         logger.debug("Response code: %s", response.status_code)
         if response.status_code!=200:
@@ -140,13 +148,14 @@ class Tests(TestCase):
                 body='Thank you!',
                 )
 
-        self._send(
-                message = {
-                    'type': 'Follow',
-                    'object': ALICE_ID,
-                    'actor': BOB_ID,
-                    },
-                )
+        with self.captureOnCommitCallbacks(execute=True):
+            self._send(
+                    message = {
+                        'type': 'Follow',
+                        'object': ALICE_ID,
+                        'actor': BOB_ID,
+                        },
+                    )
 
         self.assertDictContainsSubset(
                 subset = {
@@ -1,7 +1,11 @@
 from django.test import TestCase, Client
-from kepi.bowler_pub.validation import validate
+from kepi.bowler_pub.validation import validate, INBOX_QUEUE
+import kepi.bowler_pub.validation as bowler_validation
 import kepi.trilby_api.models as trilby_models
 from unittest import skip
+from unittest.mock import patch
+from kepi.sombrero_sendpub.cache import fetch_cache
+from kepi.sombrero_sendpub.keys import key_cache
 import httpretty
 from . import *
 from kepi.trilby_api.tests import create_local_person, create_local_status
@@ -35,6 +39,11 @@ class TestValidation(TestCase):
     def setUp(self):
         settings.KEPI['LOCAL_OBJECT_HOSTNAME'] = 'testserver'
 
+        # Anything cached by one test would outlive its rollback.
+        for cache in [fetch_cache, key_cache]:
+            cache.clear()
+            self.addCleanup(cache.clear)
+
     @httpretty.activate
     def test_local_lookup(self):
 
@@ -67,9 +76,10 @@ class TestValidation(TestCase):
                 load_default_keys_from='kepi/bowler_pub/tests/keys/keys-0001.json',
                 )
 
-        validate(path=INBOX_PATH,
-                headers=headers,
-                body=body)
+        with self.captureOnCommitCallbacks(execute=True):
+            validate(path=INBOX_PATH,
+                    headers=headers,
+                    body=body)
 
         self.assertTrue(
                 Follow.objects.filter(
@@ -110,9 +120,10 @@ class TestValidation(TestCase):
                 secret = keys['private'],
                 )
 
-        validate(path=INBOX_PATH,
-                headers=headers,
-                body=body)
+        with self.captureOnCommitCallbacks(execute=True):
+            validate(path=INBOX_PATH,
+                    headers=headers,
+                    body=body)
 
         self.assertEqual(
                 len(trilby_models.Follow.objects.filter(
@@ -129,6 +140,226 @@ class TestValidation(TestCase):
                 fetched['fred'],
                 msg="Fred's record was fetched from his server")
 
+    @httpretty.activate
+    def test_each_address_resolved_once(self):
+
+        import kepi.sombrero_sendpub.fetch as sombrero_fetch
+
+        keys = json.load(open('kepi/bowler_pub/tests/keys/keys-0001.json', 'r'))
+
+        alice = create_local_person(
+                name = 'alice',
+                )
+
+        create_remote_person(
+                remote_url = REMOTE_FRED,
+                name = 'Fred',
+                publicKey=keys['public'],
+                )
+
+        body, headers = test_message_body_and_headers(
+                fields = {
+                    'id': ACTIVITY_ID,
+                    'type': "Follow",
+                    'actor': REMOTE_FRED,
+                    'object': LOCAL_ALICE,
+                    },
+                secret = keys['private'],
+                )
+
+        with patch.object(sombrero_fetch, '_fetch_shared',
+                wraps = sombrero_fetch._fetch_shared) as fetch_remote, \
+                        patch.object(sombrero_fetch, '_fetch_local',
+                wraps = sombrero_fetch._fetch_local) as fetch_local:
+
+            with self.captureOnCommitCallbacks(execute=True):
+                validate(path=INBOX_PATH,
+                        headers=headers,
+                        body=body)
+
+        self.assertEqual(
+                len(trilby_models.Follow.objects.filter(
+                    following=alice,
+                    )),
+                1,
+                msg="The message validated successfully")
+
+        self.assertEqual(
+                [call.args[0] for call in fetch_remote.call_args_list],
+                [REMOTE_FRED],
+                msg="The actor was only looked up once")
+
+        self.assertEqual(
+                [call.args[0] for call in fetch_local.call_args_list],
+                [LOCAL_ALICE],
+                msg="The object was only looked up once")
+
+    @httpretty.activate
+    def test_key_changed(self):
+
+        keys1 = json.load(open('kepi/bowler_pub/tests/keys/keys-0001.json', 'r'))
+        keys2 = json.load(open('kepi/bowler_pub/tests/keys/keys-0002.json', 'r'))
+
+        alice = create_local_person(
+                name = 'alice',
+                )
+
+        create_remote_person(
+                remote_url = REMOTE_FRED,
+                name = 'Fred',
+                publicKey=keys1['public'],
+                auto_fetch = True,
+                )
+
+        # Fred has a new key now, but we don't know yet.
+        create_remote_person(
+                remote_url = REMOTE_FRED,
+                name = 'Fred',
+                publicKey=keys2['public'],
+                )
+
+        body, headers = test_message_body_and_headers(
+                fields = {
+                    'id': ACTIVITY_ID,
+                    'type': "Follow",
+                    'actor': REMOTE_FRED,
+                    'object': LOCAL_ALICE,
+                    },
+                secret = keys2['private'],
+                )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            validate(path=INBOX_PATH,
+                    headers=headers,
+                    body=body)
+
+        self.assertEqual(
+                len(trilby_models.Follow.objects.filter(
+                    following=alice,
+                    )),
+                1,
+                msg="The message validated with Fred's new key")
+
+    @httpretty.activate
+    def test_someone_elses_key(self):
+
+        keys1 = json.load(open('kepi/bowler_pub/tests/keys/keys-0001.json', 'r'))
+        keys2 = json.load(open('kepi/bowler_pub/tests/keys/keys-0002.json', 'r'))
+
+        alice = create_local_person(
+                name = 'alice',
+                )
+
+        create_remote_person(
+                remote_url = REMOTE_FRED,
+                name = 'Fred',
+                publicKey=keys1['public'],
+                auto_fetch = True,
+                )
+
+        create_remote_person(
+                remote_url = REMOTE_JIM,
+                name = 'Jim',
+                publicKey=keys2['public'],
+                auto_fetch = True,
+                )
+
+        # Jim signs with his own key, but claims to be Fred.
+        body, headers = test_message_body_and_headers(
+                fields = {
+                    'id': ACTIVITY_ID,
+                    'type': "Follow",
+                    'actor': REMOTE_FRED,
+                    'object': LOCAL_ALICE,
+                    'key_id': REMOTE_JIM+'#main-key',
+                    },
+                secret = keys2['private'],
+                )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            validate(path=INBOX_PATH,
+                    headers=headers,
+                    body=body)
+
+        self.assertEqual(
+                len(trilby_models.Follow.objects.filter(
+                    following=alice,
+                    )),
+                0,
+                msg="A message signed with someone else's key "
+                    "did not validate")
+
+    @httpretty.activate
+    def test_queued(self):
+
+        keys = json.load(open('kepi/bowler_pub/tests/keys/keys-0001.json', 'r'))
+
+        alice = create_local_person(
+                name = 'alice',
+                )
+
+        create_remote_person(
+                remote_url = REMOTE_FRED,
+                name = 'Fred',
+                publicKey=keys['public'],
+                )
+
+        body, headers = test_message_body_and_headers(
+                fields = {
+                    'id': ACTIVITY_ID,
+                    'type': "Follow",
+                    'actor': REMOTE_FRED,
+                    'object': LOCAL_ALICE,
+                    },
+                secret = keys['private'],
+                )
+
+        with patch.object(bowler_validation._run_validation,
+                'apply_async') as apply_async:
+
+            with self.captureOnCommitCallbacks() as callbacks:
+                message = validate(path=INBOX_PATH,
+                        headers=headers,
+                        body=body)
+
+            self.assertFalse(apply_async.called,
+                    msg="Nothing is queued before the message is committed")
+
+            for callback in callbacks:
+                callback()
+
+        apply_async.assert_called_once_with(
+                args = [str(message.id)],
+                queue = INBOX_QUEUE,
+                )
+
+        self.assertEqual(
+                httpretty.latest_requests(),
+                [],
+                msg="Nothing was fetched before the task ran")
+
+        self.assertEqual(
+                len(trilby_models.Follow.objects.filter(
+                    following=alice,
+                    )),
+                0,
+                msg="Nothing was created before the task ran")
+
+        self.assertTrue(
+                bowler_validation.IncomingMessage.objects.filter(
+                    id = message.id,
+                    ).exists(),
+                msg="The message was stored for the task")
+
+        bowler_validation._run_validation(str(message.id))
+
+        self.assertEqual(
+                len(trilby_models.Follow.objects.filter(
+                    following=alice,
+                    )),
+                1,
+                msg="The task validated the message")
+
     @httpretty.activate
     def test_remote_user_spoofed(self):
 
@@ -168,9 +399,10 @@ class TestValidation(TestCase):
         logger.info('Test message body: %s',
                 body)
 
-        validate(path=INBOX_PATH,
-                headers=headers,
-                body=body)
+        with self.captureOnCommitCallbacks(execute=True):
+            validate(path=INBOX_PATH,
+                    headers=headers,
+                    body=body)
 
         self.assertEqual(
                 len(trilby_models.Follow.objects.filter(
@@ -214,9 +446,10 @@ class TestValidation(TestCase):
                 secret = keys['private'],
                 )
 
-        validate(path=INBOX_PATH,
-                headers=headers,
-                body=body)
+        with self.captureOnCommitCallbacks(execute=True):
+            validate(path=INBOX_PATH,
+                    headers=headers,
+                    body=body)
 
         self.assertEqual(
                 len(trilby_models.Follow.objects.filter(
@@ -269,9 +502,10 @@ class TestValidation(TestCase):
                 secret = keys['private'],
                 )
 
-        validate(path=INBOX_PATH,
-                headers=headers,
-                body=body)
+        with self.captureOnCommitCallbacks(execute=True):
+            validate(path=INBOX_PATH,
+                    headers=headers,
+                    body=body)
 
         self.assertEqual(
                 len(trilby_models.Follow.objects.filter(
@@ -14,6 +14,8 @@ logger = logging.getLogger(name="kepi")
 from django.core.serializers.json import DjangoJSONEncoder
 from django.conf import settings
 from urllib.parse import urlparse
+import functools
+import re
 
 def as_json(d,
         indent=2):
@@ -57,6 +59,57 @@ def configured_url(keyname,
     """
     return uri_to_url(configured_path(keyname, **kwargs))
 
+# What each kind of placeholder in a KEPI[...]_LINK setting
+# can stand for, when we match paths against it.
+_PLACEHOLDER_PATTERNS = {
+        's': '[^/?#]+',
+        'd': '[0-9]+',
+        'x': '[0-9a-f]+',
+        }
+
+_PLACEHOLDER = re.compile(r'%\((\w+)\)([sdx])')
+
+@functools.lru_cache(maxsize=None)
+def _compile_path_template(template):
+    """
+    Turns a KEPI[...]_LINK setting, such as '/users/%(username)s',
+    into a regular expression which matches the paths it makes.
+    """
+
+    result = ''
+    position = 0
+
+    for placeholder in _PLACEHOLDER.finditer(template):
+        result += re.escape(template[position:placeholder.start()])
+        result += '(?P<%s>%s)' % (
+                placeholder.group(1),
+                _PLACEHOLDER_PATTERNS[placeholder.group(2)],
+                )
+        position = placeholder.end()
+
+    result += re.escape(template[position:])
+
+    return re.compile(result+'$')
+
+def match_configured_path(keyname, path):
+    """
+    The reverse of configured_path(). If "path" could have been
+    made from the KEPI setting "keyname", returns a dict of the
+    parameters which would have made it. Otherwise, returns None.
+
+    For example, if KEPI['USER_LINK'] is '/users/%(username)s',
+    match_configured_path('USER_LINK', '/users/alice') returns
+    {'username': 'alice'}.
+    """
+
+    found = _compile_path_template(
+            settings.KEPI[keyname]).match(path)
+
+    if found is None:
+        return None
+
+    return found.groupdict()
+
 def is_short_id(s):
     try:
         return str(s)[0] in '/@'
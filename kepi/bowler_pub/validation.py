@@ -12,18 +12,30 @@ message is from who it claims to be from.
 import logging
 logger = logging.getLogger(name="kepi")
 
-from django.db import models
+from django.db import models, transaction
 from celery import shared_task
+import django.utils.timezone
 import json
 import re
 from django.conf import settings
 from urllib.parse import urlparse
 import django.core.exceptions
 import uuid
-from httpsig.verify import HeaderVerifier
-from kepi.sombrero_sendpub.fetch import fetch
+import base64
+import binascii
+from httpsig.utils import parse_signature_header, generate_message, \
+        HASHES
+from kepi.sombrero_sendpub.keys import key_cache
+from kepi.sombrero_sendpub.resolution import resolving
 from kepi.bowler_pub.create import create
 
+# The Celery queue which validates incoming messages.
+# Give it its own workers, so that a flood of incoming
+# messages doesn't hold up anything else:
+#
+#    celery -A kepi worker -Q inbox --concurrency=4
+INBOX_QUEUE = 'inbox'
+
 class IncomingMessage(models.Model):
 
     """
@@ -92,9 +104,15 @@ def validate(path, headers, body):
     """
     Validates a message.
 
-    This function sets up the message for validation,
-    kicks off the validation task, and returns immediately.
-    The actual work is done by _run_validation(), below.
+    This function stores the message, queues the validation task
+    on INBOX_QUEUE once the message is committed, and returns
+    immediately. It doesn't fetch
+    anything or check any signatures, so the inbox can answer
+    the sender straight away. The actual work is done by
+    _run_validation(), below.
+
+    Returns the IncomingMessage, or None if we couldn't
+    store the message.
 
     path -- the URL path that the message was sent to
     headers -- the HTTP headers
@@ -115,7 +133,7 @@ def validate(path, headers, body):
         except UnicodeDecodeError as ude:
             logger.info("  -- failed validation: invalid encoding: %s",
                     ude)
-            return
+            return None
 
     # make sure this is a real dict.
     # httpsig.utils.CaseInsensitiveDict doesn't
@@ -135,9 +153,20 @@ def validate(path, headers, body):
             )
     message.save()
 
-    logger.debug('%s: invoking the validation task',
+    logger.debug('%s: queueing the validation task',
             message.id)
-    _run_validation(message.id)
+
+    # The message must be committed before the task
+    # can look for it.
+    message_id = str(message.id)
+    transaction.on_commit(
+            lambda: _run_validation.apply_async(
+                args = [message_id],
+                queue = INBOX_QUEUE,
+                ),
+            )
+
+    return message
 
 @shared_task()
 def _run_validation(
@@ -152,14 +181,22 @@ def _run_validation(
         # primitive types.
         raise ValueError("_run_validation()'s message_id parameter takes a UUID string")
 
-    valid = _run_validation_inner(message)
+    logger.info('%s: validating; waited %.3fs in the queue',
+            message,
+            (django.utils.timezone.now()-message.received_date).total_seconds(),
+            )
+
+    # Anything we look up while validating the message, such as
+    # its actor, is still there when we come to create() it.
+    with resolving():
+        valid = _run_validation_inner(message)
 
-    if valid:
-        result = create(
-                fields = message.fields,
-                address = str(message),
-                )
-        return result
+        if valid:
+            result = create(
+                    fields = message.fields,
+                    address = str(message),
+                    )
+            return result
 
     return None
 
@@ -188,81 +225,117 @@ def _run_validation_inner(
         return False
 
     try:
-        from kepi.trilby_api.models import Person
-        actor = fetch(message.actor,
-                Person)
+        actor = message.actor
     except json.decoder.JSONDecodeError as jde:
         logger.info('%s: invalid JSON; dropping: %s',
                 message, jde)
         return False
-    except UnicodeDecodeError:
-        logger.info('%s: invalid UTF-8; dropping', message)
-        return False
-
-    if actor is None:
-        logger.info('%s: remote actor does not exist; dropping message',
-            message)
-        # FIXME: If this message is an instruction to delete a remote user,
-        # it's valid if the remote user is Gone. Need to pass this out
-        # from fetch() somehow.
-        return False
 
     logger.debug('%s: message signature is: %s',
             message, message.signature)
     logger.debug('%s: message body is: %s',
             message, message.body)
 
-    logger.debug('%s: actor details are: %s',
-            message, actor)
+    key = key_cache.get(key_id,
+            actor = actor,
+            )
 
-    # XXX key used to sign must "_obviously_belong_to" the actor
+    if key is None:
+        logger.info('%s: can\'t find the key %s; dropping message',
+            message, key_id)
+        # FIXME: If this message is an instruction to delete a remote user,
+        # it's valid if the remote user is Gone. Need to pass this out
+        # from fetch() somehow.
+        return False
 
-    try:
-        key = actor.publicKey
-    except TypeError as te:
-        logger.info('%s: actor has an invalid public key (%s); dropping message',
-                message, te,
-                )
+    if key.owner!=actor:
+        # Otherwise anyone could sign messages claiming
+        # to be from anyone else.
+        logger.info('%s: signed with %s, which belongs to %s, '+\
+                'not to the actor %s; dropping message',
+                message, key_id, key.owner, actor)
         return False
 
     logger.debug('Verifying; key=%s, path=%s, host=%s',
             key, message.path, message.host)
 
-    logger.debug('All params: %s', {
-            'headers': {
-                'Content-Type': message.content_type,
-                'Date': message.date,
-                'Signature': message.signature,
-                'Host': message.host,
-                'Digest': message.digest,
-                },
-            'secret': key,
-            'method': 'POST',
-            'path': message.path,
-            'host': message.host,
-            'sign_header': 'Signature',
-            })
-
-    hv = HeaderVerifier(
-            headers = {
-                'Content-Type': message.content_type,
-                'Date': message.date,
-                'Signature': message.signature,
-                'Host': message.host,
-                'Digest': message.digest,
-                },
-            secret = key,
-            method = 'POST',
-            path = message.path,
-            host = message.host,
-            sign_header = 'Signature',
-        )
-
-    if not hv.verify():
-        logger.info('%s: spoofing attempt; message dropped',
-                message)
-        return False
+    if not _verify(message, key):
+
+        # Perhaps they've changed their key since we last looked.
+        key = key_cache.get(key_id,
+                actor = actor,
+                refresh = True,
+                )
+
+        if key is None or key.owner!=actor or \
+                not _verify(message, key):
+            logger.info('%s: spoofing attempt; message dropped',
+                    message)
+            return False
 
     logger.debug('%s: validation passed!', message)
 
     return True
+
+def _verify(
+        message,
+        key,
+        ):
+
+    """
+    Returns True iff the signature on "message" was made
+    with the VerificationKey "key".
+
+    This is what httpsig's HeaderVerifier does, except that
+    it uses a key we've already parsed.
+    """
+
+    signature = parse_signature_header(message.signature)
+
+    sign_algorithm, _, hash_algorithm = signature.get('algorithm',
+            'rsa-sha256').partition('-')
+
+    if sign_algorithm!='rsa' or hash_algorithm not in HASHES:
+        logger.info('%s: unsupported signature algorithm: %s',
+                message, signature.get('algorithm'))
+        return False
+
+    signed_headers = signature.get('headers', 'date').split(' ')
+
+    if 'date' not in signed_headers:
+        logger.info('%s: the date is not signed', message)
+        return False
+
+    try:
+        signing_string = generate_message(
+                signed_headers,
+                {
+                    'Content-Type': message.content_type,
+                    'Date': message.date,
+                    'Signature': message.signature,
+                    'Host': message.host,
+                    'Digest': message.digest,
+                    },
+                host = message.host,
+                method = 'POST',
+                path = message.path,
+                )
+
+        signed = base64.b64decode(signature.get('signature', ''))
+
+    except (binascii.Error, ValueError) as e:
+        logger.info('%s: invalid signature: %s', message, e)
+        return False
+
+    except Exception as e:
+        # httpsig raises a plain Exception for missing headers.
+        logger.info('%s: can\'t check the signature: %s', message, e)
+        return False
+
+    if isinstance(signing_string, str):
+        signing_string = signing_string.encode('UTF-8')
+
+    digest = HASHES[hash_algorithm].new()
+    digest.update(signing_string)
+
+    return key.verifier.verify(digest, signed)
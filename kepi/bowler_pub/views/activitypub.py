@@ -23,6 +23,7 @@ from collections.abc import Iterable
 import logging
 import urllib.parse
 import json
+import time
 from rest_framework import generics, response
 
 logger = logging.getLogger(name='kepi')
@@ -445,10 +446,11 @@ class InboxView(CollectionView):
         Accept a message posted to one of our inboxes.
 
         All we do here is pass the message on to validate(),
-        which will run asynchronously, and then thank the
-        caller. There is no situation where the caller can
-        get an error, because errors are being checked for
-        behind the scenes by the validate() task.
+        which stores it and queues it to be checked
+        asynchronously, and then thank the caller. There is
+        no situation where the caller can get an error,
+        because errors are being checked for behind the
+        scenes by the validation task.
 
         Params:
             request:  the HttpRequest
@@ -458,6 +460,8 @@ class InboxView(CollectionView):
                       be gained by checking it.)
         """
 
+        started = time.monotonic()
+
         body = request.data
 
         log_one_message(
@@ -480,6 +484,9 @@ class InboxView(CollectionView):
                         None, problem, problem.__traceback__)),
                     )
 
+        logger.info('Inbox message accepted in %.1fms',
+                (time.monotonic()-started)*1000)
+
         # I think this should be 201 Created, but the spec
         # says 200, so 200 is what they get.
         return HttpResponse(
@@ -38,6 +38,7 @@ KEPI = {
         'LOCAL_OBJECT_HOSTNAME': 'example.com',
 
         'OBJECT_LINK': '/%(number)s',
+        'ACTIVITY_LINK': '/activities/%(serial)s',
         'USER_LINK': '/users/%(username)s',
         'COLLECTION_LINK': '/users/%(username)s/%(listname)s',
         'STATUS_LINK': '/users/%(username)s/%(id)s',
@@ -62,6 +63,94 @@ KEPI = {
         'CONTACT_EMAIL': 'marnanel@example.com',
         'LANGUAGES': [LANGUAGE_CODE],
 
+        # Outgoing delivery: how many posts can be in flight at once,
+        # overall and to any one remote host, and how many seconds
+        # we wait for a remote host before giving up.
+        # The limit for each remote host starts at
+        # DELIVERY_MAX_PER_HOST, and then adapts to how the host
+        # is coping, up to DELIVERY_PER_HOST_CEILING.
+        'DELIVERY_MAX_CONNECTIONS': 64,
+        'DELIVERY_MAX_PER_HOST': 4,
+        'DELIVERY_PER_HOST_CEILING': 32,
+        'DELIVERY_TIMEOUT': 30,
+
+        # How many remote hosts we keep delivery connections
+        # open to at once; the least recently used are closed.
+        'DELIVERY_MAX_SESSIONS': 256,
+
+        # Outgoing deliveries are shared between this many lanes,
+        # by remote hostname. Each lane has its own Celery queue
+        # for interactive deliveries and another for bulk ones; see
+        # kepi.sombrero_sendpub.delivery.lane_queue() and
+        # dispatch_queue(). Run one worker per lane queue, with a
+        # concurrency of one. Only databases with row locking
+        # (SELECT ... FOR UPDATE SKIP LOCKED) keep deliveries in
+        # order if two workers share a lane.
+        'DELIVERY_LANES': 8,
+
+        # The cache of remote objects which fetch() keeps: how many
+        # to keep in memory, and for how many seconds to keep them,
+        # and misses. FETCH_CACHE can be the name of one of the
+        # CACHES, which will then be shared between processes.
+        'FETCH_CACHE_SIZE': 2048,
+        'FETCH_CACHE_TTL': 5*60,
+        'FETCH_CACHE_NEGATIVE_TTL': 60,
+        'FETCH_CACHE': None,
+
+        # How many remote objects fetch_many() fetches at once.
+        'FETCH_MANY_WORKERS': 8,
+
+        # How many seconds we remember webfinger lookups for,
+        # and failed lookups.
+        'WEBFINGER_TTL': 24*60*60,
+        'WEBFINGER_NEGATIVE_TTL': 10*60,
+
+        # The public keys which incoming messages are signed with:
+        # how many to keep in memory, and for how many seconds;
+        # and how many seconds we wait before asking again whether
+        # someone's key has changed, when a signature doesn't verify.
+        # See kepi.sombrero_sendpub.keys.
+        'KEY_CACHE_SIZE': 1024,
+        'KEY_CACHE_TTL': 60*60,
+        'KEY_REFETCH_INTERVAL': 60,
+
+        # How many seconds we wait before checking whether
+        # a remote person has changed.
+        'REMOTE_PERSON_LIFETIME': 24*60*60,
+
+        # How many remote people we check each time
+        # refresh_remote_people runs (see CELERY_BEAT_SCHEDULE).
+        # Each run should get through about as many people as
+        # go stale in the meantime, or we'll fall behind.
+        'REFRESH_BATCH_SIZE': 50,
+
+        # How many seconds we wait before syncing our copies of
+        # remote followers and following collections, and before
+        # going through the whole of each of them again.
+        'MIRROR_LIFETIME': 60*60,
+        'MIRROR_WALK_LIFETIME': 24*60*60,
+
+        # How many seconds we wait after someone updates their
+        # profile before telling anyone. Further updates in that
+        # time are merged into one.
+        'UPDATE_COALESCE_SECONDS': 60,
+
+        # When we GET things from remote servers: how many seconds
+        # we wait to connect, for each read, and altogether;
+        # the most bytes we'll read; how many seconds we remember
+        # DNS lookups for; how many connections we keep alive
+        # to each host, and how many hosts we keep connections
+        # open to. See kepi.sombrero_sendpub.outbound. A worker
+        # fetching an address holds a lease on it for the longest
+        # a fetch can take; see FetchLease.
+        'OUTBOUND_CONNECT_TIMEOUT': 5,
+        'OUTBOUND_READ_TIMEOUT': 10,
+        'OUTBOUND_TOTAL_TIMEOUT': 30,
+        'OUTBOUND_MAX_SIZE': 1024*1024,
+        'OUTBOUND_DNS_TTL': 60,
+        'OUTBOUND_POOL_SIZE': 4,
+        'OUTBOUND_MAX_SESSIONS': 256,
+
         }
 
 MIDDLEWARE = [
@@ -115,6 +204,49 @@ CELERY = {
         'task_ignore_result': True,
         }
 
+# Periodic tasks, run by "celery beat".
+CELERY_BEAT_SCHEDULE = {
+        'retry-deliveries': {
+            'task': 'kepi.sombrero_sendpub.delivery.retry_deliveries',
+            'schedule': 60.0,
+            },
+        'dispatch-outbox': {
+            'task': 'kepi.sombrero_sendpub.delivery.dispatch_outbox',
+            'schedule': 60.0,
+            },
+        'refresh-instances': {
+            'task': 'kepi.sombrero_sendpub.nodeinfo.refresh_instances',
+            'schedule': 60.0*60,
+            },
+        'refresh-remote-people': {
+            'task': 'kepi.sombrero_sendpub.refresh.refresh_remote_people',
+            'schedule': 5*60.0,
+            },
+        'sync-mirrors': {
+            'task': 'kepi.sombrero_sendpub.mirror.sync_mirrors',
+            'schedule': 5*60.0,
+            },
+        'forget-failures': {
+            'task': 'kepi.sombrero_sendpub.fetch.forget_failures',
+            'schedule': 24*60.0*60,
+            },
+        }
+
+# Modules containing tasks. Celery's autodiscovery only
+# looks in modules called "tasks".
+CELERY_IMPORTS = [
+        'kepi.sombrero_sendpub.delivery',
+        'kepi.sombrero_sendpub.nodeinfo',
+        'kepi.sombrero_sendpub.fetch',
+        'kepi.sombrero_sendpub.refresh',
+        'kepi.sombrero_sendpub.mirror',
+        ]
+
+# With no broker configured, tasks run in-process as soon as
+# they're queued. Set up a broker in local_config.py, and
+# set this to False, to run them in the background.
+CELERY_TASK_ALWAYS_EAGER = True
+
 LOGGING = {
 
         'version': 1,
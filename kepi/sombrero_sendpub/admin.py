@@ -1,3 +1,26 @@
+# admin.py
+#
+# Part of kepi, an ActivityPub daemon.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+These classes are used by the admin system to interact
+with sombrero_sendpub's models.
+"""
+
 from django.contrib import admin
+import kepi.sombrero_sendpub.models as sombrero_models
+
+@admin.register(sombrero_models.Delivery)
+class DeliveryAdmin(admin.ModelAdmin):
+
+    list_display = ('activity', 'inbox', 'lane', 'state',
+            'attempts', 'next_attempt', 'last_status')
+
+    list_filter = ('state', 'lane')
+
+@admin.register(sombrero_models.Instance)
+class InstanceAdmin(admin.ModelAdmin):
 
-# Register your models here.
+    list_display = ('hostname', 'error_streak', 'circuit_open_until')
@@ -0,0 +1,323 @@
+# cache.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+This contains FetchCache, which remembers the results of fetch()
+for remote objects, so that looking up the same actor over and
+over doesn't cost a database query (or a network request) each time.
+
+There are two tiers. The first is a least-recently-used cache
+in the memory of this process. The second, which is optional,
+is one of Django's caches, which can be shared between processes;
+set KEPI['FETCH_CACHE'] to the name of the cache in settings.CACHES.
+
+Misses are cached too ("negative caching"), for less time.
+
+Results are only cached once the transaction they were found in
+has been committed, so that we never remember something which
+was rolled back. Cached objects are forgotten whenever they're
+saved or deleted, and so are any misses for their addresses.
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+import threading
+import time
+import hashlib
+from collections import OrderedDict
+from django.conf import settings
+from django.db import transaction
+
+DEFAULT_SIZE = 2048
+DEFAULT_TTL = 5*60
+DEFAULT_NEGATIVE_TTL = 60
+
+# Stored in place of None, so we can tell a cached miss
+# from something which isn't in the cache.
+_MISSING = 'kepi-fetch-missing'
+
+class FetchCache(object):
+
+    """
+    A two-tier cache of fetch() results,
+    keyed on (address, expected_type).
+
+    Keyword arguments:
+        size -- how many results to keep in memory.
+            Defaults to KEPI['FETCH_CACHE_SIZE']. If this is
+            zero, nothing is cached.
+        ttl -- how many seconds to keep a result for.
+            Defaults to KEPI['FETCH_CACHE_TTL'].
+        negative_ttl -- how many seconds to remember a miss for.
+            Defaults to KEPI['FETCH_CACHE_NEGATIVE_TTL'].
+    """
+
+    def __init__(self,
+            size = None,
+            ttl = None,
+            negative_ttl = None,
+            ):
+
+        self._size = size
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._by_object = {}
+
+        self._zero_stats()
+
+    def _setting(self, value, name, default):
+        if value is not None:
+            return value
+
+        return settings.KEPI.get(name, default)
+
+    @property
+    def size(self):
+        return self._setting(self._size,
+                'FETCH_CACHE_SIZE', DEFAULT_SIZE)
+
+    @property
+    def ttl(self):
+        return self._setting(self._ttl,
+                'FETCH_CACHE_TTL', DEFAULT_TTL)
+
+    @property
+    def negative_ttl(self):
+        return self._setting(self._negative_ttl,
+                'FETCH_CACHE_NEGATIVE_TTL', DEFAULT_NEGATIVE_TTL)
+
+    @property
+    def shared(self):
+        """
+        The Django cache we use as our second tier, or None.
+        """
+
+        name = settings.KEPI.get('FETCH_CACHE', None)
+
+        if name is None:
+            return None
+
+        from django.core.cache import caches
+        return caches[name]
+
+    def _zero_stats(self):
+        self._stats = {
+                'hits': 0,
+                'negative_hits': 0,
+                'shared_hits': 0,
+                'misses': 0,
+                'evictions': 0,
+                'expiries': 0,
+                'invalidations': 0,
+                }
+
+    def stats(self):
+        """
+        Returns a dict of how well the cache is doing, since
+        the process started or clear() was last called.
+        """
+
+        with self._lock:
+            result = self._stats.copy()
+            result['size'] = len(self._entries)
+
+        lookups = result['hits'] + result['negative_hits'] + \
+                result['shared_hits'] + result['misses']
+
+        if lookups:
+            result['hit_rate'] = 1-(result['misses']/lookups)
+        else:
+            result['hit_rate'] = 0.0
+
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_object.clear()
+            self._zero_stats()
+
+    def _key(self, address, expected_type):
+        return (address,
+                f'{expected_type.__module__}.{expected_type.__qualname__}')
+
+    def _shared_key(self, address):
+        # The shared tier is keyed on the address alone, so that
+        # any process can invalidate it; see invalidate().
+        return 'kepi-fetch:'+hashlib.sha256(
+                address.encode('UTF-8')).hexdigest()
+
+    def _object_id(self, value):
+        if value is None or getattr(value, 'pk', None) is None:
+            return None
+
+        return (value._meta.label, value.pk)
+
+    def get(self, address, expected_type):
+        """
+        Returns a tuple (found, value). If "found" is False,
+        the cache doesn't know about the address, and you'll have
+        to look it up. Otherwise, "value" is the result of fetch(),
+        which may be None.
+        """
+
+        if self.size==0:
+            return False, None
+
+        key = self._key(address, expected_type)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key, None)
+
+            if entry is not None:
+                value, expires = entry
+
+                if expires > now:
+                    self._entries.move_to_end(key)
+
+                    if value is None:
+                        self._stats['negative_hits'] += 1
+                    else:
+                        self._stats['hits'] += 1
+
+                    return True, value
+
+                self._stats['expiries'] += 1
+                self._forget(key)
+
+        shared = self.shared
+        if shared is not None:
+            found = shared.get(self._shared_key(address), None)
+
+            if found is not None and found[0]==key[1]:
+                value = found[1]
+
+                if value==_MISSING:
+                    value = None
+
+                with self._lock:
+                    self._stats['shared_hits'] += 1
+
+                self._store(key, value, shared_too=False)
+                return True, value
+
+        with self._lock:
+            self._stats['misses'] += 1
+
+        return False, None
+
+    def put(self, address, expected_type, value):
+        """
+        Remembers "value" as the result of fetching "address".
+
+        This only happens once the current transaction has been
+        committed. If it's rolled back, nothing is remembered.
+        """
+
+        if self.size==0:
+            return
+
+        key = self._key(address, expected_type)
+
+        transaction.on_commit(lambda: self._store(key, value))
+
+    def _store(self, key, value, shared_too=True):
+
+        if value is None:
+            ttl = self.negative_ttl
+        else:
+            ttl = self.ttl
+
+        with self._lock:
+            self._forget(key)
+
+            self._entries[key] = (value, time.monotonic()+ttl)
+
+            object_id = self._object_id(value)
+            if object_id is not None:
+                self._by_object.setdefault(object_id, set()).add(key)
+
+            while len(self._entries) > self.size:
+                oldest = next(iter(self._entries))
+                self._forget(oldest)
+                self._stats['evictions'] += 1
+
+        if shared_too:
+            shared = self.shared
+            if shared is not None:
+                if value is None:
+                    shared_value = _MISSING
+                else:
+                    shared_value = value
+
+                shared.set(self._shared_key(key[0]),
+                        (key[1], shared_value), ttl)
+
+    def _forget(self, key):
+        # The caller must hold self._lock.
+
+        entry = self._entries.pop(key, None)
+
+        if entry is None:
+            return
+
+        object_id = self._object_id(entry[0])
+        if object_id in self._by_object:
+            self._by_object[object_id].discard(key)
+            if not self._by_object[object_id]:
+                del self._by_object[object_id]
+
+    def invalidate(self, value):
+        """
+        Forgets everything which refers to the model instance "value".
+        """
+
+        object_id = self._object_id(value)
+
+        if object_id is None:
+            return
+
+        with self._lock:
+            keys = list(self._by_object.get(object_id, []))
+
+            for key in keys:
+                self._forget(key)
+                self._stats['invalidations'] += 1
+
+        shared = self.shared
+        if shared is not None:
+            addresses = set([x[0] for x in keys])
+
+            for field in ['remote_url', 'acct']:
+                address = getattr(value, field, None)
+                if address:
+                    addresses.add(address)
+
+            shared.delete_many([self._shared_key(x) for x in addresses])
+
+    def invalidate_address(self, address):
+        """
+        Forgets everything we know about "address", of any type,
+        including misses.
+        """
+
+        with self._lock:
+            keys = [x for x in self._entries.keys() if x[0]==address]
+
+            for key in keys:
+                self._forget(key)
+                self._stats['invalidations'] += 1
+
+        shared = self.shared
+        if shared is not None:
+            shared.delete(self._shared_key(address))
+
+fetch_cache = FetchCache()
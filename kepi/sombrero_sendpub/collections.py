@@ -24,9 +24,6 @@ class ErsatzModel(object):
         self.url = remote_url
         self.status = 0
 
-        self._iter_items = []
-        self._next_page = None
-
     def update(self, found):
         """
         Update this object with information retrieved from
@@ -105,48 +102,198 @@ class Collection(ErsatzModel):
         return self.totalItems
 
     def __iter__(self):
+        return self.iterate()
+
+    def iterate(self,
+            limit = None,
+            prefetch = True,
+            ):
+        """
+        Returns a CollectionIterator over this Collection.
+
+        Iterating over the Collection directly does the same thing,
+        but with the default arguments. See CollectionIterator
+        for what the arguments mean.
+        """
+
+        return CollectionIterator(
+                collection = self,
+                limit = limit,
+                prefetch = prefetch,
+                )
+
+class CollectionIterator(object):
+
+    """
+    Iterates over the items of a Collection, fetching its
+    pages as needed.
+
+    While you're working through one page, we fetch the next
+    one in the background (unless "prefetch" is False), so that
+    walking a big collection takes about as long as downloading it,
+    rather than one round trip per page on top of that.
+    Nothing is fetched until you ask for the first item.
+
+    If "limit" is given, we stop after that many items, and
+    don't fetch pages we won't need. If you stop early yourself,
+    call close() so that we don't fetch the next page for nothing.
+
+    Each iterator is separate, so you can iterate over
+    the same Collection more than once.
+
+    Once the iteration has stopped, "complete" is True if we
+    reached the end of the collection, and False if we stopped
+    for any other reason, such as being unable to fetch a page.
+    """
+
+    def __init__(self,
+            collection,
+            limit = None,
+            prefetch = True,
+            ):
+
+        self.collection = collection
+        self.limit = limit
+        self.prefetch = prefetch
+        self.count = 0
+        self.complete = False
+
+        self._pending = None
+        self._started = False
+        self._seen = set([collection.url])
 
         try:
-            self._iter_items = self.items.copy()
-            self._next_page = self.first
-            logger.debug("%s: iteration: begin with %s",
-                    self.url, self._iter_items)
+            items = collection.items
+            self._next_page = collection.first
+            logger.debug("%s: iteration: begin with %d items",
+                    collection.url, len(items))
 
         except AttributeError:
-            self._iter_items = None
+            items = []
             self._next_page = None
-            logger.info("%s: iteration: no content loaded", self.url)
+            logger.info("%s: iteration: no content loaded",
+                    collection.url)
+
+        self._items = iter(items)
+        self._first_items = items
 
+    def __iter__(self):
         return self
 
     def __next__(self):
-        if self._iter_items:
-            return self._iter_items.pop(0)
 
-        if self._next_page is None:
-            logger.debug("%s: iteration: finished!",
-                    self.url)
+        if self.limit is not None and self.count >= self.limit:
+            logger.debug("%s: iteration: reached the limit of %d",
+                    self.collection.url, self.limit)
+            self.close()
             raise StopIteration
 
-        logger.debug("%s: iteration: fetching %s...",
-                self.url, self._next_page)
+        if not self._started:
+            # We wait until now to start prefetching, so that
+            # an iterator which is never used doesn't cost a page.
+            self._started = True
+            self._start_page(self._first_items)
+            self._first_items = None
+
+        while True:
+            try:
+                result = next(self._items)
+                self.count += 1
+                return result
+            except StopIteration:
+                pass
+
+            if not self._fetch_next_page():
+                raise StopIteration
+
+    def close(self):
+        """
+        Stops the iteration. Any page we were fetching
+        in the background is abandoned.
+        """
+
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+
+        self._started = True
+        self._items = iter(())
+        self._next_page = None
+
+    def _start_page(self, items):
+
+        # Iterating over the list, rather than popping items
+        # off the front, means each item costs the same
+        # however long the page is.
+        self._items = iter(items)
+
+        if not self.prefetch or self._next_page is None:
+            return
+
+        if self._next_page in self._seen:
+            # We'll stop there anyway; see _fetch_next_page().
+            return
+
+        if self.limit is not None and \
+                self.count+len(items) >= self.limit:
+            # We won't get that far.
+            return
 
         import kepi.sombrero_sendpub.fetch as fetch
 
-        next_bit = fetch.fetch(
+        self._pending = fetch.prefetch(
                 self._next_page,
                 expected_type = _CollectionPage,
                 )
 
-        if next_bit is None:
+    def _fetch_next_page(self):
+        """
+        Moves on to the next page. Returns False if there
+        isn't one, or if we couldn't get it.
+        """
+
+        address = self._next_page
+        pending = self._pending
+        self._next_page = None
+        self._pending = None
+
+        if address is None:
+            logger.debug("%s: iteration: finished!",
+                    self.collection.url)
+            self.complete = True
+            return False
+
+        if address in self._seen:
+            logger.info("%s: iteration: %s has come round again; stopping",
+                    self.collection.url, address)
+
+            if pending is not None:
+                pending.cancel()
+
+            return False
+
+        self._seen.add(address)
+
+        logger.debug("%s: iteration: fetching %s...",
+                self.collection.url, address)
+
+        import kepi.sombrero_sendpub.fetch as fetch
+
+        page = fetch.fetch(
+                address,
+                expected_type = _CollectionPage,
+                prefetched = pending,
+                )
+
+        if page is None:
             logger.info("%s: error in fetching items",
-                    self.url)
-            raise StopIteration
+                    self.collection.url)
+            return False
 
-        self._iter_items = next_bit.items
-        self._next_page = next_bit.next
+        logger.debug('  -- containing %d items',
+                len(page.items))
 
-        logger.debug('  -- containing %s',
-                self._iter_items)
+        self._next_page = page.next
+        self._start_page(page.items)
 
-        return self._iter_items.pop(0)
+        return True
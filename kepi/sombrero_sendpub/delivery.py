@@ -8,14 +8,18 @@ import logging
 logger = logging.getLogger(name='kepi')
 
 from celery import shared_task
-import requests
 import json
 import httpsig
 import random
-from django.http.request import HttpRequest
 from django.conf import settings
+from django.db import transaction
 from urllib.parse import urlparse
 from kepi.bowler_pub.utils import *
+from kepi.sombrero_sendpub.engine import DeliveryEngine
+import django.utils.timezone
+import email.utils
+import threading
+import hashlib
 import datetime
 import pytz
 
@@ -40,11 +44,12 @@ class _Postie(object):
             sender,
             ):
 
-        self.message = message.content
+        self.message = message
         self.sender = sender
-        self.signer = None
         self.sent_to = set()
         self.sent_to_local = False
+        self.wants_local = False
+        self.pending = []
 
     def send_to(self, inbox):
 
@@ -59,18 +64,7 @@ class _Postie(object):
             return
 
         if is_local(inbox):
-            if self.sent_to_local:
-                logger.debug("Not re-sending to local inbox: %s",
-                        inbox)
-                return
-
-            logger.debug("Sending to local inbox: %s", inbox)
-
-            _deliver_local(
-                    message=self.message,
-                    )
-
-            self.sent_to_local = True
+            self.send_to_local()
             return
 
         if inbox in self.sent_to:
@@ -78,41 +72,206 @@ class _Postie(object):
             return
 
         logger.info("Sending to remote inbox: %s", inbox)
-        parsed_target_url = urlparse(inbox)
-
-        headers = {
-                'Date': _rfc822_datetime(),
-                'Host': parsed_target_url.netloc,
-                # lowercase is deliberate, to work around
-                # an infelicity of the signer library
-                'content-type': "application/activity+json",
-                }
-
-        if self.signer is None and self.sender is not None:
-            self.signer = _signer_for_localperson(
-                    localperson = self.sender,
-                    )
 
-        if self.signer is not None:
-            headers = self.signer.sign(
-                    headers,
-                    method = 'POST',
-                    path = parsed_target_url.path,
+        self.pending.append(inbox)
+
+        # Even if delivery fails, we don't try this inbox again.
+        # If we've failed once to deliver, we don't
+        # want to hammer on the remote server.
+
+        self.sent_to.add(inbox)
+
+    def flush(self):
+        """
+        Records a Delivery for each of the remote inboxes we've been
+        given since the last flush, and then wakes up the lanes
+        they go through, once the Deliveries are committed.
+        """
+
+        import kepi.sombrero_sendpub.models as sombrero_models
+
+        if not self.pending:
+            return
+
+        logger.debug("Delivering to %d remote inboxes",
+                len(self.pending))
+
+        deliveries = []
+        for inbox in self.pending:
+            hostname = urlparse(inbox).netloc
+
+            deliveries.append(sombrero_models.Delivery(
+                    activity = self.message,
+                    inbox = inbox,
+                    hostname = hostname,
+                    lane = sombrero_models.lane_for(hostname),
+                    priority = self.message.priority,
+                    ))
+
+        sombrero_models.Delivery.objects.bulk_create(
+                deliveries,
+                ignore_conflicts = True,
+                )
+
+        priority = self.message.priority
+        for lane in sorted(set([x.lane for x in deliveries])):
+            transaction.on_commit(
+                    lambda lane=lane: _queue_lane(priority, lane),
                     )
 
-        logger.debug('  -- headers are %s', headers)
+        self.pending = []
+
+    def send_to_local(self):
+        """
+        Notes that the activity should go to our own inbox.
+        deliver_local() does the delivering.
+        """
+        self.wants_local = True
+
+    def deliver_local(self):
+
+        if not self.wants_local:
+            return
+
+        if self.sent_to_local:
+            logger.debug("Not re-sending to local inbox")
+            return
 
-        _deliver_remote(
-                message=self.message,
-                recipient=inbox,
-                signer=self.signer,
+        logger.debug("Sending to local inbox")
+
+        _deliver_local(
+                activity = self.message.value,
                 )
 
-        # Even if _deliver_remote fails, we continue here.
-        # If we've failed once to deliver, we don't
-        # want to hammer on the remote server.
+        self.sent_to_local = True
 
-        self.sent_to.add(inbox)
+def _plan_delivery(
+        target_people = [],
+        target_followers_of = [],
+        to_every_instance = False,
+        ):
+
+    """
+    Works out where an activity should be sent, before we
+    do any network I/O.
+
+    All the recipients are resolved to inbox URLs using a single
+    query, which only reads the columns we need; we don't load
+    whole Person objects.
+
+    Where remote people have a shared inbox, on_person() stores it
+    in their inbox_url, so everyone who uses the same shared inbox
+    gets the activity through it, and we only post there once.
+    People who didn't tell us about a shared inbox get the activity
+    through their own inbox, even if others on the same host have one.
+
+    Hosts which are dead (see Instance.is_dead) are left out.
+
+    Keyword arguments:
+        target_people -- list or QuerySet of Persons
+        target_followers_of -- list of Persons whose followers
+            should receive the activity
+        to_every_instance -- if True, the activity also goes to
+            the shared inbox of every instance we know about
+            which isn't dead
+
+    Returns a tuple (has_local, hosts). "has_local" is True if
+    any recipients are local. "hosts" is a dict mapping each remote
+    hostname to the set of inbox URLs we should post to there.
+    """
+
+    from django.db.models import Q, QuerySet
+    import kepi.trilby_api.models as trilby_models
+    import kepi.sombrero_sendpub.models as sombrero_models
+
+    if isinstance(target_people, QuerySet):
+        people = Q(pk__in = target_people.values('pk'))
+    else:
+        people = Q(pk__in = [x.pk for x in target_people])
+
+    local_following = [x.pk for x in target_followers_of
+            if x.is_local]
+
+    wanted = people | Q(
+            rel_following__following__in = local_following,
+            )
+
+    # Remote people's followers come from our mirror of
+    # their followers collection.
+    for following in target_followers_of:
+        if following.is_local:
+            continue
+
+        logger.debug("planning: finding %s's followers...",
+                following)
+
+        wanted |= Q(pk__in = following.followers.values('pk'))
+
+    has_local = False
+    by_host = {}
+
+    for pk, local_pk, inbox in trilby_models.Person.objects.filter(
+            wanted,
+            ).values_list(
+                    'pk',
+                    'localperson__pk',
+                    'remoteperson__inbox_url',
+                    ).distinct():
+
+        if local_pk is not None:
+            has_local = True
+            continue
+
+        if not inbox:
+            continue
+
+        hostname = urlparse(inbox).netloc
+        by_host.setdefault(hostname, []).append(inbox)
+
+    instances = sombrero_models.Instance.objects.all()
+
+    if not to_every_instance:
+        instances = instances.filter(
+                hostname__in = by_host.keys(),
+                )
+
+    known_shared = {}
+    for instance in instances.only(
+            'hostname', 'shared_inbox', 'error_streak',
+            'last_success', 'first_seen'):
+
+        if instance.is_dead:
+            logger.info('planning: %s is dead; not sending there',
+                    instance.hostname)
+            by_host.pop(instance.hostname, None)
+            continue
+
+        if instance.shared_inbox:
+            known_shared[instance.hostname] = instance.shared_inbox
+
+            if to_every_instance:
+                by_host.setdefault(instance.hostname, [])
+
+    hosts = {}
+    for hostname, inboxes in by_host.items():
+
+        if inboxes:
+            hosts[hostname] = set(inboxes)
+        elif hostname in known_shared:
+            hosts[hostname] = set([known_shared[hostname]])
+
+    logger.debug("planning: local=%s; remote=%s",
+            has_local, hosts)
+
+    return has_local, hosts
+
+# Signers are expensive to make, because the private key has
+# to be parsed. So we keep one for each LocalPerson, for the
+# life of the process. Each is stored alongside a fingerprint
+# of the key it was made from, so if the key changes, we
+# notice and make a new signer.
+_signers = {}
+_signers_lock = threading.Lock()
 
 def _signer_for_localperson(localperson):
 
@@ -130,12 +289,27 @@ def _signer_for_localperson(localperson):
                 'has no private key!', localperson)
         return None
 
+    fingerprint = (
+            localperson.key_name,
+            hashlib.sha256(
+                localperson.privateKey.encode('ASCII')).digest(),
+            )
+
+    with _signers_lock:
+        cached = _signers.get(localperson.pk, None)
+
+    if cached is not None and cached[0]==fingerprint:
+        return cached[1]
+
+    logger.debug('%s: making a new signer', localperson)
+
     try:
-        return httpsig.HeaderSigner(
+        result = httpsig.HeaderSigner(
                 key_id=localperson.key_name,
                 secret=localperson.privateKey,
                 algorithm='rsa-sha256',
-                headers=['(request-target)', 'host', 'date', 'content-type'],
+                headers=['(request-target)', 'host', 'date',
+                    'content-type', 'digest'],
                 sign_header='signature',
                 )
     except httpsig.utils.HttpSigException as hse:
@@ -145,61 +319,54 @@ def _signer_for_localperson(localperson):
         logger.warning('Key was: %s', localperson.privateKey)
         return None
 
+    with _signers_lock:
+        _signers[localperson.pk] = (fingerprint, result)
+
+    return result
+
 def _deliver_local(
-        message,
+        activity,
         ):
 
     """
-    Deliver an activity to the shared inbox.
+    Deliver an activity to local recipients.
+
+    We don't post it to our own shared inbox. The activity came
+    from one of our own users, so there's nothing to validate and
+    no signature to check: we hand it straight to create().
 
     Keyword arguments:
-    message -- the OutgoingActivity we're delivering.
+    activity -- a dict representing the activity. create()
+        may modify it, so don't pass in anything you need to keep.
     """
 
-    from kepi.bowler_pub.views.activitypub import InboxView
-
-    class InboxPostRequest(HttpRequest):
-        """
-        This is a fake HttpRequest.
-        """
+    import kepi.bowler_pub.create as bowler_create
 
-        def __init__(self):
-            super().__init__()
-
-            self.path = '/sharedInbox'
-            self.method = 'POST'
-
-    request = InboxPostRequest()
-
-    result = InboxView.as_view()(
-        request = request,
-        username = None,
-        )
+    result = bowler_create.create(
+            fields = activity,
+            )
 
-    if result.status_code==200:
-        logger.debug("Message posted to local /sharedInbox")
-    else:
-        logger.warning("Message failed to post to local /sharedInbox: error %d",
-                result.status_code)
+    logger.debug("%s: delivered locally; result was %s",
+            activity.get('id'), result)
 
-def _deliver_remote(
-        message,
+def _remote_headers(
         recipient,
         signer,
+        digest,
         ):
 
     """
-    Deliver an activity to a remote actor.
+    Returns the headers for delivering an activity to a remote inbox.
+    If there's a signer, the headers are signed; this is the only
+    place where outgoing requests are signed.
 
     Keyword arguments:
-    message -- the OutgoingActivity we're delivering.
     recipient -- the URL of the recipient
     signer -- an httpsig.HeaderSigner for the
-        local actor who sent this activity
+        local actor who sent this activity, or None
+    digest -- the value of the Digest header for the body
     """
 
-    logger.debug('  -- delivering to remote user %s', recipient)
-
     parsed_target_url = urlparse(recipient)
 
     headers = {
@@ -208,6 +375,7 @@ def _deliver_remote(
             # lowercase is deliberate, to work around
             # an infelicity of the signer library
             'content-type': "application/activity+json",
+            'digest': digest,
             }
 
     if signer is not None:
@@ -217,23 +385,35 @@ def _deliver_remote(
                 path = parsed_target_url.path,
                 )
 
-    logger.debug('    -- headers are %s', headers)
+    logger.debug('%s: headers are %s', recipient, headers)
 
-    # FIXME This is wrong-- we have to look up their inbox address
-    # if we don't have it, and post to that
+    return headers
 
-    try:
-        response = requests.post(
-                recipient,
-                data=str(message),
-                headers=headers,
-                )
-    except requests.exceptions.ConnectionError:
-        logger.debug('    -- cannot connect')
+def _check_response(
+        message,
+        recipient,
+        response,
+        signer,
+        ):
+
+    """
+    Logs what happened when we delivered an activity to a remote inbox.
+
+    Keyword arguments:
+    message -- the OutgoingActivity we delivered.
+    recipient -- the URL of the recipient
+    response -- the requests.Response, or None if we
+        couldn't connect
+    signer -- an httpsig.HeaderSigner for the
+        local actor who sent this activity
+    """
+
+    if response is None:
+        logger.debug('%s: could not deliver', recipient)
         return
 
-    logger.debug('    -- posted; server replied: %d %s',
-            response.status_code, response.reason)
+    logger.debug('%s: posted; server replied: %d %s',
+            recipient, response.status_code, response.reason)
 
     if response.status_code>=400 and response.status_code<=499 and \
             (response.status_code not in [404, 410]):
@@ -241,17 +421,476 @@ def _deliver_remote(
         # The server thinks we made an error. Log the request we made
         # so that we can debug it.
 
-        logger.debug("    -- for debugging: our signer was %s",
-                signer.__dict__)
-        logger.debug("    -- and this is how the message ran: %s %s",
-                headers, message)
+        logger.debug("%s: for debugging: our signer was %s",
+                recipient, signer.__dict__ if signer else None)
+        logger.debug("%s: and this is how the message ran: %s %s",
+                recipient, response.request.headers, message)
+
+def _retry_after(response):
+    """
+    Returns the time given in the Retry-After header of
+    "response", as a datetime, or None if there isn't one.
+    """
+
+    if response is None:
+        return None
+
+    value = response.headers.get('Retry-After', None)
+
+    if value is None:
+        return None
+
+    try:
+        return django.utils.timezone.now() + datetime.timedelta(
+                seconds = int(value))
+    except ValueError:
+        pass
+
+    try:
+        return email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        logger.debug('Unparseable Retry-After header: %s', value)
+        return None
+
+def _attempt_deliveries(
+        deliveries,
+        ):
+
+    """
+    Tries to deliver some pending Deliveries, in parallel,
+    and records how each of them went.
+
+    Deliveries to remote hosts which aren't available, because
+    their circuit breaker is open or they've asked us to wait,
+    are postponed, rather than attempted. How many posts we
+    have in flight to each host is adjusted as we go;
+    see Instance.throttle().
+
+    Keyword arguments:
+    deliveries -- an iterable of pending Deliveries
+    """
+
+    import kepi.sombrero_sendpub.models as sombrero_models
+
+    deliveries = list(deliveries)
+
+    if not deliveries:
+        return
+
+    hostnames = set([d.hostname for d in deliveries])
+
+    instances = dict([(x.hostname, x) for x in
+        sombrero_models.Instance.objects.filter(
+            hostname__in = hostnames,
+            )])
+
+    for hostname in hostnames - set(instances.keys()):
+        instances[hostname], _ = \
+                sombrero_models.Instance.objects.get_or_create(
+                        hostname = hostname,
+                        )
+
+    by_activity = {}
+    healthy = {}
+
+    for delivery in deliveries:
+
+        instance = instances[delivery.hostname]
+
+        if not instance.is_available:
+            logger.debug('%s: not available; postponing %s',
+                    delivery.hostname, delivery)
+            delivery.postpone(instance.available_from)
+            continue
+
+        by_activity.setdefault(delivery.activity_id, []).append(delivery)
+
+    for activity_id, ready in by_activity.items():
+
+        activity = ready[0].activity
+
+        activity_signer = _signer_for_localperson(
+                localperson = activity.sender,
+                )
+
+        # The body and its digest are worked out once,
+        # here, and shared by every recipient.
+
+        responses = DeliveryEngine().deliver(
+                inboxes = [x.inbox for x in ready],
+                body = activity.wire_body,
+                prepare = lambda inbox: _remote_headers(
+                    recipient = inbox,
+                    signer = activity_signer,
+                    digest = activity.digest,
+                    ),
+                per_host = dict([(hostname, instance.max_in_flight)
+                    for hostname, instance in instances.items()]),
+                )
+
+        outcomes = {}
+
+        for delivery in ready:
+
+            response = responses.get(delivery.inbox, None)
+
+            _check_response(
+                    message = activity,
+                    recipient = delivery.inbox,
+                    response = response,
+                    signer = activity_signer,
+                    )
+
+            if response is None:
+                status = 0
+                seconds = None
+            else:
+                status = response.status_code
+                seconds = response.elapsed.total_seconds()
+
+            retry_after = _retry_after(response)
+
+            delivery.record(
+                    status = status,
+                    retry_after = retry_after,
+                    )
+
+            if status not in [429, 503]:
+                retry_after = None
+
+            outcomes.setdefault(delivery.hostname, []).append(
+                    (status, seconds, retry_after))
+
+            healthy[delivery.hostname] = \
+                    healthy.get(delivery.hostname, False) or \
+                    not delivery.host_is_failing
+
+        for hostname, results in outcomes.items():
+
+            waits = [x[2] for x in results if x[2] is not None]
+
+            instances[hostname].throttle(
+                    outcomes = [x[:2] for x in results],
+                    retry_after = max(waits) if waits else None,
+                    )
+
+    # A round of posts to a host counts as one failure at most,
+    # however many posts were in it. Otherwise one blip during
+    # a big fan-out would open the circuit breaker for a day.
+    for hostname, is_healthy in healthy.items():
+        if is_healthy:
+            instances[hostname].succeeded()
+        else:
+            instances[hostname].failed()
+
+LANE_QUEUE = 'delivery-%(priority)s-%(lane)d'
+DISPATCH_QUEUE = 'dispatch-%(priority)s'
+
+def lane_queue(priority, lane):
+    """
+    Returns the name of the Celery queue for a delivery lane
+    of the given priority, such as "delivery-bulk-3".
+
+    Each of these queues should be consumed by exactly one
+    worker process, with a concurrency of one:
+
+        celery -A kepi worker -Q delivery-bulk-3 --concurrency=1
+
+    That way, two workers don't compete for the same lane.
+    If they do, the row locks taken by deliver_lane() keep
+    deliveries to each inbox in order, but only on a database
+    which supports SELECT ... FOR UPDATE SKIP LOCKED, such as
+    PostgreSQL. SQLite doesn't.
+    The worker still posts to many inboxes at once;
+    see DeliveryEngine.
+    """
+    import kepi.sombrero_sendpub.models as sombrero_models
+
+    return LANE_QUEUE % {
+            'priority': sombrero_models.PRIORITY_NAMES[priority],
+            'lane': lane,
+            }
+
+def dispatch_queue(priority):
+    """
+    Returns the name of the Celery queue for dispatching
+    activities of the given priority, such as "dispatch-interactive".
+
+    Planning a big fan-out can take a while, so give the
+    interactive queue its own workers:
+
+        celery -A kepi worker -Q dispatch-interactive --concurrency=4
+    """
+    import kepi.sombrero_sendpub.models as sombrero_models
+
+    return DISPATCH_QUEUE % {
+            'priority': sombrero_models.PRIORITY_NAMES[priority],
+            }
+
+def _queue_lane(priority, lane):
+    logger.debug('waking delivery lane %s %d', priority, lane)
+
+    deliver_lane.apply_async(
+            args = [lane, priority],
+            queue = lane_queue(priority, lane),
+            )
+
+def _queue_dispatch(message):
+
+    countdown = None
+    if message.not_before is not None:
+        countdown = max((message.not_before -
+            django.utils.timezone.now()).total_seconds(), 0)
+
+    dispatch.apply_async(
+            args = [message.pk],
+            queue = dispatch_queue(message.priority),
+            countdown = countdown,
+            )
+
+# Activities which change or take back something we sent
+# earlier. These wait for everything sent earlier to the same
+# inbox, whatever its priority; see _next_in_lane().
+FOLLOW_UP_TYPES = ['Undo', 'Delete', 'Update']
+
+def priority_of(activity):
+    """
+    Returns the priority an activity should be delivered with.
+
+    Follows and their answers, and anything which isn't public
+    (such as a direct message) or is a reply, are interactive.
+    Everything else is bulk.
+
+    Follow-ups such as Undo keep their place behind what they're
+    following up, whatever its priority; see _next_in_lane().
+    """
+
+    from kepi.bowler_pub import PUBLIC_IDS
+    import kepi.sombrero_sendpub.models as sombrero_models
+
+    if activity.get('type', None) in [
+            'Follow', 'Accept', 'Reject', 'Undo', 'Block',
+            ]:
+        return sombrero_models.INTERACTIVE
+
+    obj = activity.get('object', None)
+
+    if isinstance(obj, dict) and obj.get('inReplyTo', None):
+        return sombrero_models.INTERACTIVE
+
+    audience = []
+
+    for source in [activity, obj]:
+        if not isinstance(source, dict):
+            continue
+
+        for field in ['to', 'cc']:
+            value = source.get(field, [])
+            if isinstance(value, str):
+                value = [value]
+            audience.extend(value)
+
+    if not audience:
+        # Not addressed at all, so it goes wherever the
+        # caller says; we can't tell whether it's public.
+        return sombrero_models.BULK
+
+    if not [x for x in audience if x in PUBLIC_IDS]:
+        return sombrero_models.INTERACTIVE
+
+    return sombrero_models.BULK
+
+def _next_in_lane(priority, lane, batch_size):
+    """
+    Returns the pending Deliveries in the given lane which we can
+    attempt now.
+
+    A Delivery has to wait if an earlier activity of the same
+    priority, to the same inbox, is still pending, even if the
+    earlier one isn't due yet. Otherwise, activities of different
+    priorities don't wait for one another, so that (for example)
+    a Follow needn't wait behind a big fan-out.
+
+    But follow-ups, such as Undo and Delete, wait for every
+    earlier activity to the same inbox, whatever its priority.
+    So an Undo never overtakes the Announce it's undoing, and
+    a Delete never overtakes the Create it's deleting.
+
+    The Deliveries we return are locked until the current
+    transaction ends, and Deliveries another worker has locked
+    are skipped. Their activities are still pending, though,
+    so anything waiting behind them keeps waiting.
+    """
+
+    from django.db.models import Exists, OuterRef, Q
+    import kepi.sombrero_sendpub.models as sombrero_models
+
+    Delivery = sombrero_models.Delivery
+
+    earlier = Delivery.objects.filter(
+            state = Delivery.PENDING,
+            inbox = OuterRef('inbox'),
+            activity_id__lt = OuterRef('activity_id'),
+            )
+
+    return list(Delivery.objects.filter(
+            priority = priority,
+            lane = lane,
+            state = Delivery.PENDING,
+            next_attempt__lte = django.utils.timezone.now(),
+            ).exclude(
+                    Exists(earlier.filter(
+                        priority = priority,
+                        )),
+                    ).exclude(
+                            Q(activity__follows_up = True) &
+                            Exists(earlier),
+                            ).select_related(
+                                    'activity',
+                                    'activity__sender',
+                                    ).select_for_update(
+                                            skip_locked = True,
+                                            of = ('self',),
+                                            ).order_by(
+                                                    'activity_id',
+                                                    )[:batch_size])
 
 @shared_task()
+def deliver_lane(
+        lane,
+        priority,
+        batch_size = 500,
+        ):
+
+    """
+    Attempts every Delivery in a lane which is due,
+    keeping the order of activities to each inbox.
+
+    Keyword arguments:
+        lane -- the number of the lane
+        priority -- the priority of the lane: "I" for interactive
+            or "B" for bulk
+        batch_size -- how many Deliveries to attempt at once
+
+    This function is a shared task. It should run on the
+    lane's own queue; see lane_queue(). Each batch is attempted
+    in its own transaction, holding locks on its Deliveries, so
+    if two workers do end up running the same lane, they won't
+    attempt the same Delivery, or overtake one another.
+    """
+
+    attempted = set()
+
+    while True:
+        with transaction.atomic():
+            ready = [x for x in _next_in_lane(priority, lane, batch_size)
+                    if x.pk not in attempted]
+
+            if not ready:
+                break
+
+            logger.debug('lane %s %d: attempting %s',
+                    priority, lane, ready)
+
+            attempted.update([x.pk for x in ready])
+            _attempt_deliveries(ready)
+
+    if attempted:
+        _wake_follow_ups(priority, lane)
+
+def _wake_follow_ups(priority, lane):
+    """
+    Wakes up the lanes of other priorities with the same number,
+    if they have follow-ups due. They may have been waiting
+    for something we've just sent; see _next_in_lane().
+    """
+
+    import kepi.sombrero_sendpub.models as sombrero_models
+
+    for other in sombrero_models.PRIORITY_NAMES.keys():
+        if other==priority:
+            continue
+
+        if sombrero_models.Delivery.objects.filter(
+                priority = other,
+                lane = lane,
+                state = sombrero_models.Delivery.PENDING,
+                next_attempt__lte = django.utils.timezone.now(),
+                activity__follows_up = True,
+                ).exists():
+            _queue_lane(other, lane)
+
+def lane_depths():
+    """
+    Returns a dict mapping each delivery lane, as a tuple
+    (priority, lane), to the number of Deliveries pending in it.
+    Lanes with nothing pending aren't included.
+
+    This is for keeping an eye on things, from the shell or
+    a monitoring script.
+    """
+
+    from django.db.models import Count
+    import kepi.sombrero_sendpub.models as sombrero_models
+
+    return dict([((priority, lane), count)
+        for priority, lane, count in
+        sombrero_models.Delivery.objects.filter(
+            state = sombrero_models.Delivery.PENDING,
+            ).values_list(
+                    'priority', 'lane',
+                    ).annotate(
+                            Count('pk'),
+                            ).order_by(
+                                    'priority', 'lane',
+                                    )])
+
+@shared_task()
+def retry_deliveries():
+
+    """
+    Wakes up every delivery lane which has Deliveries due.
+
+    This function is a shared task; Celery runs it periodically.
+    See CELERY_BEAT_SCHEDULE in settings.py.
+    """
+
+    import kepi.sombrero_sendpub.models as sombrero_models
+
+    lanes = sombrero_models.Delivery.objects.filter(
+            state = sombrero_models.Delivery.PENDING,
+            next_attempt__lte = django.utils.timezone.now(),
+            ).values_list(
+                    'priority', 'lane',
+                    ).order_by(
+                            'priority', 'lane',
+                            ).distinct()
+
+    for priority, lane in lanes:
+        _queue_lane(priority, lane)
+
+def _as_pks(people):
+    """
+    Returns a list of the primary keys of "people",
+    which is a list or QuerySet of Persons.
+    """
+
+    from django.db.models import QuerySet
+
+    if isinstance(people, QuerySet):
+        return list(people.values_list('pk', flat=True))
+
+    return [x.pk for x in people]
+
 def deliver(
         activity,
         sender,
         target_people = [],
         target_followers_of = [],
+        to_every_instance = False,
+        priority = None,
+        coalesce = None,
+        delay = None,
         ):
 
     """
@@ -260,51 +899,234 @@ def deliver(
     Keyword arguments:
         activity -- a dict representing an ActivityPub activity
         sender -- a Person who's doing the sending
-        target_people -- list of Person objects who should receive it
-        target_followers_of -- list of Person objects whose followers
+        target_people -- list or QuerySet of Persons who
+            should receive it
+        target_followers_of -- list of Persons whose followers
             should receive it.
-
-    This function is a shared task; it will be run by Celery behind
-    the scenes.
+        to_every_instance -- if True, it should also go to every
+            remote instance we know about. This is for things like
+            deleting an account.
+        priority -- "I" for interactive or "B" for bulk.
+            If this is None, we decide using priority_of().
+        coalesce -- a string, or None. If an activity with the same
+            "coalesce" string is still waiting in the outbox, we
+            replace it with this one, rather than sending both.
+        delay -- a timedelta: how long to wait before sending,
+            or None to send as soon as possible. With "coalesce",
+            each new activity puts the wait back, but never
+            to more than COALESCE_MAX after the first.
+
+    This doesn't send anything itself. It writes the activity
+    to the outbox, as part of the current transaction, and
+    once that transaction is committed, it queues dispatch()
+    to do the rest. So it's cheap enough to call while we're
+    handling a request, however many recipients there are.
+
+    Returns the OutgoingActivity.
     """
 
     import kepi.sombrero_sendpub.models as sombrero_models
 
-    message = sombrero_models.OutgoingActivity(
-            content=json.dumps(activity,
-                indent=2,
-                ),
-            )
+    if sender is not None and not sender.is_local:
+        sender = None
+
+    if priority is None:
+        priority = priority_of(activity)
+
+    fields = {
+            'content': json.dumps(activity),
+            'sender': sender,
+            'target_people': json.dumps(_as_pks(target_people)),
+            'target_followers_of': json.dumps(
+                _as_pks(target_followers_of)),
+            'to_every_instance': to_every_instance,
+            'priority': priority,
+            'follows_up': activity.get('type', None) in FOLLOW_UP_TYPES,
+            'coalesce_key': coalesce or '',
+            }
+
+    now = django.utils.timezone.now()
+
+    if delay is not None:
+        fields['not_before'] = now + delay
+
+    if coalesce:
+        waiting = sombrero_models.OutgoingActivity.objects.filter(
+                coalesce_key = coalesce,
+                dispatched_at = None,
+                ).order_by('created_at').first()
+
+        if waiting is not None:
+            if 'not_before' in fields:
+                fields['not_before'] = min(fields['not_before'],
+                        waiting.created_at + COALESCE_MAX)
+
+            # This only works if the waiting activity hasn't
+            # been dispatched in the meantime.
+            merged = sombrero_models.OutgoingActivity.objects.filter(
+                    pk = waiting.pk,
+                    dispatched_at = None,
+                    ).update(
+                            **fields,
+                            )
+
+            if merged:
+                logger.debug('outgoing %s: replaced by a newer %s',
+                        waiting.pk, coalesce)
+                waiting.refresh_from_db()
+                transaction.on_commit(
+                        lambda: _queue_dispatch(waiting),
+                        )
+                return waiting
+
+    message = sombrero_models.OutgoingActivity(**fields)
     message.save()
 
-    log_one_message(
-            direction = "outgoing: "+str(message.pk),
-            body = activity,
-            )
+    logger.debug('outgoing %s: in the outbox, priority %s',
+            message.pk, priority)
 
-    signer = None
-    postie = _Postie(
-            message = message,
-            sender = sender,
+    transaction.on_commit(
+            lambda: _queue_dispatch(message),
             )
 
-    for target in target_people:
+    return message
+
+@shared_task()
+def dispatch(
+        activity_id,
+        ):
 
-        logger.debug("outgoing %s: person %s has inbox %s",
-                message.pk, target, target.inbox_url)
+    """
+    Works out who should receive an activity in the outbox,
+    and sends it to them.
 
-        postie.send_to(target.inbox_url)
+    Keyword arguments:
+        activity_id -- the primary key of the OutgoingActivity
 
-    for following in target_followers_of:
+    This function is a shared task; it will be run by Celery behind
+    the scenes. It's queued by deliver(), and by dispatch_outbox().
+    It does nothing if the activity has already been dispatched,
+    or if its not_before time hasn't come yet.
+    """
+
+    from django.db.models import Q
+    import kepi.sombrero_sendpub.models as sombrero_models
+    import kepi.trilby_api.models as trilby_models
+
+    now = django.utils.timezone.now()
+
+    # We only mark the activity as dispatched once its Deliveries
+    # are recorded. If anything goes wrong before then, none of it
+    # happened, and dispatch_outbox() will try again.
+    with transaction.atomic():
+
+        message = sombrero_models.OutgoingActivity.objects.select_for_update(
+                skip_locked = True,
+                ).filter(
+                        Q(not_before = None) | Q(not_before__lte = now),
+                        pk = activity_id,
+                        dispatched_at = None,
+                        ).first()
+
+        if message is None:
+            logger.debug('outgoing %s: already dispatched, not due, '+\
+                    'or being dispatched by someone else',
+                    activity_id)
+            return
+
+        log_one_message(
+                direction = "outgoing: "+str(message.pk),
+                body = message.content,
+                )
+
+        postie = _Postie(
+                message = message,
+                sender = message.sender,
+                )
+
+        has_local, hosts = _plan_delivery(
+                target_people = trilby_models.Person.objects.filter(
+                    pk__in = json.loads(message.target_people),
+                    ),
+                target_followers_of = trilby_models.Person.objects.filter(
+                    pk__in = json.loads(message.target_followers_of),
+                    ),
+                to_every_instance = message.to_every_instance,
+                )
+
+        if has_local:
+            postie.send_to_local()
+
+        for hostname, inboxes in sorted(hosts.items()):
+
+            logger.debug("outgoing %s: host %s gets %s",
+                    message.pk, hostname, inboxes)
 
-        logger.debug("outgoing %s: sending to person %s's followers...",
-                message.pk, following)
+            for inbox in sorted(inboxes):
+                postie.send_to(inbox)
 
-        for follower in following.followers:
-            logger.debug("outgoing %s:   -- to %s",
-                    message.pk, follower)
+        postie.flush()
 
-            postie.send_to(follower.inbox_url)
+        message.dispatched_at = now
+        message.save(
+                update_fields = ['dispatched_at'],
+                )
 
-    logger.debug('outgoing %s: message posted to all inboxes',
+    logger.debug('outgoing %s: message posted to all remote inboxes',
         message.pk)
+
+    # The remote Deliveries are committed now, so a problem
+    # here can't stop them going out.
+    try:
+        postie.deliver_local()
+    except Exception as problem:
+        import traceback
+
+        logger.warning('outgoing %s: local delivery failed: %s %s',
+                message.pk, problem,
+                ''.join(traceback.format_exception(
+                    None, problem, problem.__traceback__)),
+                )
+
+# How long an activity can sit in the outbox before
+# dispatch_outbox() decides its dispatch() task got lost.
+OUTBOX_GRACE = datetime.timedelta(minutes=5)
+
+# The longest that coalescing can put off an activity for.
+COALESCE_MAX = datetime.timedelta(minutes=10)
+
+@shared_task()
+def dispatch_outbox(
+        batch_size = 500,
+        ):
+
+    """
+    Dispatches any activities which have been in the outbox
+    for a while without being dispatched; for example, because
+    the process stopped between committing and queueing.
+    Activities which were delayed are dispatched once they're due.
+
+    This function is a shared task; Celery runs it periodically.
+    See CELERY_BEAT_SCHEDULE in settings.py.
+    """
+
+    import kepi.sombrero_sendpub.models as sombrero_models
+
+    from django.db.models import Q
+
+    now = django.utils.timezone.now()
+
+    stranded = sombrero_models.OutgoingActivity.objects.filter(
+            Q(not_before = None, created_at__lte = now-OUTBOX_GRACE) |
+            Q(not_before__lte = now),
+            dispatched_at = None,
+            ).order_by(
+                    'created_at',
+                    ).only(
+                            'pk', 'priority',
+                            )[:batch_size]
+
+    for message in stranded:
+        logger.info('outgoing %s: picked up from the outbox',
+                message.pk)
+        _queue_dispatch(message)
@@ -0,0 +1,227 @@
+# engine.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+This contains DeliveryEngine, which posts outgoing activities
+to many remote inboxes in parallel.
+
+The engine runs an asyncio event loop. The HTTP requests
+themselves are made by "requests", in a pool of threads;
+each remote host gets its own requests.Session, so connections
+are kept alive and reused between posts to the same host, and
+between calls to deliver().
+
+The number of requests in flight is limited, both overall
+and for each remote host, so that one big fan-out doesn't
+swamp either us or any one remote server. The caller can give
+a different limit for each host; see Instance.throttle().
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+import asyncio
+import threading
+import requests
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from django.conf import settings
+
+DEFAULT_MAX_CONNECTIONS = 64
+DEFAULT_MAX_PER_HOST = 4
+DEFAULT_TIMEOUT = 30
+DEFAULT_PER_HOST_CEILING = 32
+DEFAULT_MAX_SESSIONS = 256
+
+_sessions = OrderedDict()
+_sessions_lock = threading.Lock()
+
+def _session_for(hostname, pool_size):
+    """
+    Returns the requests.Session we use for posting to "hostname".
+
+    Sessions are shared across the whole process, so that
+    keep-alive connections outlive any particular delivery.
+    We keep KEPI['DELIVERY_MAX_SESSIONS'] of them at most;
+    the least recently used are closed.
+    """
+
+    evicted = []
+
+    with _sessions_lock:
+        result = _sessions.get(hostname, None)
+
+        if result is None:
+            logger.debug('%s: new delivery session', hostname)
+
+            result = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                    pool_connections = 1,
+                    pool_maxsize = pool_size,
+                    )
+            result.mount('https://', adapter)
+            result.mount('http://', adapter)
+
+            _sessions[hostname] = result
+
+            max_sessions = settings.KEPI.get('DELIVERY_MAX_SESSIONS',
+                    DEFAULT_MAX_SESSIONS)
+
+            while len(_sessions) > max_sessions:
+                evicted.append(_sessions.popitem(last=False))
+        else:
+            _sessions.move_to_end(hostname)
+
+    for old_hostname, session in evicted:
+        logger.debug('%s: closing delivery session', old_hostname)
+        session.close()
+
+    return result
+
+class DeliveryEngine(object):
+
+    """
+    Posts a message to a set of inboxes, in parallel.
+
+    Keyword arguments:
+        max_connections -- the greatest number of requests we
+            can have in flight at once. Defaults to
+            KEPI['DELIVERY_MAX_CONNECTIONS'].
+        max_per_host -- the greatest number of requests we
+            can have in flight to any one remote host, unless
+            deliver() is told otherwise. Defaults to
+            KEPI['DELIVERY_MAX_PER_HOST'].
+        timeout -- how many seconds to wait for a remote host
+            before giving up. Defaults to KEPI['DELIVERY_TIMEOUT'].
+    """
+
+    def __init__(self,
+            max_connections = None,
+            max_per_host = None,
+            timeout = None,
+            ):
+
+        if max_connections is None:
+            max_connections = settings.KEPI.get(
+                    'DELIVERY_MAX_CONNECTIONS',
+                    DEFAULT_MAX_CONNECTIONS)
+
+        if max_per_host is None:
+            max_per_host = settings.KEPI.get(
+                    'DELIVERY_MAX_PER_HOST',
+                    DEFAULT_MAX_PER_HOST)
+
+        if timeout is None:
+            timeout = settings.KEPI.get(
+                    'DELIVERY_TIMEOUT',
+                    DEFAULT_TIMEOUT)
+
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+
+    def post(self, inbox, body, headers):
+        """
+        Posts "body" to "inbox", and returns the response.
+        This is blocking; it runs in one of the engine's threads.
+
+        If we can't connect, or the post fails in any other way,
+        returns None. One bad inbox mustn't stop the rest of
+        a batch from being delivered.
+        """
+
+        hostname = urlparse(inbox).netloc
+
+        session = _session_for(
+                hostname,
+                pool_size = max(self.max_per_host,
+                    settings.KEPI.get('DELIVERY_PER_HOST_CEILING',
+                        DEFAULT_PER_HOST_CEILING)),
+                )
+
+        try:
+            return session.post(
+                    inbox,
+                    data = body,
+                    headers = headers,
+                    timeout = self.timeout,
+                    )
+        except requests.exceptions.ConnectionError:
+            logger.debug('%s: cannot connect', inbox)
+            return None
+        except requests.exceptions.Timeout:
+            logger.debug('%s: timed out', inbox)
+            return None
+        except requests.exceptions.RequestException as e:
+            logger.info('%s: failed to post: %s', inbox, e)
+            return None
+
+    def deliver(self, inboxes, body, prepare, per_host=None):
+        """
+        Posts "body" to each of "inboxes".
+
+        "prepare" is a function which takes an inbox URL and
+        returns the headers to send to that inbox. (This is
+        where the request gets signed.)
+
+        "per_host", if given, is a dict mapping hostnames to the
+        greatest number of requests we can have in flight to
+        each of them. Hosts which aren't in it get max_per_host.
+
+        Blocks until every post has finished, and then
+        returns a dict mapping each inbox URL to its response,
+        or None if the post failed.
+        """
+
+        inboxes = list(inboxes)
+
+        if not inboxes:
+            return {}
+
+        return asyncio.run(self._deliver(
+            inboxes = inboxes,
+            body = body,
+            prepare = prepare,
+            per_host = per_host or {},
+            ))
+
+    async def _deliver(self, inboxes, body, prepare, per_host):
+
+        loop = asyncio.get_running_loop()
+        overall = asyncio.Semaphore(self.max_connections)
+        host_limits = {}
+
+        async def deliver_one(inbox):
+
+            hostname = urlparse(inbox).netloc
+
+            if hostname not in host_limits:
+                host_limits[hostname] = asyncio.Semaphore(
+                        per_host.get(hostname, self.max_per_host))
+
+            # Wait for the host first, so that posts queued for
+            # a slow host don't hold up everyone else's.
+            async with host_limits[hostname], overall:
+                headers = prepare(inbox)
+
+                response = await loop.run_in_executor(
+                        executor,
+                        self.post,
+                        inbox, body, headers,
+                        )
+
+            return inbox, response
+
+        with ThreadPoolExecutor(
+                max_workers = min(len(inboxes), self.max_connections),
+                ) as executor:
+
+            results = await asyncio.gather(*[
+                deliver_one(inbox) for inbox in inboxes
+                ])
+
+        return dict(results)
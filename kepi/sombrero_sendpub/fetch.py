@@ -9,19 +9,54 @@ logger = logging.getLogger(name="kepi")
 
 import requests
 import django.db.utils
+import django.utils.timezone
+from django.db import transaction
+from celery import shared_task
 from urllib.parse import urlparse
 from django.http.request import HttpRequest
 from django.conf import settings
 from kepi.trilby_api.models import *
-from kepi.bowler_pub.utils import log_one_message
+from kepi.bowler_pub.utils import log_one_message, \
+        match_configured_path, uri_to_url
 from kepi.bowler_pub.activityresponse import ActivityResponse
 from kepi.sombrero_sendpub.webfinger import get_webfinger
+import kepi.sombrero_sendpub.outbound as outbound
 import kepi.sombrero_sendpub.models as sombrero_models
+from kepi.sombrero_sendpub.cache import fetch_cache
+from kepi.sombrero_sendpub.resolution import current as current_resolution
 import kepi.bowler_pub.create as bowler_create
 from django.http import HttpResponse, JsonResponse, Http404
+from kepi.sombrero_sendpub.flight import SingleFlight
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import socket
+import time
+import os
+
+# How often we check whether another worker has finished
+# fetching something, and how long we wait for them, in seconds.
+# If LEASE_WAIT is None, we wait as long as their lease lasts.
+LEASE_POLL = 0.1
+LEASE_WAIT = None
+
+# How many remote objects fetch_many() fetches at once,
+# unless settings.py says otherwise.
+DEFAULT_FETCH_MANY_WORKERS = 8
+
+# How many pages prefetch() fetches at once, across the process.
+PREFETCH_WORKERS = 4
+
+# Fetches which are in progress in this process.
+_flights = SingleFlight()
+
+_prefetcher = ThreadPoolExecutor(
+        max_workers = PREFETCH_WORKERS,
+        thread_name_prefix = 'kepi-prefetch',
+        )
 
 def fetch(address,
         expected_type,
+        prefetched = None,
         ):
 
     """
@@ -44,6 +79,10 @@ def fetch(address,
 
     "expected_type" is the type we're looking for.
 
+    "prefetched" is a Future returned by prefetch() for the same
+    address. If we need to go online, we use what it found,
+    rather than asking again. If we don't, it's cancelled.
+
     "expected_type" should contain at least the fields
       - remote_url (read/write)
       - local_form and remote_form, which may be identity functions
@@ -53,6 +92,13 @@ def fetch(address,
     using the "type" field in the retrieved object,
     rather than the "expected_type" passed to this function.
 
+    Results for remote objects, including misses, are cached;
+    see kepi.sombrero_sendpub.cache. If several threads or workers
+    ask for the same remote object at once, only one of them
+    fetches it, and the others wait for the result. Inside
+    resolving(), each address is only looked up once at all;
+    see kepi.sombrero_sendpub.resolution.
+
     This function returns the requested object if it can.
     If you didn't specify a type, raises ValueError.
     On all other errors, which are logged, returns None.
@@ -65,16 +111,232 @@ def fetch(address,
 
     wanted['type'] = expected_type
 
-    if wanted['is_local']:
-        handler = _fetch_local
-    else:
-        handler = _fetch_remote
-
     if wanted['type'] is None:
         raise ValueError(
                 "fetch() requires some sort of type to be specified")
 
-    return handler(address, wanted)
+    try:
+        resolution = current_resolution()
+
+        if resolution is not None:
+            found, result = resolution.get(address, expected_type)
+
+            if found:
+                logger.debug("%s: already resolved for this message: %s",
+                        address, result)
+                return result
+
+        if wanted['is_local']:
+            result = _fetch_local(address, wanted)
+        else:
+            result = _fetch_shared(address, wanted, prefetched)
+
+        if resolution is not None:
+            resolution.put(address, expected_type, result)
+
+        return result
+
+    finally:
+        # If we found the answer without going online, nobody
+        # needs the prefetched response; don't let it run.
+        if prefetched is not None:
+            prefetched.cancel()
+
+def _fetch_shared(address, wanted, prefetched=None):
+    """
+    Finds the remote object at "address", using the cache if we can.
+    If another thread is already looking for it, waits for them.
+    """
+
+    found, result = fetch_cache.get(address, wanted['type'])
+
+    if found:
+        logger.debug("%s: found in cache: %s",
+                address, result)
+        return result
+
+    def fetch_once():
+        result = _fetch_remote(address, wanted, prefetched)
+        fetch_cache.put(address, wanted['type'], result)
+        return result
+
+    return _flights.do(
+            (address, wanted['type']),
+            fetch_once,
+            )
+
+def prefetch(address,
+        expected_type,
+        ):
+
+    """
+    Starts GETting "address" in the background, and returns
+    a Future for the response, which you can pass to fetch()
+    later as "prefetched".
+
+    Returns None if there's no point, because "address" is local
+    or atstyle, or because we have it in the cache already.
+
+    Only the network request happens in the background; nothing
+    is stored until you call fetch().
+    """
+
+    if address is None:
+        return None
+
+    wanted = _parse_address(address)
+
+    if wanted['is_local'] or wanted['is_atstyle']:
+        return None
+
+    found, result = fetch_cache.get(address, expected_type)
+
+    if found:
+        return None
+
+    logger.debug("%s: prefetching", address)
+
+    return _prefetcher.submit(_get_online, address)
+
+def fetch_many(addresses,
+        expected_type,
+        ):
+
+    """
+    Like fetch(), but for many addresses at once.
+
+    Returns a dict mapping each of "addresses" to what fetch()
+    would have returned for it.
+
+    Anything we already know about is found with one query.
+    The rest are fetched in parallel by up to
+    KEPI['FETCH_MANY_WORKERS'] threads. Only the network requests
+    happen in those threads; everything is stored from this one.
+    """
+
+    if expected_type is None:
+        raise ValueError(
+                "fetch_many() requires some sort of type to be specified")
+
+    result = {}
+    remote = {}
+    resolution = current_resolution()
+
+    for address in addresses:
+
+        if address is None or address in result or address in remote:
+            continue
+
+        if resolution is not None:
+            found, resolved = resolution.get(address, expected_type)
+
+            if found:
+                result[address] = resolved
+                continue
+
+        wanted = _parse_address(address)
+        wanted['type'] = expected_type
+
+        if wanted['is_local']:
+            result[address] = _fetch_local(address, wanted)
+            continue
+
+        found, cached = fetch_cache.get(address, expected_type)
+
+        if found:
+            result[address] = cached
+        else:
+            remote[address] = wanted
+
+    logger.debug("fetch_many: %d addresses; %d not in cache",
+            len(result)+len(remote), len(remote))
+
+    if remote:
+        _fetch_many_remote(remote, expected_type, result)
+
+    if resolution is not None:
+        for address, value in result.items():
+            resolution.put(address, expected_type, value)
+
+    return result
+
+def _fetch_many_remote(remote, expected_type, result):
+
+    def found(address, value):
+        result[address] = value
+        fetch_cache.put(address, expected_type, value)
+        del remote[address]
+
+    urls = [address for address, wanted in remote.items()
+            if not wanted['is_atstyle']]
+
+    # Anything which failed lately, or which we already know about?
+
+    failures = dict([(failure.url, failure) for failure in
+        sombrero_models.Failure.objects.filter(url__in = urls)])
+
+    for url, failure in failures.items():
+        if failure.is_current:
+            logger.debug("%s: %s; not trying again until %s",
+                    url, failure, failure.retry_after)
+            found(url, None)
+
+    try:
+        known = expected_type.remote_form().objects.filter(
+                remote_url__in = [x for x in urls if x in remote],
+                )
+
+        for thing in known:
+            if isinstance(thing, expected_type):
+                logger.debug("%s: already known: %s",
+                        thing.remote_url, thing)
+                found(thing.remote_url, thing)
+
+    except AttributeError:
+        # Types don't have to support object lookup
+        pass
+
+    # Go and look for the rest, unless another worker
+    # is looking already.
+
+    holder = _lease_holder()
+    mine = []
+
+    for address, wanted in remote.items():
+        if wanted['is_atstyle']:
+            continue
+
+        if sombrero_models.FetchLease.acquire(address, holder):
+            mine.append(address)
+
+    try:
+        if mine:
+            with ThreadPoolExecutor(
+                    max_workers = min(len(mine),
+                        settings.KEPI.get('FETCH_MANY_WORKERS',
+                            DEFAULT_FETCH_MANY_WORKERS)),
+                    ) as pool:
+
+                responses = list(pool.map(_get_online, mine))
+
+            for address, response in zip(mine, responses):
+                found(address,
+                        _use_response(address,
+                            remote[address],
+                            failures.get(address, None),
+                            response,
+                            ))
+
+    finally:
+        for address in mine:
+            sombrero_models.FetchLease.release(address, holder)
+
+    # Whatever's left is either atstyle, which needs webfinger,
+    # or being fetched by someone else. fetch() can deal with those.
+
+    for address in list(remote.keys()):
+        result[address] = fetch(address, expected_type)
+        del remote[address]
 
 def _parse_address(address):
 
@@ -118,9 +380,66 @@ def _fetch_local_by_atstyle(address, wanted):
 
     return result
 
+def _fetch_local_directly(address, wanted):
+    """
+    Looks up local people and statuses by their URLs, without
+    going through the views. Returns a tuple (handled, result);
+    if "handled" is False, "address" isn't one of those,
+    and you should ask the views instead.
+    """
+
+    path = wanted['path']
+
+    found = match_configured_path('USER_LINK', path)
+
+    if found is not None:
+        result = LocalPerson.objects.filter(
+                local_user__username = found['username'],
+                ).select_related('local_user').first()
+
+        logger.debug("%s: local user: %s",
+                address, result)
+
+        return True, result
+
+    found = match_configured_path('STATUS_LINK', path)
+
+    if found is not None and found['id'].isdigit():
+        result = Status.objects.filter(
+                url_denormed = uri_to_url(path),
+                ).first()
+
+        logger.debug("%s: local status: %s",
+                address, result)
+
+        if result is not None and result.reblog_of_id is not None:
+            # Reblogs are found as the status they reblogged,
+            # as the view does.
+            result = result.original
+
+            if result.account.username != found['username']:
+                logger.info('%s: status was by %s; discarding',
+                        address, result.account.username)
+                result = None
+
+        return True, result
+
+    return False, None
+
 def _fetch_local_by_url(address, wanted):
     from django.urls import resolve
 
+    handled, result = _fetch_local_directly(address, wanted)
+
+    if handled:
+        if result is not None and not isinstance(result, wanted['type']):
+            logger.info("%s: type mismatch (%s vs %s); discarding",
+                    address, type(result), wanted['type'],
+                    )
+            return None
+
+        return result
+
     class ActivityRequest(HttpRequest):
         """
         These are fake HttpRequests which we send to the views
@@ -177,9 +496,36 @@ def _fetch_local(address, wanted):
     else:
         return _fetch_local_by_url(address, wanted)
 
-def _fetch_remote(address, wanted):
+def _note_instance(address, status):
+    """
+    Records in the registry how the host of "address" responded.
 
-    # Do we already know about them?
+    "status" is the HTTP status, or 0 if we couldn't connect.
+    Errors from the server itself count against it; other errors,
+    like 404, only tell us about the thing we asked for.
+    """
+
+    instance = sombrero_models.Instance.for_hostname(
+            urlparse(address).netloc,
+            )
+
+    if status==0 or status>=500:
+        instance.failed()
+    else:
+        instance.succeeded()
+
+def _lease_holder():
+    return '%s:%d:%d' % (
+            socket.gethostname(),
+            os.getpid(),
+            threading.get_ident(),
+            )
+
+def _already_known(address, wanted):
+    """
+    Returns what we already have stored for "address",
+    or None if we don't have anything.
+    """
 
     if wanted['is_atstyle']:
         # XXX Not certain about this (or indeed the benefit
@@ -189,18 +535,6 @@ def _fetch_remote(address, wanted):
     else:
         kwargs = {"remote_url": address}
 
-        try:
-            failure = sombrero_models.Failure.objects.get(
-                    url = address,
-                    )
-            logger.debug("%s: %s",
-                    address, failure)
-
-            return None
-        except sombrero_models.Failure.DoesNotExist:
-            # all good then
-            pass
-
     try:
         result = wanted['type'].remote_form().objects.get(
                 **kwargs,
@@ -218,10 +552,99 @@ def _fetch_remote(address, wanted):
     except wanted['type'].DoesNotExist:
         pass
 
-    # No, so create them (but don't save yet).
+    return None
+
+def _known_failure(address):
+    """
+    Returns the Failure we recorded for "address", or None.
+    """
+
+    try:
+        return sombrero_models.Failure.objects.get(
+                url = address,
+                )
+    except sombrero_models.Failure.DoesNotExist:
+        return None
+
+def _fetch_remote(address, wanted, prefetched=None):
+
+    # Do we already know about them?
+
+    failure = None
+
+    if not wanted['is_atstyle']:
+
+        failure = _known_failure(address)
+
+        if failure is not None:
+            if failure.is_current:
+                logger.debug("%s: %s; not trying again until %s",
+                        address, failure, failure.retry_after)
+
+                return None
+
+            logger.debug("%s: %s, but that was a while ago",
+                    address, failure)
+
+    result = _already_known(address, wanted)
+
+    if result is not None:
+        return result
+
+    # No, so we'll have to go and look. While we do, we hold a
+    # FetchLease on the address, so that other workers don't
+    # go and look at the same time.
+
+    holder = _lease_holder()
+
+    if not sombrero_models.FetchLease.acquire(address, holder):
+        logger.debug("%s: another worker is fetching this; waiting",
+                address)
+
+        if LEASE_WAIT is None:
+            wait = sombrero_models.lease_duration().total_seconds()
+        else:
+            wait = LEASE_WAIT
+
+        waited = 0
+        while sombrero_models.FetchLease.is_held(address):
+            if waited >= wait:
+                logger.info("%s: gave up waiting for another worker",
+                        address)
+                break
+
+            time.sleep(LEASE_POLL)
+            waited += LEASE_POLL
+
+        holder = None
+
+        # If they found it was failing, we'd only fail too.
+        if not wanted['is_atstyle']:
+
+            failure = _known_failure(address)
+
+            if failure is not None and failure.is_current:
+                logger.debug("%s: the other worker found %s",
+                        address, failure)
+
+                return None
+
+        # They've probably stored it by now.
+        result = _already_known(address, wanted)
 
-    logger.debug("%s: wanted %s; kwargs=%s",
-            address, wanted, kwargs)
+        if result is not None:
+            return result
+
+    try:
+        return _fetch_online(address, wanted, failure, prefetched)
+    finally:
+        if holder is not None:
+            sombrero_models.FetchLease.release(address, holder)
+
+def _fetch_online(address, wanted, failure, prefetched=None):
+
+    logger.debug("%s: wanted %s",
+            address, wanted)
 
     if wanted['is_atstyle']:
 
@@ -241,39 +664,83 @@ def _fetch_remote(address, wanted):
 
     # okay, time to go looking online
 
+    if prefetched is not None:
+        response = prefetched.result()
+    else:
+        response = _get_online(address)
+
+    return _use_response(address, wanted, failure, response)
+
+def _get_online(address):
+    """
+    GETs "address", and returns the response, or the exception
+    if that didn't work.
+
+    This doesn't touch the database, so it's safe to call
+    from other threads; see fetch_many() and prefetch().
+    """
+
     try:
-        response = requests.get(
+        return outbound.get(
                 address,
                 headers = {
                     'Accept': 'application/activity+json',
                     },
                 )
-    except requests.ConnectionError:
+    except requests.RequestException as re:
+        return re
+
+def _use_response(address, wanted, failure, response):
+    """
+    Deals with what _get_online() returned for "address",
+    storing it if it's new. Returns the object we wanted,
+    or None.
+    """
+
+    if isinstance(response, outbound.ResponseTooLarge):
+
+        logger.info("%s: %s",
+            address, response)
+
+        sombrero_models.Failure.record(
+                url = address,
+                status = 0,
+                )
+
+        return None
+
+    elif isinstance(response, requests.ConnectionError):
 
         logger.info("%s: can't reach host",
             address)
 
-        sombrero_models.Failure(
+        _note_instance(address, 0)
+
+        sombrero_models.Failure.record(
                 url = address,
                 status = 0,
-                ).save()
+                )
 
         return None
 
-    except requests.exceptions.Timeout:
+    elif isinstance(response, requests.RequestException):
 
-        logger.info("%s: timeout reaching host",
-            address)
+        logger.info("%s: error reaching host: %s",
+            address, response)
+
+        _note_instance(address, 0)
 
-        sombrero_models.Failure(
+        sombrero_models.Failure.record(
                 url = address,
                 status = 0,
-                ).save()
+                )
 
         return None
 
     # so, we have *something*...
 
+    _note_instance(address, response.status_code)
+
     if response.status_code!=200:
         # HTTP error; bail immediately
 
@@ -281,13 +748,17 @@ def _fetch_remote(address, wanted):
                 address, response.status_code,
                 )
 
-        sombrero_models.Failure(
+        sombrero_models.Failure.record(
                 url = address,
                 status = response.status_code,
-                ).save()
+                )
 
         return None
 
+    if failure is not None:
+        # They're back!
+        failure.delete()
+
     try:
         found = response.json()
     except ValueError as ve:
@@ -317,10 +788,25 @@ def _fetch_remote(address, wanted):
                     )
             return None
 
-    result = bowler_create.deserialise(
-            found,
-            address,
-            )
+    try:
+        with transaction.atomic():
+            result = bowler_create.deserialise(
+                    found,
+                    address,
+                    )
+
+    except django.db.utils.IntegrityError as ie:
+        # Someone else stored it while we were fetching it;
+        # theirs will do.
+        logger.info("%s: stored elsewhere meanwhile (%s); using that",
+                address, ie)
+
+        try:
+            result = wanted['type'].remote_form().objects.get(
+                    remote_url = address,
+                    )
+        except (AttributeError, wanted['type'].DoesNotExist):
+            return None
 
     if result is None:
         logger.info("%s:    -- can't deserialise; returning None",
@@ -336,4 +822,47 @@ def _fetch_remote(address, wanted):
 
         return None
 
+    if isinstance(result, RemotePerson):
+        note_validators(result, response.headers)
+
     return result
+
+def note_validators(person, headers):
+    """
+    Records that we've just fetched the RemotePerson "person",
+    along with the ETag and Last-Modified fields from "headers",
+    which will let us ask later whether they've changed;
+    see kepi.sombrero_sendpub.refresh.
+    """
+
+    person.found_at = django.utils.timezone.now()
+    person.etag = headers.get('ETag', '')[:255]
+    person.last_modified = headers.get('Last-Modified', '')[:255]
+
+    RemotePerson.objects.filter(
+            pk = person.pk,
+            ).update(
+                    found_at = person.found_at,
+                    etag = person.etag,
+                    last_modified = person.last_modified,
+                    )
+
+@shared_task()
+def forget_failures():
+    """
+    Deletes Failures for URLs which nobody has asked for
+    in a long while, and FetchLeases left behind by workers
+    which died.
+
+    This function is a shared task; Celery runs it periodically.
+    See CELERY_BEAT_SCHEDULE in settings.py.
+    """
+
+    count, _ = sombrero_models.Failure.objects.stale().delete()
+
+    if count:
+        logger.info('Forgot %d old failures', count)
+
+    sombrero_models.FetchLease.objects.filter(
+            expires__lt = django.utils.timezone.now(),
+            ).delete()
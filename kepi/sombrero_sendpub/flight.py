@@ -0,0 +1,94 @@
+# flight.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+This contains SingleFlight, which stops several threads
+doing the same work at once.
+
+When a popular post is boosted, lots of messages turn up together,
+all mentioning the same people. Without this, each of them would
+go off and fetch the same things from the same remote server.
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+import threading
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight(object):
+
+    """
+    Runs one piece of work at a time for each key.
+
+    If do() is called with a key while another thread is
+    already working on it, the caller waits for that work
+    to finish and gets the same result (or exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.shared = 0
+
+    def do(self, key, fn):
+        """
+        Returns the result of calling fn(), unless another
+        thread is already calling fn() for "key", in which case
+        returns the result of that call instead.
+        """
+
+        with self._lock:
+            flight = self._flights.get(key, None)
+
+            if flight is None:
+                flight = _Flight()
+                self._flights[key] = flight
+                leader = True
+            else:
+                flight.waiters += 1
+                self.shared += 1
+                leader = False
+
+        if not leader:
+            logger.debug('%s: already in flight; waiting', key)
+            flight.done.wait()
+
+            if flight.error is not None:
+                raise flight.error
+
+            return flight.result
+
+        try:
+            flight.result = fn()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+
+            flight.done.set()
+
+            if flight.waiters:
+                logger.debug('%s: shared with %d waiting',
+                        key, flight.waiters)
+
+        return flight.result
+
+    def in_flight(self):
+        """
+        Returns how many keys are being worked on at present.
+        """
+        with self._lock:
+            return len(self._flights)
@@ -0,0 +1,325 @@
+# keys.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+This contains KeyCache, which remembers the public keys that
+remote people sign their messages with.
+
+Every incoming message is signed, and names its key by the
+keyId in its Signature header. Looking up whoever owns that key,
+and parsing their PEM-encoded public key, for every message
+would be a waste of time: people rarely change their keys.
+So we keep the parsed keys in memory, keyed by keyId.
+
+The keyId needn't be the owner's URL with a fragment on the end.
+We look for the owner by the keyId we stored when we last fetched
+them, among the actor's keys if we know who the actor is; then we
+try fetching the actor; then we try fetching the keyId itself.
+Each VerificationKey records who owns it. It's up to the caller to
+check that the owner is who the message claims to be from.
+
+People do change their keys sometimes, though. If a signature
+doesn't verify with the key we have, the caller can ask us for
+the key again with refresh=True, and we check with the owner's
+server whether it's changed. We only do that once in a while
+for each key, so that a flood of badly-signed messages can't make
+us flood the owner's server in turn.
+
+Like FetchCache, we only remember keys once the transaction
+they were found in has been committed. Keys are forgotten when
+their owner is saved or deleted.
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urldefrag
+from django.conf import settings
+from django.db import transaction
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+
+DEFAULT_SIZE = 1024
+DEFAULT_TTL = 60*60
+DEFAULT_REFETCH_INTERVAL = 60
+
+class VerificationKey(object):
+
+    """
+    A parsed public key.
+
+    Attributes:
+        key_id -- the ID of the key, as in the keyId of a signature
+        owner -- the URL of the person the key belongs to
+        verifier -- a PKCS1_v1_5 signature scheme for the key
+    """
+
+    def __init__(self, key_id, owner, verifier):
+        self.key_id = key_id
+        self.owner = owner
+        self.verifier = verifier
+
+    def __str__(self):
+        return '[key %s of %s]' % (self.key_id, self.owner)
+
+    @classmethod
+    def from_person(cls, person, key_id):
+        """
+        Returns the VerificationKey "key_id" of "person", or None
+        if it isn't theirs or we can't parse it.
+        """
+
+        if not _is_key_of(person, key_id):
+            return None
+
+        try:
+            rsa_key = RSA.importKey(person.publicKey)
+        except (ValueError, TypeError, IndexError) as e:
+            logger.info('%s: %s has an invalid public key: %s',
+                    key_id, person.url, e)
+            return None
+
+        return cls(
+                key_id = key_id,
+                owner = person.url,
+                verifier = PKCS1_v1_5.new(rsa_key),
+                )
+
+def _is_key_of(person, key_id):
+
+    if person is None or not person.publicKey:
+        return False
+
+    if person.key_name:
+        return person.key_name==key_id
+
+    # We don't know what their key is called, but this
+    # looks like the usual name for it.
+    return urldefrag(key_id).url==person.url
+
+class KeyCache(object):
+
+    """
+    A cache of VerificationKeys, keyed on keyId.
+
+    Keyword arguments:
+        size -- how many keys to keep in memory.
+            Defaults to KEPI['KEY_CACHE_SIZE']. If this is
+            zero, nothing is cached.
+        ttl -- how many seconds to keep a key for.
+            Defaults to KEPI['KEY_CACHE_TTL'].
+        refetch_interval -- how many seconds to wait before
+            checking again whether a key has changed.
+            Defaults to KEPI['KEY_REFETCH_INTERVAL'].
+    """
+
+    def __init__(self,
+            size = None,
+            ttl = None,
+            refetch_interval = None,
+            ):
+
+        self._size = size
+        self._ttl = ttl
+        self._refetch_interval = refetch_interval
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._refetched = {}
+
+    def _setting(self, value, name, default):
+        if value is not None:
+            return value
+
+        return settings.KEPI.get(name, default)
+
+    @property
+    def size(self):
+        return self._setting(self._size,
+                'KEY_CACHE_SIZE', DEFAULT_SIZE)
+
+    @property
+    def ttl(self):
+        return self._setting(self._ttl,
+                'KEY_CACHE_TTL', DEFAULT_TTL)
+
+    @property
+    def refetch_interval(self):
+        return self._setting(self._refetch_interval,
+                'KEY_REFETCH_INTERVAL', DEFAULT_REFETCH_INTERVAL)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._refetched.clear()
+
+    def get(self, key_id,
+            actor = None,
+            refresh = False,
+            ):
+        """
+        Returns the VerificationKey for "key_id", or None if
+        we can't find it.
+
+        "actor" is the URL of the person who we think owns the key,
+        such as the actor of the message it signed. If it's given,
+        we only look for the key among the actor's keys, so that
+        nobody else can claim the actor's keyId as their own.
+
+        If "refresh" is True, we ask the owner's server whether
+        the key has changed, unless we asked in the last
+        KEPI['KEY_REFETCH_INTERVAL'] seconds.
+        """
+
+        if not refresh:
+            found = self._cached(key_id)
+
+            if found is not None and \
+                    (actor is None or found.owner==actor):
+                return found
+
+        owner = self._find_owner(key_id, actor)
+
+        if owner is None:
+            logger.info('%s: can\'t find the owner of this key',
+                    key_id)
+            return None
+
+        if refresh:
+            owner = self._refetch(owner, key_id)
+
+        result = VerificationKey.from_person(owner, key_id)
+
+        if result is not None:
+            self.put(result)
+
+        return result
+
+    def _cached(self, key_id):
+
+        if self.size==0:
+            return None
+
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key_id, None)
+
+            if entry is None:
+                return None
+
+            value, expires = entry
+
+            if expires <= now:
+                del self._entries[key_id]
+                return None
+
+            self._entries.move_to_end(key_id)
+            return value
+
+    def _find_owner(self, key_id, actor):
+
+        from kepi.sombrero_sendpub.fetch import fetch
+        from kepi.trilby_api.models import Person, RemotePerson
+
+        known = RemotePerson.objects.filter(
+                key_name = key_id,
+                )
+
+        if actor:
+            known = known.filter(
+                    remote_url = actor,
+                    )
+
+        owner = known.first()
+
+        if owner is not None:
+            return owner
+
+        candidates = []
+
+        if actor:
+            candidates.append(actor)
+
+        key_url = urldefrag(key_id).url
+        if key_url not in candidates:
+            candidates.append(key_url)
+
+        for address in candidates:
+            person = fetch(address, Person)
+
+            if _is_key_of(person, key_id):
+                return person
+
+            logger.debug('%s: not the key of %s', key_id, address)
+
+        return None
+
+    def _refetch(self, owner, key_id):
+
+        from kepi.sombrero_sendpub.refresh import refresh_person
+        from kepi.trilby_api.models import RemotePerson
+
+        if owner.is_local:
+            return owner
+
+        now = time.monotonic()
+
+        with self._lock:
+            last = self._refetched.get(key_id, None)
+
+            if last is not None and last+self.refetch_interval > now:
+                logger.debug('%s: checked this key lately; not refetching',
+                        key_id)
+                return owner
+
+            self._refetched[key_id] = now
+
+        logger.info('%s: checking whether this key has changed',
+                key_id)
+
+        if refresh_person(owner):
+            owner = RemotePerson.objects.get(pk=owner.pk)
+
+        return owner
+
+    def put(self, key):
+        """
+        Remembers the VerificationKey "key".
+
+        This only happens once the current transaction has been
+        committed. If it's rolled back, nothing is remembered.
+        """
+
+        if self.size==0:
+            return
+
+        transaction.on_commit(lambda: self._store(key))
+
+    def _store(self, key):
+
+        with self._lock:
+            self._entries.pop(key.key_id, None)
+            self._entries[key.key_id] = (key, time.monotonic()+self.ttl)
+
+            while len(self._entries) > self.size:
+                oldest = next(iter(self._entries))
+                del self._entries[oldest]
+
+    def invalidate_owner(self, url):
+        """
+        Forgets all the keys belonging to the person at "url".
+        """
+
+        with self._lock:
+            for key_id in [k for k, (v, expires) in self._entries.items()
+                    if v.owner==url]:
+                del self._entries[key_id]
+
+key_cache = KeyCache()
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:50
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sombrero_sendpub', '0004_failure'),
+        ('trilby_api', '0029_auto_20210216_1914'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Instance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hostname', models.CharField(max_length=256, unique=True)),
+                ('error_streak', models.IntegerField(default=0, help_text="How many times in a row we've failed to talk to this server.")),
+                ('circuit_open_until', models.DateTimeField(blank=True, default=None, help_text="If set, we won't deliver anything to this server until this time.", null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='outgoingactivity',
+            name='sender',
+            field=models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, to='trilby_api.localperson'),
+        ),
+        migrations.CreateModel(
+            name='Delivery',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('inbox', models.URLField(max_length=256)),
+                ('hostname', models.CharField(max_length=256)),
+                ('state', models.CharField(choices=[('P', 'pending'), ('D', 'delivered'), ('F', 'failed')], default='P', max_length=1)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_attempt', models.DateTimeField(blank=True, default=None, null=True)),
+                ('last_status', models.IntegerField(blank=True, default=None, help_text="The HTTP status of the last attempt, or 0 if we couldn't connect.", null=True)),
+                ('activity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='sombrero_sendpub.outgoingactivity')),
+            ],
+            options={
+                'verbose_name_plural': 'Deliveries',
+                'indexes': [models.Index(fields=['state', 'next_attempt'], name='sombrero_se_state_9762c5_idx')],
+                'constraints': [models.UniqueConstraint(fields=('activity', 'inbox'), name='deliver_only_once')],
+            },
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:57
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def mark_old_activities_dispatched(apps, schema_editor):
+    # Anything sent before we had an outbox was delivered
+    # at the time; don't let dispatch_outbox() send it again.
+    OutgoingActivity = apps.get_model('sombrero_sendpub',
+            'OutgoingActivity')
+    OutgoingActivity.objects.filter(
+            dispatched_at = None,
+            ).update(
+                    dispatched_at = models.F('created_at'),
+                    )
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sombrero_sendpub', '0005_delivery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outgoingactivity',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='outgoingactivity',
+            name='dispatched_at',
+            field=models.DateTimeField(blank=True, default=None, help_text="When we worked out who should receive this, or None if we haven't yet.", null=True),
+        ),
+        migrations.AddField(
+            model_name='outgoingactivity',
+            name='target_followers_of',
+            field=models.TextField(default='[]', help_text='JSON list of the primary keys of the Persons whose followers should receive this.'),
+        ),
+        migrations.AddField(
+            model_name='outgoingactivity',
+            name='target_people',
+            field=models.TextField(default='[]', help_text='JSON list of the primary keys of the Persons who should receive this.'),
+        ),
+        migrations.RunPython(
+            mark_old_activities_dispatched,
+            migrations.RunPython.noop,
+        ),
+    ]
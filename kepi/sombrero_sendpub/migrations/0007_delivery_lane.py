@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:00
+
+from django.db import migrations, models
+
+
+def assign_lanes(apps, schema_editor):
+    from kepi.sombrero_sendpub.models import lane_for
+
+    Delivery = apps.get_model('sombrero_sendpub', 'Delivery')
+
+    for hostname in Delivery.objects.values_list(
+            'hostname', flat=True).distinct():
+        Delivery.objects.filter(
+                hostname = hostname,
+                ).update(
+                        lane = lane_for(hostname),
+                        )
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sombrero_sendpub', '0006_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='delivery',
+            name='lane',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Which delivery lane this goes through. See lane_for().'),
+        ),
+        migrations.AddIndex(
+            model_name='delivery',
+            index=models.Index(fields=['lane', 'state', 'next_attempt'], name='sombrero_se_lane_79eb19_idx'),
+        ),
+        migrations.RunPython(
+            assign_lanes,
+            migrations.RunPython.noop,
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sombrero_sendpub', '0007_delivery_lane'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='instance',
+            name='concurrency',
+            field=models.FloatField(blank=True, default=None, help_text='How many posts we can have in flight to this server at once, or None for the default. See throttle().', null=True),
+        ),
+        migrations.AddField(
+            model_name='instance',
+            name='latency',
+            field=models.FloatField(blank=True, default=None, help_text='Moving average of how long this server takes to respond, in seconds.', null=True),
+        ),
+        migrations.AddField(
+            model_name='instance',
+            name='throttled_until',
+            field=models.DateTimeField(blank=True, default=None, help_text='If set, the server asked us (with Retry-After) not to deliver anything until this time.', null=True),
+        ),
+    ]
@@ -0,0 +1,75 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:06
+
+import django.utils.timezone
+from django.db import migrations, models
+from urllib.parse import urlparse
+
+def add_known_instances(apps, schema_editor):
+    # Every host we already know someone on is an instance.
+    Instance = apps.get_model('sombrero_sendpub', 'Instance')
+    RemotePerson = apps.get_model('trilby_api', 'RemotePerson')
+
+    known = set(Instance.objects.values_list('hostname', flat=True))
+
+    for remote_url in RemotePerson.objects.values_list(
+            'remote_url', flat=True):
+
+        hostname = urlparse(remote_url or '').netloc
+
+        if hostname and hostname not in known:
+            Instance(hostname = hostname).save()
+            known.add(hostname)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sombrero_sendpub', '0008_instance_throttle'),
+        ('trilby_api', '0029_auto_20210216_1914'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='instance',
+            name='first_seen',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='instance',
+            name='last_failure',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='instance',
+            name='last_success',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='instance',
+            name='nodeinfo_checked',
+            field=models.DateTimeField(blank=True, default=None, help_text='When we last asked the server for nodeinfo.', null=True),
+        ),
+        migrations.AddField(
+            model_name='instance',
+            name='shared_inbox',
+            field=models.URLField(blank=True, default='', help_text="The server's shared inbox, if it has one.", max_length=256),
+        ),
+        migrations.AddField(
+            model_name='instance',
+            name='software',
+            field=models.CharField(blank=True, default='', help_text='The server software, according to nodeinfo.', max_length=256),
+        ),
+        migrations.AddField(
+            model_name='instance',
+            name='software_version',
+            field=models.CharField(blank=True, default='', max_length=256),
+        ),
+        migrations.AddField(
+            model_name='outgoingactivity',
+            name='to_every_instance',
+            field=models.BooleanField(default=False, help_text='If True, this also goes to the shared inbox of every instance we know about.'),
+        ),
+        migrations.RunPython(
+            add_known_instances,
+            migrations.RunPython.noop,
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sombrero_sendpub', '0009_instance_registry'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='delivery',
+            name='sombrero_se_lane_79eb19_idx',
+        ),
+        migrations.AddField(
+            model_name='delivery',
+            name='priority',
+            field=models.CharField(choices=[('I', 'interactive'), ('B', 'bulk')], default='B', help_text='The priority of the activity.', max_length=1),
+        ),
+        migrations.AddField(
+            model_name='outgoingactivity',
+            name='priority',
+            field=models.CharField(choices=[('I', 'interactive'), ('B', 'bulk')], default='B', max_length=1),
+        ),
+        migrations.AddIndex(
+            model_name='delivery',
+            index=models.Index(fields=['priority', 'lane', 'state', 'next_attempt'], name='sombrero_se_priorit_6468e6_idx'),
+        ),
+    ]
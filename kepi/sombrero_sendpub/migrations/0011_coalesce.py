@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sombrero_sendpub', '0010_priorities'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outgoingactivity',
+            name='coalesce_key',
+            field=models.CharField(blank=True, db_index=True, default='', help_text='Activities with the same key which are waiting in the outbox get merged, and only the latest is sent. See deliver().', max_length=256),
+        ),
+        migrations.AddField(
+            model_name='outgoingactivity',
+            name='not_before',
+            field=models.DateTimeField(blank=True, default=None, help_text="If set, we don't dispatch this until then.", null=True),
+        ),
+    ]
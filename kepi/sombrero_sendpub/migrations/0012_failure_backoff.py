@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:16
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def merge_duplicate_failures(apps, schema_editor):
+    # Before now, every failure got its own row. Keep the newest
+    # for each URL, and count how many there were.
+    Failure = apps.get_model('sombrero_sendpub', 'Failure')
+
+    duplicated = Failure.objects.values('url').annotate(
+            rows = models.Count('id'),
+            ).filter(rows__gt = 1)
+
+    for row in duplicated:
+        failures = Failure.objects.filter(
+                url = row['url'],
+                ).order_by('-found_at', '-id')
+
+        newest = failures[0]
+        failures.exclude(id = newest.id).delete()
+
+        Failure.objects.filter(id = newest.id).update(
+                count = row['rows'],
+                )
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sombrero_sendpub', '0011_coalesce'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='failure',
+            name='count',
+            field=models.IntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='failure',
+            name='retry_after',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(
+            merge_duplicate_failures,
+            migrations.RunPython.noop,
+        ),
+        migrations.AlterField(
+            model_name='failure',
+            name='url',
+            field=models.URLField(max_length=256, unique=True),
+        ),
+    ]
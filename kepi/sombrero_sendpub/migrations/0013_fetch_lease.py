@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sombrero_sendpub', '0012_failure_backoff'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FetchLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address', models.CharField(max_length=512, unique=True)),
+                ('holder', models.CharField(max_length=256)),
+                ('expires', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:29
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sombrero_sendpub', '0013_fetch_lease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebfingerHost',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hostname', models.CharField(max_length=256, unique=True)),
+                ('template', models.CharField(help_text='The webfinger URL, with {uri} in place of the account.', max_length=512)),
+                ('fetched', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='webfingeruser',
+            name='status',
+            field=models.IntegerField(default=0, help_text="The HTTP status of the last lookup, or 0 if we couldn't connect."),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sombrero_sendpub', '0014_webfinger_cache'),
+        ('trilby_api', '0030_remoteperson_validators'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MirroredCollection',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.URLField(max_length=512, unique=True)),
+                ('total_items', models.IntegerField(default=None, help_text="The collection's totalItems when we last synced it, or None if it didn't say.", null=True)),
+                ('synced', models.DateTimeField(db_index=True, default=None, help_text='When we last synced this, or None if we never have.', null=True)),
+                ('walked', models.DateTimeField(default=None, help_text='When we last went through the whole collection, rather than just the new part.', null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MirroredMember',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.URLField(max_length=512)),
+                ('collection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='members', to='sombrero_sendpub.mirroredcollection')),
+                ('person', models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='mirrored_in', to='trilby_api.person')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('collection', 'url'), name='collection_and_member')],
+            },
+        ),
+    ]
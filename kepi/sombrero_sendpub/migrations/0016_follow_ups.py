@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sombrero_sendpub', '0015_mirrored_collections'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outgoingactivity',
+            name='follows_up',
+            field=models.BooleanField(default=False, help_text='If True, this changes or takes back something sent earlier, as Undo and Delete do. It waits for everything sent earlier to the same inbox, whatever its priority.'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sombrero_sendpub', '0016_follow_ups'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='delivery',
+            index=models.Index(fields=['inbox', 'state', 'priority', 'activity'], name='sombrero_se_inbox_dfe8f4_idx'),
+        ),
+    ]
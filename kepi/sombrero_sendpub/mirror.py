@@ -0,0 +1,283 @@
+# mirror.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+This keeps our own copies ("mirrors") of remote collections
+of people: in particular, remote people's followers and following.
+
+Walking a remote collection, and looking up everyone in it,
+takes far too long to do whenever someone asks who a remote
+person's followers are. So we keep a MirroredCollection for each,
+and members() reads from that. The first time anyone asks, the
+mirror is empty, and members() queues a task to fill it.
+A periodic task, sync_mirrors(), keeps the mirrors up to date.
+
+Most syncs only look at the part of the collection which is new.
+Servers list the newest members first, so we read until we reach
+people we already know about. If totalItems then adds up, nobody
+has left, and we can stop there. Otherwise, and every so often
+anyway, we go through the whole collection, and drop anyone
+who isn't in it any more.
+"""
+
+import logging
+logger = logging.getLogger(name="kepi")
+
+import datetime
+import django.utils.timezone
+from django.conf import settings
+from django.db import transaction
+from celery import shared_task
+import kepi.sombrero_sendpub.models as sombrero_models
+
+# How often we sync each mirror, and how often we go through
+# the whole collection, in seconds, unless settings.py says otherwise.
+DEFAULT_MIRROR_LIFETIME = 60*60
+DEFAULT_MIRROR_WALK_LIFETIME = 24*60*60
+
+# How many members we look up, or delete, at once.
+BATCH_SIZE = 20
+
+def _setting(name, default):
+    return datetime.timedelta(
+            seconds = settings.KEPI.get(name, default))
+
+def members(url):
+    """
+    Returns a QuerySet of the Persons in the remote collection
+    at "url", as of when we last synced it.
+
+    If we've never synced it, the QuerySet is empty, and we queue
+    sync_mirror() to sync it. Syncing can take a long while, so
+    we don't make the caller wait for it. If "url" is None,
+    the QuerySet is empty.
+    """
+
+    from kepi.trilby_api.models import Person
+
+    if url is None:
+        return Person.objects.none()
+
+    mirror, created = sombrero_models.MirroredCollection.objects.get_or_create(
+            url = url,
+            )
+
+    if created:
+        logger.debug("%s: mirror: new; queueing sync", url)
+        transaction.on_commit(
+                lambda: sync_mirror.apply_async(
+                    args = [url],
+                    ),
+                )
+
+    return Person.objects.filter(
+            mirrored_in__collection__url = url,
+            )
+
+def sync(url,
+        walk = None,
+        ):
+    """
+    Brings our mirror of the remote collection at "url" up to date,
+    and returns its MirroredCollection.
+
+    If "walk" is True, we go through the whole collection. If it's
+    False, we only look for new members, unless it turns out that
+    some have left. If it's None, we walk the collection if we haven't
+    for KEPI['MIRROR_WALK_LIFETIME'] seconds.
+
+    If we can't fetch the collection, we keep what we had.
+    """
+
+    from kepi.sombrero_sendpub.fetch import fetch
+    from kepi.sombrero_sendpub.collections import Collection
+
+    mirror, created = sombrero_models.MirroredCollection.objects.get_or_create(
+            url = url,
+            )
+
+    now = django.utils.timezone.now()
+
+    remote = fetch(url, Collection)
+
+    if remote is None:
+        logger.info("%s: mirror: can't fetch the collection; "+\
+                "keeping what we had", url)
+
+        sombrero_models.MirroredCollection.objects.filter(
+                pk = mirror.pk,
+                ).update(
+                        synced = now,
+                        )
+        return mirror
+
+    total = remote.totalItems
+    known = set(mirror.members.values_list('url', flat=True))
+
+    if walk is None:
+        walk = mirror.walked is None or \
+                mirror.walked < now - _setting('MIRROR_WALK_LIFETIME',
+                    DEFAULT_MIRROR_WALK_LIFETIME)
+
+    if not known or total is None:
+        # There's nothing to compare against.
+        walk = True
+
+    seen = set()
+    new = []
+
+    # If we're only looking for new members, we usually stop on
+    # the first page, so fetching the next one early is wasted.
+    iterator = remote.iterate(
+            prefetch = walk,
+            )
+
+    for item in iterator:
+
+        if isinstance(item, dict):
+            item = item.get('id', None)
+
+        if not isinstance(item, str) or item in seen:
+            continue
+
+        seen.add(item)
+
+        if item not in known:
+            new.append(item)
+
+        elif not walk and len(known)+len(new)==total:
+            logger.debug("%s: mirror: reached known members, "+\
+                    "and nobody has left", url)
+            iterator.close()
+            break
+
+    _add(mirror, new)
+
+    walked = iterator.complete
+
+    if walked:
+        _remove(mirror, known - seen)
+        _resolve(mirror)
+        mirror.walked = now
+    else:
+        logger.debug("%s: mirror: didn't go through the whole collection",
+                url)
+
+    mirror.total_items = total
+    mirror.synced = now
+    mirror.save()
+
+    logger.info("%s: mirror: synced; %d new, %s",
+            url, len(new),
+            'walked' if walked else 'not walked')
+
+    return mirror
+
+def _add(mirror, urls):
+    """
+    Adds "urls" to "mirror", looking up who they are.
+    """
+
+    from kepi.sombrero_sendpub.fetch import fetch_many
+    from kepi.trilby_api.models import Person
+
+    for i in range(0, len(urls), BATCH_SIZE):
+        batch = urls[i:i+BATCH_SIZE]
+        people = fetch_many(batch, Person)
+
+        sombrero_models.MirroredMember.objects.bulk_create([
+            sombrero_models.MirroredMember(
+                collection = mirror,
+                url = url,
+                person = people.get(url, None),
+                )
+            for url in batch],
+            ignore_conflicts = True,
+            )
+
+def _remove(mirror, urls):
+    """
+    Removes "urls" from "mirror".
+    """
+
+    urls = list(urls)
+
+    if urls:
+        logger.debug("%s: mirror: %d members have left",
+                mirror.url, len(urls))
+
+    for i in range(0, len(urls), BATCH_SIZE):
+        mirror.members.filter(
+                url__in = urls[i:i+BATCH_SIZE],
+                ).delete()
+
+def _resolve(mirror):
+    """
+    Tries again to look up members of "mirror" who we
+    couldn't find before.
+    """
+
+    from kepi.sombrero_sendpub.fetch import fetch_many
+    from kepi.trilby_api.models import Person
+
+    unknown = list(mirror.members.filter(
+            person = None,
+            ).values_list('url', flat=True))
+
+    for i in range(0, len(unknown), BATCH_SIZE):
+        people = fetch_many(unknown[i:i+BATCH_SIZE], Person)
+
+        for url, person in people.items():
+            if person is not None:
+                mirror.members.filter(
+                        url = url,
+                        ).update(
+                                person = person,
+                                )
+
+@shared_task()
+def sync_mirror(
+        url,
+        ):
+
+    """
+    Syncs the mirror of the remote collection at "url".
+
+    This function is a shared task. It's queued by members().
+    """
+
+    sync(url)
+
+@shared_task()
+def sync_mirrors(
+        batch_size = 20,
+        ):
+
+    """
+    Syncs the mirrors we haven't synced for KEPI['MIRROR_LIFETIME']
+    seconds, oldest first. Mirrors which have never been synced,
+    perhaps because their sync_mirror() task was lost, come
+    before all of them.
+
+    This function is a shared task; Celery runs it periodically.
+    See CELERY_BEAT_SCHEDULE in settings.py.
+    """
+
+    from django.db.models import F, Q
+
+    cutoff = django.utils.timezone.now() - _setting(
+            'MIRROR_LIFETIME', DEFAULT_MIRROR_LIFETIME)
+
+    stale = list(sombrero_models.MirroredCollection.objects.filter(
+            Q(synced = None) | Q(synced__lt = cutoff),
+            ).order_by(
+                    F('synced').asc(nulls_first = True),
+                    ).values_list('url', flat=True)[:batch_size])
+
+    logger.info('Syncing %d mirrors', len(stale))
+
+    for url in stale:
+        sync(url)
@@ -7,16 +7,202 @@
 import logging
 logger = logging.getLogger(name='kepi')
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from kepi.bowler_pub.utils import configured_url, as_json
 from django.db.models.constraints import UniqueConstraint
+from urllib.parse import urlparse
 import django.utils.timezone
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.functional import cached_property
+from django.conf import settings
+import datetime
+import hashlib
+import zlib
+import base64
 import json
 
+# How long we wait before retrying a delivery, in seconds.
+# This doubles after every failed attempt, up to RETRY_MAX.
+RETRY_BASE = 60
+RETRY_MAX = 24*60*60
+
+# How many times we try to deliver something before we give up.
+MAX_ATTEMPTS = 10
+
+# How many failures in a row it takes before we stop
+# talking to a remote host for a while.
+BREAKER_THRESHOLD = 5
+
+# Adaptive throttling. When a server is congested, we halve
+# how many posts we have in flight to it; while it's healthy,
+# we add one more after each round of posts.
+THROTTLE_DECREASE = 0.5
+THROTTLE_INCREASE = 1
+
+# Responses slower than this, in seconds, mean a server is struggling.
+SLOW_RESPONSE = 2.0
+
+# How much each round of posts counts towards a server's
+# average latency.
+LATENCY_WEIGHT = 0.2
+
+# How many posts we have in flight to a server to begin with,
+# and the most we'll ever have, unless settings.py says otherwise.
+DEFAULT_PER_HOST = 4
+DEFAULT_PER_HOST_CEILING = 32
+
+def _backoff(attempts):
+    """
+    Returns how long we should wait after "attempts" failures,
+    as a timedelta.
+    """
+    return datetime.timedelta(
+            seconds = min(RETRY_BASE * 2**max(attempts-1, 0),
+                RETRY_MAX),
+            )
+
+# If a server has been failing, and we haven't heard from it
+# successfully for this long, we count it as dead, and
+# stop planning deliveries to it.
+DEAD_AFTER = datetime.timedelta(days=3)
+
+# How many seconds we remember webfinger lookups for,
+# and failed lookups, unless settings.py says otherwise.
+DEFAULT_WEBFINGER_TTL = 24*60*60
+DEFAULT_WEBFINGER_NEGATIVE_TTL = 10*60
+
+# How long one worker can claim to be fetching an address
+# before other workers give up waiting for it, on top of
+# the longest a GET can take; see lease_duration().
+LEASE_MARGIN = datetime.timedelta(seconds=10)
+
+def lease_duration():
+    """
+    Returns how long a FetchLease lasts: long enough for the
+    holder to fetch the address and store what it found, so that
+    nobody else takes the lease over while they're still at it.
+    """
+    import kepi.sombrero_sendpub.outbound as outbound
+
+    return datetime.timedelta(
+            seconds = outbound.longest_get(),
+            ) + LEASE_MARGIN
+
+# How many delivery lanes we have, unless settings.py says otherwise.
+DEFAULT_LANES = 8
+
+# Delivery priorities. Interactive activities, like direct messages,
+# replies and follows, have their own queues, so that they don't
+# get stuck behind a big fan-out of bulk activities.
+INTERACTIVE = 'I'
+BULK = 'B'
+
+PRIORITY_CHOICES = [
+        (INTERACTIVE, 'interactive'),
+        (BULK, 'bulk'),
+        ]
+
+PRIORITY_NAMES = dict(PRIORITY_CHOICES)
+
+def lane_for(hostname):
+    """
+    Returns the delivery lane for a remote host.
+
+    Every delivery to the same host goes through the same lane,
+    so they go out in order, over the same connections. The
+    lane is worked out from a checksum of the hostname, so it's
+    the same in every process.
+    """
+
+    lanes = settings.KEPI.get('DELIVERY_LANES', DEFAULT_LANES)
+
+    return zlib.crc32(hostname.lower().encode('UTF-8')) % lanes
+
 class OutgoingActivity(models.Model):
 
+    """
+    An activity we're sending out.
+
+    This also acts as our outbox. The row is written in the
+    same transaction as whatever caused the activity, and
+    the delivery task is only queued once that transaction
+    has been committed. So the delivery task never sees an
+    activity about something which was rolled back, and
+    nothing is lost if the task can't be queued: see
+    kepi.sombrero_sendpub.delivery.dispatch_outbox().
+    """
+
     content = models.TextField()
 
+    sender = models.ForeignKey(
+            'trilby_api.LocalPerson',
+            on_delete = models.SET_NULL,
+            null = True,
+            blank = True,
+            default = None,
+            )
+
+    target_people = models.TextField(
+            default = '[]',
+            help_text = "JSON list of the primary keys of "+\
+                    "the Persons who should receive this.",
+            )
+
+    target_followers_of = models.TextField(
+            default = '[]',
+            help_text = "JSON list of the primary keys of "+\
+                    "the Persons whose followers should receive this.",
+            )
+
+    priority = models.CharField(
+            max_length = 1,
+            default = BULK,
+            choices = PRIORITY_CHOICES,
+            )
+
+    to_every_instance = models.BooleanField(
+            default = False,
+            help_text = "If True, this also goes to the shared "+\
+                    "inbox of every instance we know about.",
+            )
+
+    follows_up = models.BooleanField(
+            default = False,
+            help_text = "If True, this changes or takes back something "+\
+                    "sent earlier, as Undo and Delete do. It waits "+\
+                    "for everything sent earlier to the same inbox, "+\
+                    "whatever its priority.",
+            )
+
+    created_at = models.DateTimeField(
+            default = django.utils.timezone.now,
+            )
+
+    coalesce_key = models.CharField(
+            max_length = 256,
+            blank = True,
+            default = '',
+            db_index = True,
+            help_text = "Activities with the same key which are "+\
+                    "waiting in the outbox get merged, and only "+\
+                    "the latest is sent. See deliver().",
+            )
+
+    not_before = models.DateTimeField(
+            null = True,
+            blank = True,
+            default = None,
+            help_text = "If set, we don't dispatch this until then.",
+            )
+
+    dispatched_at = models.DateTimeField(
+            null = True,
+            blank = True,
+            default = None,
+            help_text = "When we worked out who should receive "+\
+                    "this, or None if we haven't yet.",
+            )
+
     @property
     def url(self):
         return configured_url(
@@ -37,6 +223,30 @@ class OutgoingActivity(models.Model):
 
         return result
 
+    @cached_property
+    def wire_body(self):
+        """
+        The activity, as bytes, in the form we post to remote inboxes.
+
+        This is worked out once, and the same bytes are shared
+        by every delivery of this activity.
+        """
+        return json.dumps(
+                self.value,
+                cls = DjangoJSONEncoder,
+                separators = (',', ':'),
+                ).encode('UTF-8')
+
+    @cached_property
+    def digest(self):
+        """
+        The value of the Digest header for wire_body.
+        See RFC 3230.
+        """
+        return 'SHA-256=' + str(base64.b64encode(
+            hashlib.sha256(self.wire_body).digest()),
+            encoding = 'ASCII')
+
     def __repr__(self):
         return as_json(self.value)
 
@@ -56,8 +266,24 @@ class OutgoingActivity(models.Model):
 
         super().save(*args, **kwargs)
 
+def _webfinger_ttl(found):
+    if found:
+        return datetime.timedelta(seconds=settings.KEPI.get(
+            'WEBFINGER_TTL', DEFAULT_WEBFINGER_TTL))
+    else:
+        return datetime.timedelta(seconds=settings.KEPI.get(
+            'WEBFINGER_NEGATIVE_TTL', DEFAULT_WEBFINGER_NEGATIVE_TTL))
+
 class WebfingerUser(models.Model):
 
+    """
+    What webfinger told us about username@hostname.
+
+    These are kept as a cache: get_webfinger() doesn't ask
+    again until they've expired. If "url" is None, the lookup
+    failed, and we ask again sooner.
+    """
+
     username = models.CharField(
             max_length = 256,
             )
@@ -72,6 +298,12 @@ class WebfingerUser(models.Model):
             default = None,
             )
 
+    status = models.IntegerField(
+            default = 0,
+            help_text = "The HTTP status of the last lookup, "+\
+                    "or 0 if we couldn't connect.",
+            )
+
     fetched = models.DateTimeField(
             default=django.utils.timezone.now,
             )
@@ -84,13 +316,154 @@ class WebfingerUser(models.Model):
                     ),
                 ]
 
+    @property
+    def is_fresh(self):
+        return self.fetched + _webfinger_ttl(self.url) > \
+                django.utils.timezone.now()
+
     def __str__(self):
         return f'{self.username}@{self.hostname} -> {self.url}'
 
+class WebfingerHost(models.Model):
+
+    """
+    Where a remote host keeps its webfinger lookups,
+    as found in its host-meta.
+    """
+
+    hostname = models.CharField(
+            max_length = 256,
+            unique = True,
+            )
+
+    template = models.CharField(
+            max_length = 512,
+            help_text = "The webfinger URL, with {uri} "+\
+                    "in place of the account.",
+            )
+
+    fetched = models.DateTimeField(
+            default=django.utils.timezone.now,
+            )
+
+    @property
+    def is_fresh(self):
+        return self.fetched + _webfinger_ttl(True) > \
+                django.utils.timezone.now()
+
+    def __str__(self):
+        return f'{self.hostname} -> {self.template}'
+
+class MirroredCollection(models.Model):
+
+    """
+    Our copy of a remote collection of people, such as a remote
+    person's followers. The members are MirroredMembers.
+
+    These are kept up to date by kepi.sombrero_sendpub.mirror.
+    """
+
+    url = models.URLField(
+            max_length = 512,
+            unique = True,
+            )
+
+    total_items = models.IntegerField(
+            null = True,
+            default = None,
+            help_text = "The collection's totalItems when we last "+\
+                    "synced it, or None if it didn't say.",
+            )
+
+    synced = models.DateTimeField(
+            null = True,
+            default = None,
+            db_index = True,
+            help_text = "When we last synced this, "+\
+                    "or None if we never have.",
+            )
+
+    walked = models.DateTimeField(
+            null = True,
+            default = None,
+            help_text = "When we last went through the whole "+\
+                    "collection, rather than just the new part.",
+            )
+
+    def __str__(self):
+        return f'[{self.url}: {self.total_items} items, synced {self.synced}]'
+
+class MirroredMember(models.Model):
+
+    """
+    One member of a MirroredCollection.
+
+    "person" is None if we couldn't find out who they were.
+    """
+
+    collection = models.ForeignKey(
+            MirroredCollection,
+            on_delete = models.CASCADE,
+            related_name = 'members',
+            )
+
+    url = models.URLField(
+            max_length = 512,
+            )
+
+    person = models.ForeignKey(
+            'trilby_api.Person',
+            on_delete = models.SET_NULL,
+            null = True,
+            blank = True,
+            default = None,
+            related_name = 'mirrored_in',
+            )
+
+    class Meta:
+        constraints = [
+                UniqueConstraint(
+                    fields = ['collection', 'url'],
+                    name = 'collection_and_member',
+                    ),
+                ]
+
+    def __str__(self):
+        return f'[{self.url} in {self.collection.url}]'
+
+class FailureQuerySet(models.QuerySet):
+
+    def current(self):
+        """
+        Failures which we're still waiting out.
+        """
+        return self.filter(
+                retry_after__gt = django.utils.timezone.now(),
+                )
+
+    def stale(self):
+        """
+        Failures which ran out long enough ago that nobody
+        seems to want the URL any more.
+        """
+        return self.filter(
+                retry_after__lt = django.utils.timezone.now() - \
+                        datetime.timedelta(seconds=RETRY_MAX),
+                )
+
 class Failure(models.Model):
 
+    """
+    A URL which we couldn't fetch.
+
+    There is one Failure per URL. Every time fetching it fails again,
+    "count" goes up, and we wait longer before trying again;
+    see _backoff(). If it works, the Failure is deleted.
+    """
+
     url = models.URLField(
             max_length = 256,
+            unique = True,
             )
 
     status = models.IntegerField()
@@ -99,6 +472,47 @@ class Failure(models.Model):
             auto_now = True,
             )
 
+    count = models.IntegerField(
+            default = 1,
+            )
+
+    retry_after = models.DateTimeField(
+            default = django.utils.timezone.now,
+            )
+
+    objects = FailureQuerySet.as_manager()
+
+    @property
+    def is_current(self):
+        return self.retry_after > django.utils.timezone.now()
+
+    @classmethod
+    def record(cls, url, status):
+        """
+        Records that fetching "url" failed with "status".
+        Returns the Failure.
+        """
+
+        failure = cls.objects.filter(url=url).first()
+
+        if failure is None:
+            failure = cls(url=url, count=0)
+
+        failure.status = status
+        failure.count += 1
+        failure.retry_after = django.utils.timezone.now() + \
+                _backoff(failure.count)
+
+        try:
+            with transaction.atomic():
+                failure.save()
+        except IntegrityError:
+            # Someone else recorded the first failure
+            # at the same moment; theirs will do.
+            logger.debug('%s: failure already recorded', url)
+
+        return failure
+
     def save(self, *args, **kwargs):
 
         if self.status//100 == 2:
@@ -110,4 +524,577 @@ class Failure(models.Model):
         super().save(*args, **kwargs)
 
     def __str__(self):
-        return f'[{self.url} got {self.status}]'
+        return f'[{self.url} got {self.status}, {self.count} times]'
+
+class FetchLease(models.Model):
+
+    """
+    A claim, by one worker, to be fetching an address.
+
+    Other workers which want the same address wait for
+    the lease to go away rather than fetching it themselves.
+    If the holder dies, the lease runs out; see lease_duration().
+    """
+
+    address = models.CharField(
+            max_length = 512,
+            unique = True,
+            )
+
+    holder = models.CharField(
+            max_length = 256,
+            )
+
+    expires = models.DateTimeField(
+            )
+
+    @classmethod
+    def acquire(cls, address, holder):
+        """
+        Tries to take the lease on "address" for "holder".
+        Returns True if it worked, and False if someone
+        else holds it.
+        """
+
+        now = django.utils.timezone.now()
+
+        try:
+            with transaction.atomic():
+                cls.objects.create(
+                        address = address,
+                        holder = holder,
+                        expires = now + lease_duration(),
+                        )
+            return True
+
+        except IntegrityError:
+            pass
+
+        # If it's run out, it's ours.
+        return cls.objects.filter(
+                address = address,
+                expires__lte = now,
+                ).update(
+                        holder = holder,
+                        expires = now + lease_duration(),
+                        ) > 0
+
+    @classmethod
+    def is_held(cls, address):
+        return cls.objects.filter(
+                address = address,
+                expires__gt = django.utils.timezone.now(),
+                ).exists()
+
+    @classmethod
+    def release(cls, address, holder):
+        cls.objects.filter(
+                address = address,
+                holder = holder,
+                ).delete()
+
+    def __str__(self):
+        return f'[{self.address} held by {self.holder} until {self.expires}]'
+
+class InstanceQuerySet(models.QuerySet):
+
+    def _dead(self):
+        cutoff = django.utils.timezone.now() - DEAD_AFTER
+
+        return models.Q(error_streak__gte = BREAKER_THRESHOLD) & (
+                models.Q(last_success__lt = cutoff) |
+                models.Q(last_success = None, first_seen__lt = cutoff))
+
+    def dead(self):
+        """
+        Instances which have been failing for at least DEAD_AFTER.
+        """
+        return self.filter(self._dead())
+
+    def alive(self):
+        """
+        Instances which aren't dead.
+        """
+        return self.exclude(self._dead())
+
+class Instance(models.Model):
+
+    """
+    A remote server.
+
+    Instances are created as we come across them, when we
+    fetch things from them or deliver things to them.
+
+    We keep a record of which remote servers are failing,
+    so that when a server goes down, we stop trying to deliver
+    to it for a while. This is known as a circuit breaker.
+    When the breaker is open, we don't try to deliver anything
+    to the server until circuit_open_until has passed;
+    after that, we try again, and if it works, we close
+    the breaker. If a server keeps failing for DEAD_AFTER,
+    we stop planning deliveries to it at all, until we
+    hear from it again.
+    """
+
+    objects = InstanceQuerySet.as_manager()
+
+    hostname = models.CharField(
+            max_length = 256,
+            unique = True,
+            )
+
+    shared_inbox = models.URLField(
+            max_length = 256,
+            blank = True,
+            default = '',
+            help_text = "The server's shared inbox, if it has one.",
+            )
+
+    first_seen = models.DateTimeField(
+            default = django.utils.timezone.now,
+            )
+
+    last_success = models.DateTimeField(
+            null = True,
+            blank = True,
+            default = None,
+            )
+
+    last_failure = models.DateTimeField(
+            null = True,
+            blank = True,
+            default = None,
+            )
+
+    software = models.CharField(
+            max_length = 256,
+            blank = True,
+            default = '',
+            help_text = "The server software, according to nodeinfo.",
+            )
+
+    software_version = models.CharField(
+            max_length = 256,
+            blank = True,
+            default = '',
+            )
+
+    nodeinfo_checked = models.DateTimeField(
+            null = True,
+            blank = True,
+            default = None,
+            help_text = "When we last asked the server for nodeinfo.",
+            )
+
+    error_streak = models.IntegerField(
+            default = 0,
+            help_text = "How many times in a row we've failed "+\
+                    "to talk to this server.",
+            )
+
+    circuit_open_until = models.DateTimeField(
+            null = True,
+            blank = True,
+            default = None,
+            help_text = "If set, we won't deliver anything "+\
+                    "to this server until this time.",
+            )
+
+    concurrency = models.FloatField(
+            null = True,
+            blank = True,
+            default = None,
+            help_text = "How many posts we can have in flight "+\
+                    "to this server at once, or None for the default. "+\
+                    "See throttle().",
+            )
+
+    latency = models.FloatField(
+            null = True,
+            blank = True,
+            default = None,
+            help_text = "Moving average of how long this server "+\
+                    "takes to respond, in seconds.",
+            )
+
+    throttled_until = models.DateTimeField(
+            null = True,
+            blank = True,
+            default = None,
+            help_text = "If set, the server asked us (with "+\
+                    "Retry-After) not to deliver anything until this time.",
+            )
+
+    @property
+    def available_from(self):
+        """
+        The time before which we shouldn't deliver anything
+        to this server, or None if there isn't one.
+        """
+        times = [x for x in [self.circuit_open_until, self.throttled_until]
+                if x is not None]
+
+        if not times:
+            return None
+
+        return max(times)
+
+    @property
+    def is_available(self):
+        available_from = self.available_from
+
+        if available_from is None:
+            return True
+
+        return available_from <= django.utils.timezone.now()
+
+    @property
+    def max_in_flight(self):
+        """
+        How many posts we can have in flight to this server at once.
+        """
+        if self.concurrency is None:
+            return settings.KEPI.get('DELIVERY_MAX_PER_HOST',
+                    DEFAULT_PER_HOST)
+
+        return max(int(self.concurrency), 1)
+
+    def throttle(self, outcomes, retry_after=None):
+        """
+        Adjusts how hard we push this server, after a round of posts.
+
+        This is additive-increase, multiplicative-decrease, as
+        in TCP. If the server turned anything away with 429 or 503,
+        or timed out, we halve our concurrency. Otherwise, if it
+        answered quickly enough, we add one.
+
+        outcomes -- list of (status, seconds) for each post, where
+            status is the HTTP status, or 0 if we couldn't connect,
+            and seconds is how long it took to respond, or None.
+        retry_after -- the latest datetime the server asked us
+            to wait until, or None.
+        """
+
+        if not outcomes:
+            return
+
+        ceiling = settings.KEPI.get('DELIVERY_PER_HOST_CEILING',
+                DEFAULT_PER_HOST_CEILING)
+
+        concurrency = float(self.max_in_flight)
+
+        timings = [x[1] for x in outcomes
+                if x[1] is not None and x[0]!=0]
+
+        if timings:
+            latest = sum(timings)/len(timings)
+
+            if self.latency is None:
+                self.latency = latest
+            else:
+                self.latency += LATENCY_WEIGHT * (latest-self.latency)
+
+        congested = [x for x in outcomes
+                if x[0] in [0, 429, 503]]
+
+        if congested:
+            concurrency = max(concurrency * THROTTLE_DECREASE, 1.0)
+
+            logger.info('%s: congested (%s); concurrency now %.1f',
+                    self.hostname,
+                    sorted(set([x[0] for x in congested])),
+                    concurrency)
+
+        elif self.latency is not None and self.latency < SLOW_RESPONSE:
+            concurrency = min(concurrency + THROTTLE_INCREASE, ceiling)
+
+        self.concurrency = concurrency
+
+        # Other workers may be saving other fields of this
+        # Instance at the same time; don't overwrite them.
+        changed = ['concurrency', 'latency']
+
+        if retry_after is not None:
+            if self.throttled_until is None or \
+                    retry_after > self.throttled_until:
+
+                logger.info('%s: asked us to wait until %s',
+                        self.hostname, retry_after)
+                self.throttled_until = retry_after
+                changed.append('throttled_until')
+
+        self.save(
+                update_fields = changed,
+                )
+
+    @property
+    def is_dead(self):
+        if self.error_streak < BREAKER_THRESHOLD:
+            return False
+
+        heard_from = self.last_success or self.first_seen
+
+        return heard_from < django.utils.timezone.now() - DEAD_AFTER
+
+    @classmethod
+    def for_hostname(cls, hostname):
+        """
+        Returns the Instance for "hostname", creating it if need be.
+        """
+        result, created = cls.objects.get_or_create(
+                hostname = hostname,
+                )
+
+        if created:
+            logger.debug('%s: new instance', hostname)
+
+        return result
+
+    def succeeded(self):
+        """
+        Records that we talked to this server successfully.
+        """
+
+        now = django.utils.timezone.now()
+
+        if self.error_streak==0 and self.circuit_open_until is None \
+                and self.last_success is not None \
+                and self.last_success > now-datetime.timedelta(minutes=1):
+            return
+
+        if self.circuit_open_until is not None:
+            logger.info('%s: back up; closing circuit breaker',
+                    self.hostname)
+
+        self.error_streak = 0
+        self.circuit_open_until = None
+        self.last_success = now
+        self.save(
+                update_fields = ['error_streak', 'circuit_open_until',
+                    'last_success'],
+                )
+
+    def failed(self):
+        """
+        Records that we failed to talk to this server.
+        """
+
+        now = django.utils.timezone.now()
+        self.last_failure = now
+
+        # Other workers may be failing to talk to this server
+        # at the same time, so count in the database.
+        #
+        # Failures while the circuit breaker is open were already
+        # under way when it opened, so they don't count. That way,
+        # the streak grows by one each time the breaker trips,
+        # and so does the backoff.
+        counted = Instance.objects.filter(
+                models.Q(circuit_open_until = None) |
+                models.Q(circuit_open_until__lte = now),
+                pk = self.pk,
+                ).update(
+                        error_streak = models.F('error_streak') + 1,
+                        last_failure = now,
+                        )
+
+        if not counted:
+            Instance.objects.filter(
+                    pk = self.pk,
+                    ).update(
+                            last_failure = now,
+                            )
+            return
+
+        self.refresh_from_db(
+                fields = ['error_streak'],
+                )
+
+        if self.error_streak >= BREAKER_THRESHOLD:
+            self.circuit_open_until = now + \
+                    _backoff(self.error_streak - BREAKER_THRESHOLD + 1)
+
+            logger.info('%s: %d failures in a row; '+\
+                    'opening circuit breaker until %s',
+                    self.hostname, self.error_streak,
+                    self.circuit_open_until)
+
+            self.save(
+                    update_fields = ['circuit_open_until'],
+                    )
+
+    def __str__(self):
+        return self.hostname
+
+class Delivery(models.Model):
+
+    """
+    A record of delivering an OutgoingActivity to one inbox.
+    """
+
+    PENDING = 'P'
+    DELIVERED = 'D'
+    FAILED = 'F'
+
+    STATE_CHOICES = [
+            (PENDING, 'pending'),
+            (DELIVERED, 'delivered'),
+            (FAILED, 'failed'),
+            ]
+
+    activity = models.ForeignKey(
+            OutgoingActivity,
+            on_delete = models.CASCADE,
+            related_name = 'deliveries',
+            )
+
+    inbox = models.URLField(
+            max_length = 256,
+            )
+
+    hostname = models.CharField(
+            max_length = 256,
+            )
+
+    lane = models.PositiveSmallIntegerField(
+            default = 0,
+            help_text = "Which delivery lane this goes through. "+\
+                    "See lane_for().",
+            )
+
+    priority = models.CharField(
+            max_length = 1,
+            default = BULK,
+            choices = PRIORITY_CHOICES,
+            help_text = "The priority of the activity.",
+            )
+
+    state = models.CharField(
+            max_length = 1,
+            default = PENDING,
+            choices = STATE_CHOICES,
+            )
+
+    attempts = models.IntegerField(
+            default = 0,
+            )
+
+    next_attempt = models.DateTimeField(
+            default = django.utils.timezone.now,
+            )
+
+    last_attempt = models.DateTimeField(
+            null = True,
+            blank = True,
+            default = None,
+            )
+
+    last_status = models.IntegerField(
+            null = True,
+            blank = True,
+            default = None,
+            help_text = "The HTTP status of the last attempt, "+\
+                    "or 0 if we couldn't connect.",
+            )
+
+    class Meta:
+        verbose_name_plural = 'Deliveries'
+
+        constraints = [
+                UniqueConstraint(
+                    fields = ['activity', 'inbox'],
+                    name = 'deliver_only_once',
+                    ),
+                ]
+
+        indexes = [
+                models.Index(
+                    fields = ['state', 'next_attempt'],
+                    ),
+                models.Index(
+                    fields = ['priority', 'lane', 'state', 'next_attempt'],
+                    ),
+                # For finding earlier activities to the same inbox
+                # which are still pending; see _next_in_lane().
+                models.Index(
+                    fields = ['inbox', 'state', 'priority', 'activity'],
+                    ),
+                ]
+
+    def save(self, *args, **kwargs):
+
+        if not self.hostname:
+            self.hostname = urlparse(self.inbox).netloc
+
+        self.lane = lane_for(self.hostname)
+
+        if self._state.adding:
+            self.priority = self.activity.priority
+
+        super().save(*args, **kwargs)
+
+    @property
+    def host_is_failing(self):
+        """
+        True if the last attempt suggests that the remote host
+        is in trouble, rather than that it didn't like the message.
+        """
+        return self.last_status==0 or (self.last_status or 0)>=500
+
+    def postpone(self, until):
+        """
+        Puts off the next attempt, without counting it as a failure.
+        """
+
+        self.next_attempt = until
+        self.save(
+                update_fields = ['next_attempt'],
+                )
+
+    def record(self, status, retry_after=None):
+        """
+        Records the result of an attempt.
+
+        status -- the HTTP status code, or 0 if we couldn't connect.
+        retry_after -- a datetime before which the remote host
+            asked us not to try again, or None.
+        """
+
+        now = django.utils.timezone.now()
+
+        self.attempts += 1
+        self.last_attempt = now
+        self.last_status = status
+
+        if status//100 == 2:
+            self.state = self.DELIVERED
+        elif status in [404, 410]:
+            logger.info('%s: gone (%d); giving up', self.inbox, status)
+            self.state = self.FAILED
+        elif status//100 == 4 and status not in [408, 429]:
+            logger.info('%s: refused (%d); giving up', self.inbox, status)
+            self.state = self.FAILED
+        elif self.attempts >= MAX_ATTEMPTS:
+            logger.info('%s: %d attempts; giving up', self.inbox,
+                    self.attempts)
+            self.state = self.FAILED
+        else:
+            self.next_attempt = now + _backoff(self.attempts)
+
+            if retry_after is not None and retry_after > self.next_attempt:
+                self.next_attempt = retry_after
+
+            logger.debug('%s: got %d; retrying at %s', self.inbox,
+                    status, self.next_attempt)
+
+        self.save(
+                update_fields = ['attempts', 'last_attempt', 'last_status',
+                    'state', 'next_attempt'],
+                )
+
+    def __str__(self):
+        return '[%s to %s: %s]' % (
+                self.activity_id,
+                self.inbox,
+                self.get_state_display(),
+                )
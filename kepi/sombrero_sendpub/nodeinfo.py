@@ -0,0 +1,111 @@
+# nodeinfo.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+This finds out what software remote instances are running,
+using nodeinfo: http://nodeinfo.diaspora.software/
+"""
+
+import logging
+logger = logging.getLogger(name="kepi")
+
+import requests
+import kepi.sombrero_sendpub.outbound as outbound
+import datetime
+import django.utils.timezone
+from django.db.models import Q
+from celery import shared_task
+import kepi.sombrero_sendpub.models as sombrero_models
+
+# How often we ask each instance for its nodeinfo.
+NODEINFO_LIFETIME = datetime.timedelta(days=7)
+
+def get_nodeinfo(instance):
+    """
+    Asks "instance" for its nodeinfo, and records the
+    software it says it's running.
+
+    Saves the Instance, whether or not it works. Only the fields
+    we change are saved, so we don't undo what delivery and
+    fetching have recorded in the meantime.
+    """
+
+    instance.nodeinfo_checked = django.utils.timezone.now()
+
+    try:
+        response = outbound.get(
+                f'https://{instance.hostname}/.well-known/nodeinfo',
+                headers = {
+                    'Accept': 'application/json',
+                    },
+                )
+
+        links = [x['href'] for x in response.json().get('links', [])
+                if 'href' in x and
+                x.get('rel', '').startswith(
+                    'http://nodeinfo.diaspora.software/ns/schema/')]
+
+        if not links:
+            logger.info('%s: no nodeinfo', instance.hostname)
+            instance.save(
+                    update_fields = ['nodeinfo_checked'],
+                    )
+            return
+
+        # Links are listed in order of schema version;
+        # the last is the newest.
+        response = outbound.get(
+                links[-1],
+                headers = {
+                    'Accept': 'application/json',
+                    },
+                )
+
+        software = response.json().get('software', {})
+
+    except (requests.exceptions.RequestException,
+            ValueError, AttributeError, TypeError) as e:
+        logger.info('%s: nodeinfo lookup failed: %s',
+                instance.hostname, e)
+        instance.save(
+                update_fields = ['nodeinfo_checked'],
+                )
+        return
+
+    instance.software = str(software.get('name', ''))[:256]
+    instance.software_version = str(software.get('version', ''))[:256]
+
+    logger.info('%s: runs %s %s',
+            instance.hostname,
+            instance.software, instance.software_version)
+
+    instance.save(
+            update_fields = ['nodeinfo_checked', 'software',
+                'software_version'],
+            )
+
+@shared_task()
+def refresh_instances(
+        batch_size = 50,
+        ):
+
+    """
+    Asks instances for their nodeinfo, if we haven't done
+    so lately. Dead instances are left alone.
+
+    This function is a shared task; Celery runs it periodically.
+    See CELERY_BEAT_SCHEDULE in settings.py.
+    """
+
+    cutoff = django.utils.timezone.now() - NODEINFO_LIFETIME
+
+    stale = sombrero_models.Instance.objects.alive().filter(
+            Q(nodeinfo_checked__lt = cutoff) |
+            Q(nodeinfo_checked = None),
+            )
+
+    for instance in stale.order_by('nodeinfo_checked')[:batch_size]:
+        get_nodeinfo(instance)
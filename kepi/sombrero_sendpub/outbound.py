@@ -0,0 +1,305 @@
+# outbound.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+This is how we GET things from remote servers.
+
+Use get() instead of calling requests.get() directly. It:
+  - keeps connections to each host alive, and reuses them;
+  - gives up on servers which are slow to connect, slow to reply,
+    or which send their reply very slowly;
+  - remembers DNS lookups for a little while;
+  - refuses to read more than a certain amount, so that someone
+    can't fill up our memory by sending us an enormous "actor".
+
+All the limits can be set in settings.KEPI; see OUTBOUND_*.
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+import threading
+import socket
+import ipaddress
+import time
+import requests
+import urllib3
+from collections import OrderedDict
+from urllib.parse import urlparse
+from django.conf import settings
+
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 10
+DEFAULT_TOTAL_TIMEOUT = 30
+DEFAULT_MAX_SIZE = 1024*1024
+DEFAULT_DNS_TTL = 60
+DEFAULT_POOL_SIZE = 4
+DEFAULT_MAX_SESSIONS = 256
+
+CHUNK_SIZE = 16*1024
+
+class ResponseTooLarge(requests.RequestException):
+    """
+    The remote server sent us more than OUTBOUND_MAX_SIZE bytes.
+    """
+    pass
+
+def _setting(name, default):
+    return settings.KEPI.get(name, default)
+
+def longest_get():
+    """
+    Returns the most seconds get() can take before it gives up.
+
+    The total timeout is only checked between reads, so the
+    last read can run over it by up to the read timeout.
+    """
+    return _setting('OUTBOUND_TOTAL_TIMEOUT', DEFAULT_TOTAL_TIMEOUT) + \
+            _setting('OUTBOUND_READ_TIMEOUT', DEFAULT_READ_TIMEOUT)
+
+class _DNSCache(object):
+
+    """
+    Remembers which address each hostname resolved to,
+    for OUTBOUND_DNS_TTL seconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.lookups = 0
+
+    def resolve(self, hostname):
+
+        try:
+            ipaddress.ip_address(hostname)
+            return hostname
+        except ValueError:
+            pass
+
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(hostname, None)
+
+            if entry is not None and entry[1] > now:
+                return entry[0]
+
+        # If this fails, socket.gaierror goes back up to urllib3,
+        # which handles it as it would have done anyway.
+        found = socket.getaddrinfo(hostname, None,
+                0, socket.SOCK_STREAM)
+
+        address = found[0][4][0]
+
+        with self._lock:
+            self.lookups += 1
+            self._entries[hostname] = (address,
+                    now + _setting('OUTBOUND_DNS_TTL', DEFAULT_DNS_TTL))
+
+        logger.debug('%s: resolved to %s', hostname, address)
+
+        return address
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.lookups = 0
+
+dns_cache = _DNSCache()
+
+class _CachedDNSMixin(object):
+
+    # urllib3 connects to self._dns_host, but uses self.host
+    # for everything else, including checking certificates.
+    def _new_conn(self):
+        original = self._dns_host
+        self._dns_host = dns_cache.resolve(original)
+
+        try:
+            return super()._new_conn()
+        finally:
+            self._dns_host = original
+
+class _HTTPConnection(_CachedDNSMixin,
+        urllib3.connection.HTTPConnection):
+    pass
+
+class _HTTPSConnection(_CachedDNSMixin,
+        urllib3.connection.HTTPSConnection):
+    pass
+
+class _HTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = _HTTPConnection
+
+class _HTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = _HTTPSConnection
+
+class _Adapter(requests.adapters.HTTPAdapter):
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+
+        self.poolmanager.pool_classes_by_scheme = {
+                'http': _HTTPConnectionPool,
+                'https': _HTTPSConnectionPool,
+                }
+
+_sessions = OrderedDict()
+_sessions_lock = threading.Lock()
+
+def _session_for(hostname):
+    """
+    Returns the requests.Session we use for "hostname".
+
+    Sessions are shared across the whole process, so that
+    keep-alive connections are reused between requests.
+    We keep OUTBOUND_MAX_SESSIONS of them at most;
+    the least recently used are closed.
+    """
+
+    evicted = []
+
+    with _sessions_lock:
+        result = _sessions.get(hostname, None)
+
+        if result is None:
+            logger.debug('%s: new outbound session', hostname)
+
+            result = requests.Session()
+            adapter = _Adapter(
+                    pool_connections = 1,
+                    pool_maxsize = _setting('OUTBOUND_POOL_SIZE',
+                        DEFAULT_POOL_SIZE),
+                    )
+            result.mount('https://', adapter)
+            result.mount('http://', adapter)
+
+            _sessions[hostname] = result
+
+            while len(_sessions) > _setting('OUTBOUND_MAX_SESSIONS',
+                    DEFAULT_MAX_SESSIONS):
+                evicted.append(_sessions.popitem(last=False))
+        else:
+            _sessions.move_to_end(hostname)
+
+    for old_hostname, session in evicted:
+        logger.debug('%s: closing outbound session', old_hostname)
+        session.close()
+
+    return result
+
+def close_sessions():
+    """
+    Closes all the keep-alive connections we have open.
+    """
+
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+
+        _sessions.clear()
+
+def get(url,
+        headers = None,
+        max_size = None,
+        ):
+
+    """
+    GETs "url", and returns the requests.Response.
+
+    The body has already been read by the time this returns,
+    so response.content, response.text and response.json()
+    all work as usual.
+
+    Raises requests.ConnectionError if we can't connect,
+    requests.Timeout if the server takes too long, and
+    ResponseTooLarge if the body is bigger than "max_size",
+    which defaults to KEPI['OUTBOUND_MAX_SIZE']. These are all
+    subclasses of requests.RequestException.
+    """
+
+    if max_size is None:
+        max_size = _setting('OUTBOUND_MAX_SIZE', DEFAULT_MAX_SIZE)
+
+    total_timeout = _setting('OUTBOUND_TOTAL_TIMEOUT',
+            DEFAULT_TOTAL_TIMEOUT)
+
+    started = time.monotonic()
+
+    session = _session_for(urlparse(url).netloc)
+
+    response = session.get(
+            url,
+            headers = headers,
+            timeout = (
+                _setting('OUTBOUND_CONNECT_TIMEOUT',
+                    DEFAULT_CONNECT_TIMEOUT),
+                _setting('OUTBOUND_READ_TIMEOUT',
+                    DEFAULT_READ_TIMEOUT),
+                ),
+            stream = True,
+            )
+
+    try:
+        length = int(response.headers.get('Content-Length', 0))
+    except ValueError:
+        length = 0
+
+    if length > max_size:
+        response.close()
+        raise ResponseTooLarge(
+                f'{url}: Content-Length is {length}, but the '
+                f'most we accept is {max_size}',
+                response = response,
+                )
+
+    # The read timeout only applies to each read, so a server
+    # which sends a byte at a time could keep us here forever.
+    # So we keep an eye on the total time as well. read1() returns
+    # whatever has arrived, rather than waiting for a whole chunk,
+    # so we get to check often enough.
+
+    read = getattr(response.raw, 'read1', response.raw.read)
+    body = bytearray()
+
+    try:
+        while True:
+            chunk = read(CHUNK_SIZE, decode_content=True)
+
+            if not chunk:
+                break
+
+            body.extend(chunk)
+
+            if len(body) > max_size:
+                raise ResponseTooLarge(
+                        f'{url}: body is over {max_size} bytes',
+                        response = response,
+                        )
+
+            if time.monotonic()-started > total_timeout:
+                raise requests.Timeout(
+                        f'{url}: took over {total_timeout} seconds',
+                        response = response,
+                        )
+
+    except requests.RequestException:
+        response.close()
+        raise
+
+    except urllib3.exceptions.ReadTimeoutError as e:
+        response.close()
+        raise requests.Timeout(e, response=response)
+
+    except urllib3.exceptions.HTTPError as e:
+        response.close()
+        raise requests.ConnectionError(e, response=response)
+
+    response._content = bytes(body)
+    response._content_consumed = True
+
+    return response
@@ -8,7 +8,11 @@ import logging
 logger = logging.getLogger(name='kepi')
 
 import kepi.trilby_api.signals as kepi_signals
+import kepi.trilby_api.utils as trilby_utils
 from django.dispatch import receiver
+from django.db.models.signals import post_save, post_delete
+from kepi.sombrero_sendpub.cache import fetch_cache
+from kepi.sombrero_sendpub.keys import key_cache
 from kepi.sombrero_sendpub.delivery import deliver
 
 @receiver(kepi_signals.followed)
@@ -52,6 +56,14 @@ def on_posted(sender, **kwargs):
 
     logger.info("%s: status creation received", sender)
 
+    import kepi.sombrero_sendpub.models as sombrero_models
+
+    if sender.is_reply or \
+            sender.visibility==trilby_utils.VISIBILITY_DIRECT:
+        priority = sombrero_models.INTERACTIVE
+    else:
+        priority = sombrero_models.BULK
+
     deliver(
             activity = {
                 "type": "Create",
@@ -63,8 +75,81 @@ def on_posted(sender, **kwargs):
                     }
                 },
             sender = sender.account,
-            target_people = sender.account.followers,
+            target_followers_of = [sender.account],
+            priority = priority,
             )
 
-    logger.info("%s: status creation notification delivered",
+    logger.info("%s: status creation notification queued",
             sender)
+
+@receiver(kepi_signals.updated)
+def on_updated(sender, **kwargs):
+    """
+    If a local person has updated their profile, send an
+    ActivityPub "Update" activity message about it to their followers.
+
+    People often make several changes in a row, so we wait
+    for a while before sending, and if they change anything else
+    in the meantime, we only send the latest version.
+    See KEPI['UPDATE_COALESCE_SECONDS'] in settings.py.
+
+    The spec for "Update" is here:
+    https://www.w3.org/TR/activitystreams-vocabulary/#dfn-update
+    """
+
+    if not sender.is_local:
+        logger.debug("%s is remote; not notifying remote hosts",
+                sender)
+        return
+
+    import datetime
+    from django.conf import settings
+    from kepi.trilby_api.models.status import PUBLIC
+    from kepi.bowler_pub.serializers import PersonSerializer
+
+    logger.info("%s: profile update received", sender)
+
+    deliver(
+            activity = {
+                'type': 'Update',
+                'actor': sender.url,
+                'to': [PUBLIC],
+                'object': PersonSerializer(sender).data,
+                },
+            sender = sender,
+            target_followers_of = [sender],
+            coalesce = 'Update '+sender.url,
+            delay = datetime.timedelta(
+                seconds = settings.KEPI.get(
+                    'UPDATE_COALESCE_SECONDS', 60),
+                ),
+            )
+
+@receiver(post_save, sender='trilby_api.RemotePerson')
+@receiver(post_delete, sender='trilby_api.RemotePerson')
+@receiver(post_save, sender='trilby_api.Status')
+@receiver(post_delete, sender='trilby_api.Status')
+def on_fetchable_changed(sender, instance, **kwargs):
+    """
+    Forgets any cached fetch() results for something
+    which has changed.
+
+    This includes misses for its addresses, so that something
+    we've just created isn't hidden behind an earlier failure
+    to find it.
+    """
+    fetch_cache.invalidate(instance)
+
+    for field in ['remote_url', 'acct']:
+        address = getattr(instance, field, None)
+        if address:
+            fetch_cache.invalidate_address(address)
+
+@receiver(post_save, sender='trilby_api.RemotePerson')
+@receiver(post_delete, sender='trilby_api.RemotePerson')
+def on_remote_person_changed(sender, instance, **kwargs):
+    """
+    Forgets any cached public keys of a remote person
+    who has changed; their key may have changed too.
+    """
+    key_cache.invalidate_owner(instance.url)
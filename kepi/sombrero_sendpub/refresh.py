@@ -0,0 +1,236 @@
+# refresh.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+This keeps what we know about remote people up to date.
+
+Every so often, we ask the remote server whether each person
+we know about has changed since we last fetched them, using
+the ETag and Last-Modified headers it gave us then. Usually
+they haven't, and the server just says so. We only process
+their profile again if it has actually changed.
+"""
+
+import logging
+logger = logging.getLogger(name="kepi")
+
+import requests
+import datetime
+import django.utils.timezone
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db.models import Q, F
+from celery import shared_task
+import kepi.sombrero_sendpub.outbound as outbound
+import kepi.sombrero_sendpub.models as sombrero_models
+from kepi.sombrero_sendpub.fetch import note_validators, \
+        DEFAULT_FETCH_MANY_WORKERS
+
+# How often we check each remote person,
+# unless settings.py says otherwise.
+DEFAULT_PERSON_LIFETIME = 24*60*60
+
+# How many remote people we check each time,
+# unless settings.py says otherwise.
+DEFAULT_REFRESH_BATCH_SIZE = 50
+
+def _revalidate(person):
+    """
+    Asks the remote server whether "person" has changed.
+    Returns the response, or the exception if that didn't work.
+
+    This doesn't touch the database, so it's safe to call
+    from other threads.
+    """
+
+    headers = {
+            'Accept': 'application/activity+json',
+            }
+
+    if person.etag:
+        headers['If-None-Match'] = person.etag
+
+    if person.last_modified:
+        headers['If-Modified-Since'] = person.last_modified
+
+    try:
+        return outbound.get(
+                person.remote_url,
+                headers = headers,
+                )
+    except requests.RequestException as re:
+        return re
+
+def refresh_person(person, response=None):
+    """
+    Brings the RemotePerson "person" up to date.
+
+    "response" is what _revalidate() returned for them;
+    if it's None, we call _revalidate() ourselves.
+
+    Returns True if they'd changed, and False otherwise.
+    """
+
+    from kepi.trilby_api.models import RemotePerson
+    import kepi.bowler_pub.create as bowler_create
+
+    if response is None:
+        response = _revalidate(person)
+
+    if isinstance(response, requests.RequestException):
+        logger.info('%s: refresh failed: %s',
+                person.remote_url, response)
+
+        sombrero_models.Instance.for_hostname(
+                urlparse(person.remote_url).netloc,
+                ).failed()
+
+        # Try again next time round.
+        RemotePerson.objects.filter(
+                pk = person.pk,
+                ).update(
+                        found_at = django.utils.timezone.now(),
+                        )
+        return False
+
+    if response.status_code==304:
+        logger.debug('%s: not modified',
+                person.remote_url)
+
+        # Servers may send new validators with a 304.
+        note_validators(person, {
+            'ETag': response.headers.get('ETag', person.etag),
+            'Last-Modified': response.headers.get('Last-Modified',
+                person.last_modified),
+            })
+        return False
+
+    if response.status_code!=200:
+        logger.info('%s: refresh got status %d; leaving them alone',
+                person.remote_url, response.status_code)
+
+        RemotePerson.objects.filter(
+                pk = person.pk,
+                ).update(
+                        found_at = django.utils.timezone.now(),
+                        )
+        return False
+
+    etag = response.headers.get('ETag', '')
+
+    if etag and etag==person.etag:
+        # The server ignored If-None-Match, but it's told us
+        # nothing has changed all the same.
+        logger.debug('%s: same ETag; not modified',
+                person.remote_url)
+        note_validators(person, response.headers)
+        return False
+
+    try:
+        found = response.json()
+
+        if found.get('id', None)!=person.remote_url:
+            raise ValueError(
+                    f"id was {found.get('id', None)}")
+
+        bowler_create.on_person(
+                found,
+                person.remote_url,
+                update_existing = True,
+                )
+
+    except (ValueError, AttributeError, TypeError) as e:
+        logger.info('%s: refresh gave us something we can\'t use: %s',
+                person.remote_url, e)
+
+        RemotePerson.objects.filter(
+                pk = person.pk,
+                ).update(
+                        found_at = django.utils.timezone.now(),
+                        )
+        return False
+
+    logger.info('%s: refreshed', person.remote_url)
+
+    note_validators(person, response.headers)
+    return True
+
+@shared_task()
+def refresh_remote_people(
+        batch_size = None,
+        ):
+
+    """
+    Checks whether the remote people we haven't checked
+    for a while have changed, and updates them if so.
+    People on instances we aren't talking to at present
+    are left until next time.
+
+    We check at most "batch_size" people each time, the ones
+    we've gone longest without checking first. It defaults to
+    KEPI['REFRESH_BATCH_SIZE'].
+
+    This function is a shared task; Celery runs it periodically.
+    See CELERY_BEAT_SCHEDULE in settings.py.
+    """
+
+    from kepi.trilby_api.models import RemotePerson
+
+    if batch_size is None:
+        batch_size = settings.KEPI.get('REFRESH_BATCH_SIZE',
+                DEFAULT_REFRESH_BATCH_SIZE)
+
+    cutoff = django.utils.timezone.now() - datetime.timedelta(
+            seconds = settings.KEPI.get('REMOTE_PERSON_LIFETIME',
+                DEFAULT_PERSON_LIFETIME))
+
+    stale = list(RemotePerson.objects.filter(
+            Q(found_at__lt = cutoff) |
+            Q(found_at = None),
+            ).exclude(
+                    remote_url = None,
+                    ).order_by(
+                            F('found_at').asc(nulls_first=True),
+                            )[:batch_size])
+
+    if not stale:
+        return
+
+    unavailable = set([instance.hostname for instance in
+        sombrero_models.Instance.objects.filter(
+            hostname__in = set([urlparse(person.remote_url).netloc
+                for person in stale]),
+            ) if not instance.is_available or instance.is_dead])
+
+    people = []
+
+    for person in stale:
+        if urlparse(person.remote_url).netloc in unavailable:
+            RemotePerson.objects.filter(
+                    pk = person.pk,
+                    ).update(
+                            found_at = django.utils.timezone.now(),
+                            )
+        else:
+            people.append(person)
+
+    logger.info('Refreshing %d remote people; skipping %d',
+            len(people), len(stale)-len(people))
+
+    if not people:
+        return
+
+    with ThreadPoolExecutor(
+            max_workers = min(len(people),
+                settings.KEPI.get('FETCH_MANY_WORKERS',
+                    DEFAULT_FETCH_MANY_WORKERS)),
+            ) as pool:
+
+        responses = list(pool.map(_revalidate, people))
+
+    for person, response in zip(people, responses):
+        refresh_person(person, response)
@@ -0,0 +1,112 @@
+# resolution.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+This contains resolving(), which makes fetch() look up each
+address at most once while we're dealing with one message.
+
+Without it, an incoming Follow finds its actor when we validate
+it, and then again when we create the Follow; a Note finds its
+poster over and over, once for each thing which refers to them.
+
+Inside resolving(), everything fetch() and fetch_many() find,
+including misses, is remembered in a Resolution: an identity map
+from addresses to objects. Asking again for the same address gives
+you the same object. The Resolution only lasts until the end of
+the "with" block, so nothing is remembered from one message to
+the next; that's what kepi.sombrero_sendpub.cache is for.
+
+The current Resolution is kept in a context variable, so it
+follows the code which is dealing with the message, and isn't
+shared with anything else running at the same time.
+"""
+
+import logging
+logger = logging.getLogger(name="kepi")
+
+import contextvars
+from contextlib import contextmanager
+
+_current = contextvars.ContextVar('kepi_resolution',
+        default = None)
+
+class Resolution(object):
+
+    """
+    What each address resolved to, while dealing with one message.
+    Use resolving() rather than creating these directly.
+    """
+
+    def __init__(self):
+        self._found = {}
+        self.hits = 0
+
+    def get(self, address, expected_type):
+        """
+        Returns a tuple (found, value). If we've resolved "address"
+        as "expected_type" already, "found" is True and "value" is
+        what we found, which might be None. Otherwise, "found"
+        is False.
+
+        Something we found while looking for a different type
+        will do, if it's an instance of "expected_type".
+        """
+
+        by_type = self._found.get(address, None)
+
+        if by_type is None:
+            return False, None
+
+        if expected_type in by_type:
+            self.hits += 1
+            return True, by_type[expected_type]
+
+        for value in by_type.values():
+            if value is not None and isinstance(value, expected_type):
+                self.hits += 1
+                return True, value
+
+        return False, None
+
+    def put(self, address, expected_type, value):
+        self._found.setdefault(address, {})[expected_type] = value
+
+    def __len__(self):
+        return len(self._found)
+
+def current():
+    """
+    Returns the current Resolution, or None if we're not
+    inside resolving().
+    """
+    return _current.get()
+
+@contextmanager
+def resolving():
+    """
+    Context manager. Inside it, fetch() resolves each address
+    at most once. Yields the Resolution.
+
+    If we're already inside resolving(), the Resolution
+    is shared with the outer one.
+    """
+
+    existing = _current.get()
+
+    if existing is not None:
+        yield existing
+        return
+
+    resolution = Resolution()
+    token = _current.set(resolution)
+
+    try:
+        yield resolution
+    finally:
+        _current.reset(token)
+
+        logger.debug("resolution: %d addresses; %d lookups saved",
+                len(resolution), resolution.hits)
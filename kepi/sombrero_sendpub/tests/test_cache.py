@@ -0,0 +1,166 @@
+# test_cache.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+import logging
+logger = logging.getLogger(name="kepi")
+
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.conf import settings
+from kepi.sombrero_sendpub.cache import FetchCache, fetch_cache
+from kepi.sombrero_sendpub.fetch import fetch
+from kepi.trilby_api.models import RemotePerson
+from .test_fetch import EXAMPLE_USER_URL, EXAMPLE_USER_RESULT
+import httpretty
+
+class Tests(TransactionTestCase):
+
+    def test_hit_and_miss(self):
+
+        cache = FetchCache(size=10)
+
+        self.assertEqual(cache.get('https://example.org/1', str),
+                (False, None))
+
+        cache.put('https://example.org/1', str, 'one')
+        cache.put('https://example.org/2', str, None)
+
+        self.assertEqual(cache.get('https://example.org/1', str),
+                (True, 'one'))
+        self.assertEqual(cache.get('https://example.org/1', int),
+                (False, None),
+                msg = "Results are kept separately for each type")
+        self.assertEqual(cache.get('https://example.org/2', str),
+                (True, None),
+                msg = "Misses are cached")
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['negative_hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['size'], 2)
+
+    def test_lru(self):
+
+        cache = FetchCache(size=2)
+
+        cache.put('https://example.org/1', str, 'one')
+        cache.put('https://example.org/2', str, 'two')
+        cache.get('https://example.org/1', str)
+        cache.put('https://example.org/3', str, 'three')
+
+        self.assertEqual(cache.get('https://example.org/2', str),
+                (False, None),
+                msg = "The least recently used entry was evicted")
+        self.assertEqual(cache.get('https://example.org/1', str),
+                (True, 'one'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_ttl(self):
+
+        cache = FetchCache(size=10, ttl=0, negative_ttl=0)
+
+        cache.put('https://example.org/1', str, 'one')
+
+        self.assertEqual(cache.get('https://example.org/1', str),
+                (False, None))
+        self.assertEqual(cache.stats()['expiries'], 1)
+
+    def test_shared(self):
+
+        kepi_settings = settings.KEPI.copy()
+        kepi_settings['FETCH_CACHE'] = 'default'
+
+        with override_settings(KEPI=kepi_settings):
+            first = FetchCache(size=10)
+            second = FetchCache(size=10)
+
+            first.put('https://example.org/1', str, 'one')
+            first.put('https://example.org/2', str, None)
+
+            self.assertEqual(second.get('https://example.org/1', str),
+                    (True, 'one'))
+            self.assertEqual(second.get('https://example.org/2', str),
+                    (True, None))
+            self.assertEqual(second.stats()['shared_hits'], 2)
+
+            first.invalidate_address('https://example.org/1')
+            second.clear()
+
+            self.assertEqual(second.get('https://example.org/1', str),
+                    (False, None))
+
+    @httpretty.activate
+    def test_fetch(self):
+
+        fetch_cache.clear()
+        self.addCleanup(fetch_cache.clear)
+
+        httpretty.register_uri(
+                'GET',
+                EXAMPLE_USER_URL,
+                status=200,
+                headers = {
+                        'Content-Type': 'application/activity+json',
+                        },
+                body = EXAMPLE_USER_RESULT,
+                )
+
+        user = fetch(EXAMPLE_USER_URL, RemotePerson)
+        self.assertIsNotNone(user)
+
+        with self.assertNumQueries(0):
+            again = fetch(EXAMPLE_USER_URL, RemotePerson)
+
+        self.assertEqual(again.pk, user.pk)
+        self.assertEqual(fetch_cache.stats()['hits'], 1)
+
+        user.display_name = 'The Other Wombat'
+        user.save()
+
+        self.assertEqual(
+                fetch_cache.get(EXAMPLE_USER_URL, RemotePerson),
+                (False, None),
+                msg = "Saving an object removes it from the cache")
+
+    def test_miss_forgotten_when_created(self):
+
+        fetch_cache.clear()
+        self.addCleanup(fetch_cache.clear)
+
+        remote_url = 'https://remote.example.org/users/wombat'
+
+        fetch_cache.put(remote_url, RemotePerson, None)
+        self.assertEqual(fetch_cache.get(remote_url, RemotePerson),
+                (True, None))
+
+        RemotePerson.objects.create(
+                remote_url = remote_url,
+                username = 'wombat',
+                )
+
+        self.assertEqual(
+                fetch_cache.get(remote_url, RemotePerson),
+                (False, None),
+                msg = "Creating an object removes misses for its address")
+
+class TestRollback(TestCase):
+
+    def test_not_cached_until_committed(self):
+
+        cache = FetchCache(size=10)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            cache.put('https://example.org/1', str, 'one')
+
+            self.assertEqual(cache.get('https://example.org/1', str),
+                    (False, None))
+
+        for callback in callbacks:
+            callback()
+
+        self.assertEqual(cache.get('https://example.org/1', str),
+                (True, 'one'),
+                msg = "It's cached once the transaction is committed")
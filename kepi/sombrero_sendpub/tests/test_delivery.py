@@ -7,14 +7,25 @@
 import logging
 logger = logging.getLogger(name='kepi')
 
-from unittest import skip
-from django.test import TestCase
-from kepi.sombrero_sendpub.delivery import deliver
+from unittest import skip, mock
+from django.test import TestCase, TransactionTestCase, \
+        skipUnlessDBFeature
+from django.db import connection, transaction
+from kepi.sombrero_sendpub.delivery import deliver, _plan_delivery, \
+        retry_deliveries, _signer_for_localperson, \
+        dispatch, dispatch_outbox, lane_depths, lane_queue, \
+        priority_of, _next_in_lane, COALESCE_MAX
+from kepi.sombrero_sendpub.mirror import sync
+import kepi.sombrero_sendpub.models as sombrero_models
+import django.utils.timezone
+import datetime
+import json
 from kepi.trilby_api.tests import create_local_person
 from kepi.trilby_api.models import Follow
 from kepi.bowler_pub.tests import create_remote_person, mock_remote_object
-import kepi.bowler_pub.views as bowler_views
 import httpretty
+import httpsig
+import threading
 
 TEST_ACTIVITY = {
         'id': 'https://example.com/foo',
@@ -33,33 +44,28 @@ class Tests(TestCase):
         self.bob = create_local_person("bob")
         self.carol = create_local_person("carol")
 
-        self._real_inbox_post = bowler_views.InboxView.post
         self.remotes = {}
         self.received_post = set()
+        self.created = []
 
-        def mock_post(*args, **kwargs):
+        def mock_create(fields, *args, **kwargs):
             """
-            Wrapper for InboxView.post(), which flags that
-            the local view has received a copy of the message.
-
-            Adds the name of the user to self.received_post.
-            If the message was sent to the local shared inbox,
-            adds "(shared)".
+            Stands in for create(), which is what receives
+            local deliveries. Flags that the message was
+            delivered locally by adding "(local)" to
+            self.received_post.
             """
-            logger.info("Received local post")
-
-            self.received_post.add(
-                    kwargs.get("username") or "(shared)")
+            logger.info("Received local delivery: %s", fields)
 
-            logger.info("%s %s %s",
-                    self.received_post,
-                    kwargs,
-                    kwargs.get("username", "(shared"))
+            self.received_post.add("(local)")
+            self.created.append(fields)
 
-            result = self._real_inbox_post(*args, **kwargs)
-            return result
-
-        bowler_views.InboxView.post = mock_post
+        patcher = mock.patch(
+                'kepi.bowler_pub.create.create',
+                mock_create,
+                )
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def acknowledge_remote(self, name):
         logger.info("Received remote post for %s", name)
@@ -87,17 +93,28 @@ class Tests(TestCase):
 
         self.setup_locals()
 
-        deliver(
-                activity = TEST_ACTIVITY,
-                sender = self.alice,
-                target_people = [
-                    self.bob, self.carol,
-                    ],
-                )
+        with self.captureOnCommitCallbacks(execute=True):
+            deliver(
+                    activity = TEST_ACTIVITY,
+                    sender = self.alice,
+                    target_people = [
+                        self.bob, self.carol,
+                        ],
+                    )
 
         self.assertEqual(
                 self.received_post,
-                set(['(shared)']),
+                set(['(local)']),
+                )
+
+        self.assertEqual(
+                len(self.created),
+                1,
+                )
+
+        self.assertEqual(
+                self.created[0]['object'],
+                TEST_ACTIVITY['object'],
                 )
 
     def test_send_to_followers_of_local_user(self):
@@ -107,17 +124,28 @@ class Tests(TestCase):
         Follow(following=self.alice, follower=self.bob).save()
         Follow(following=self.alice, follower=self.carol).save()
 
-        deliver(
-                activity = TEST_ACTIVITY,
-                sender = self.alice,
-                target_followers_of = [
-                    self.alice,
-                    ],
-                )
+        with self.captureOnCommitCallbacks(execute=True):
+            deliver(
+                    activity = TEST_ACTIVITY,
+                    sender = self.alice,
+                    target_followers_of = [
+                        self.alice,
+                        ],
+                    )
 
         self.assertEqual(
                 self.received_post,
-                set(['(shared)']),
+                set(['(local)']),
+                )
+
+        self.assertEqual(
+                len(self.created),
+                1,
+                )
+
+        self.assertEqual(
+                self.created[0]['object'],
+                TEST_ACTIVITY['object'],
                 )
 
     @httpretty.activate
@@ -125,13 +153,14 @@ class Tests(TestCase):
         self.setup_locals()
         self.setup_remotes()
 
-        deliver(
-                activity = TEST_ACTIVITY,
-                sender = self.alice,
-                target_people = [
-                    self.remotes['peter'],
-                    ],
-                )
+        with self.captureOnCommitCallbacks(execute=True):
+            deliver(
+                    activity = TEST_ACTIVITY,
+                    sender = self.alice,
+                    target_people = [
+                        self.remotes['peter'],
+                        ],
+                    )
 
         self.assertEqual(
                 self.received_post,
@@ -157,15 +186,1140 @@ class Tests(TestCase):
                 status = 200,
                 )
 
-        deliver(
-                activity = TEST_ACTIVITY,
-                sender = self.alice,
-                target_followers_of = [
+        # Planning reads our mirror of the collection; it doesn't
+        # wait for the remote server.
+        sync('https://example.org/people/peter/followers')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            deliver(
+                    activity = TEST_ACTIVITY,
+                    sender = self.alice,
+                    target_followers_of = [
+                        self.remotes['peter'],
+                        ],
+                    )
+
+        self.assertEqual(
+                self.received_post,
+                set(['quentin', 'robert']),
+                )
+
+    @httpretty.activate
+    def test_plan_shared_inbox(self):
+        self.setup_locals()
+
+        for name in ['sarah', 'tim']:
+            self.remotes[name] = create_remote_person(
+                    remote_url = 'https://example.net/people/'+name,
+                    name = name,
+                    sharedInbox = 'https://example.net/inbox',
+                    auto_fetch = True,
+                    )
+
+        self.setup_remotes()
+
+        for name in ['sarah', 'tim', 'peter', 'robert']:
+            Follow(following=self.alice,
+                    follower=self.remotes[name]).save()
+
+        Follow(following=self.alice, follower=self.bob).save()
+
+        has_local, hosts = _plan_delivery(
+                target_followers_of = [self.alice],
+                )
+
+        self.assertTrue(has_local)
+
+        self.assertEqual(
+                hosts,
+                {
+                    'example.net': set([
+                        'https://example.net/inbox',
+                        ]),
+                    'example.org': set([
+                        'https://example.org/people/peter/inbox',
+                        'https://example.org/people/robert/inbox',
+                        ]),
+                    },
+                )
+
+        self.assertEqual(
+                sombrero_models.Instance.objects.get(
+                    hostname = 'example.net',
+                    ).shared_inbox,
+                'https://example.net/inbox',
+                )
+
+    @httpretty.activate
+    def test_plan_cross_host_shared_inbox(self):
+        self.setup_locals()
+        self.setup_remotes()
+
+        # Someone on another host claims that example.org's
+        # shared inbox is somewhere else on example.org.
+        mallory = create_remote_person(
+                remote_url = 'https://evil.example/people/mallory',
+                name = 'mallory',
+                sharedInbox = 'https://example.org/nowhere',
+                auto_fetch = True,
+                )
+
+        self.assertEqual(mallory.inbox_url,
+                'https://evil.example/people/mallory/inbox',
+                msg = "A shared inbox on another host is ignored")
+
+        self.assertFalse(
+                sombrero_models.Instance.objects.filter(
+                    hostname = 'example.org',
+                    ).exclude(
+                        shared_inbox = None,
+                        ).exclude(
+                            shared_inbox = '',
+                            ).exists(),
+                msg = "A shared inbox on another host isn't recorded")
+
+        for name in ['peter', 'robert']:
+            Follow(following=self.alice,
+                    follower=self.remotes[name]).save()
+
+        Follow(following=self.alice, follower=mallory).save()
+
+        has_local, hosts = _plan_delivery(
+                target_followers_of = [self.alice],
+                )
+
+        self.assertEqual(
+                hosts,
+                {
+                    'example.org': set([
+                        'https://example.org/people/peter/inbox',
+                        'https://example.org/people/robert/inbox',
+                        ]),
+                    'evil.example': set([
+                        'https://evil.example/people/mallory/inbox',
+                        ]),
+                    },
+                )
+
+    @httpretty.activate
+    def test_plan_shared_inbox_not_advertised(self):
+        self.setup_locals()
+        self.setup_remotes()
+
+        sombrero_models.Instance.objects.filter(
+                hostname = 'example.org',
+                ).update(
+                        shared_inbox = 'https://example.org/inbox',
+                        )
+
+        has_local, hosts = _plan_delivery(
+                target_people = [self.remotes['peter']],
+                )
+
+        self.assertEqual(
+                hosts,
+                {
+                    'example.org': set([
+                        'https://example.org/people/peter/inbox',
+                        ]),
+                    },
+                msg = "People who didn't advertise the host's shared "
+                    "inbox are sent to through their own inbox",
+                )
+
+    @httpretty.activate
+    def test_plan_dead_host(self):
+        self.setup_locals()
+        self.setup_remotes()
+
+        sombrero_models.Instance.objects.filter(
+                hostname = 'example.org',
+                ).update(
+                        error_streak = sombrero_models.BREAKER_THRESHOLD,
+                        last_success = django.utils.timezone.now() - \
+                                datetime.timedelta(days=30),
+                        )
+
+        has_local, hosts = _plan_delivery(
+                target_people = self.remotes.values(),
+                )
+
+        self.assertEqual(hosts, {},
+                msg = "Dead hosts are left out")
+
+    @httpretty.activate
+    def test_plan_every_instance(self):
+        self.setup_locals()
+        self.setup_remotes()
+
+        sombrero_models.Instance(
+                hostname = 'example.net',
+                shared_inbox = 'https://example.net/inbox',
+                ).save()
+
+        sombrero_models.Instance(
+                hostname = 'example.com',
+                ).save()
+
+        has_local, hosts = _plan_delivery(
+                target_people = [self.remotes['peter']],
+                to_every_instance = True,
+                )
+
+        self.assertEqual(
+                hosts,
+                {
+                    'example.net': set([
+                        'https://example.net/inbox',
+                        ]),
+                    'example.org': set([
+                        'https://example.org/people/peter/inbox',
+                        ]),
+                    },
+                )
+
+    @httpretty.activate
+    def test_plan_people_and_followers(self):
+        self.setup_locals()
+        self.setup_remotes()
+
+        Follow(following=self.alice,
+                follower=self.remotes['peter']).save()
+
+        has_local, hosts = _plan_delivery(
+                target_people = [
                     self.remotes['peter'],
+                    self.remotes['quentin'],
                     ],
+                target_followers_of = [self.alice],
+                )
+
+        self.assertFalse(has_local)
+
+        self.assertEqual(
+                hosts,
+                {
+                    'example.org': set([
+                        'https://example.org/people/peter/inbox',
+                        'https://example.org/people/quentin/inbox',
+                        ]),
+                    },
                 )
 
+    @httpretty.activate
+    def test_body_encoded_once(self):
+        self.setup_locals()
+        self.setup_remotes()
+
+        real_value = sombrero_models.OutgoingActivity.value
+        encodings = []
+
+        def counting_value(activity):
+            encodings.append(activity.pk)
+            return real_value.fget(activity)
+
+        with mock.patch.object(
+                sombrero_models.OutgoingActivity,
+                'value',
+                property(counting_value),
+                ):
+
+            with self.captureOnCommitCallbacks(execute=True):
+                deliver(
+                        activity = TEST_ACTIVITY,
+                        sender = self.alice,
+                        target_people = self.remotes.values(),
+                        )
+
         self.assertEqual(
                 self.received_post,
-                set(['quentin', 'robert']),
+                set(['peter', 'quentin', 'robert']),
+                )
+
+        self.assertEqual(
+                len(encodings),
+                1,
+                msg = "The activity was encoded once for all recipients",
+                )
+
+        posts = [x for x in httpretty.latest_requests()
+                if x.method=='POST']
+
+        self.assertEqual(
+                len(set([x.body for x in posts])),
+                1,
+                msg = "Every recipient got the same body",
+                )
+
+        activity = sombrero_models.OutgoingActivity.objects.get()
+
+        for post in posts:
+            self.assertEqual(post.headers['Digest'], activity.digest)
+            self.assertEqual(post.body, activity.wire_body)
+
+    @httpretty.activate
+    def test_signed_once(self):
+        self.setup_locals()
+        self.setup_remotes()
+
+        real_sign = httpsig.HeaderSigner.sign
+        signings = []
+
+        def counting_sign(signer, *args, **kwargs):
+            signings.append(kwargs.get('path'))
+            return real_sign(signer, *args, **kwargs)
+
+        with mock.patch.object(
+                httpsig.HeaderSigner,
+                'sign',
+                counting_sign,
+                ):
+
+            with self.captureOnCommitCallbacks(execute=True):
+                deliver(
+                        activity = TEST_ACTIVITY,
+                        sender = self.alice,
+                        target_people = self.remotes.values(),
+                        )
+
+        self.assertEqual(
+                sorted(signings),
+                [
+                    '/people/peter/inbox',
+                    '/people/quentin/inbox',
+                    '/people/robert/inbox',
+                    ],
+                msg = "Each request was signed exactly once",
+                )
+
+        for post in httpretty.latest_requests():
+            if post.method!='POST':
+                continue
+
+            self.assertIn(
+                    'headers="(request-target) host date content-type digest"',
+                    post.headers['Signature'],
+                    )
+
+    def test_signer_cache(self):
+        self.setup_locals()
+
+        first = _signer_for_localperson(self.alice)
+
+        self.assertIs(
+                _signer_for_localperson(self.alice),
+                first,
+                msg = "Signers are reused",
+                )
+
+        self.alice._generate_keys()
+        self.alice.save()
+
+        self.assertIsNot(
+                _signer_for_localperson(self.alice),
+                first,
+                msg = "Signers are replaced when the key changes",
+                )
+
+    def test_outbox_waits_for_commit(self):
+        self.setup_locals()
+
+        activity = deliver(
+                activity = TEST_ACTIVITY,
+                sender = self.alice,
+                target_people = [self.bob],
+                )
+
+        self.assertEqual(
+                self.received_post,
+                set(),
+                msg = "Nothing is sent before the commit",
+                )
+
+        self.assertIsNone(
+                activity.dispatched_at,
+                )
+
+        dispatch(activity.pk)
+        dispatch(activity.pk)
+
+        self.assertEqual(
+                len(self.created),
+                1,
+                msg = "Dispatching twice only delivers once",
+                )
+
+    @httpretty.activate
+    def test_dispatch_fails(self):
+        self.setup_locals()
+        self.setup_remotes()
+
+        activity = deliver(
+                activity = TEST_ACTIVITY,
+                sender = self.alice,
+                target_people = [self.bob, self.remotes['peter']],
+                )
+
+        with mock.patch(
+                'kepi.sombrero_sendpub.delivery._plan_delivery',
+                side_effect = ValueError("Something went wrong")):
+
+            with self.assertRaises(ValueError):
+                dispatch(activity.pk)
+
+        self.assertIsNone(
+                sombrero_models.OutgoingActivity.objects.get(
+                    pk = activity.pk,
+                    ).dispatched_at,
+                msg = "A failed dispatch isn't marked as dispatched",
+                )
+
+        self.assertFalse(
+                sombrero_models.Delivery.objects.exists(),
+                )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            dispatch(activity.pk)
+
+        self.assertIsNotNone(
+                sombrero_models.OutgoingActivity.objects.get(
+                    pk = activity.pk,
+                    ).dispatched_at,
+                )
+
+        self.assertEqual(
+                self.received_post,
+                set(['(local)', 'peter']),
+                msg = "The activity was dispatched the second time",
+                )
+
+    @httpretty.activate
+    def test_local_delivery_fails(self):
+        self.setup_locals()
+        self.setup_remotes()
+
+        activity = deliver(
+                activity = TEST_ACTIVITY,
+                sender = self.alice,
+                target_people = [self.bob, self.remotes['peter']],
+                )
+
+        with mock.patch(
+                'kepi.sombrero_sendpub.delivery._deliver_local',
+                side_effect = ValueError("Something went wrong")):
+
+            dispatch(activity.pk)
+
+        self.assertEqual(
+                list(sombrero_models.Delivery.objects.values_list(
+                    'inbox', flat=True)),
+                ['https://example.org/people/peter/inbox'],
+                msg = "Remote deliveries survive a failed local delivery",
+                )
+
+    def test_dispatch_outbox(self):
+        self.setup_locals()
+
+        stranded = deliver(
+                activity = TEST_ACTIVITY,
+                sender = self.alice,
+                target_people = [self.bob],
+                )
+
+        sombrero_models.OutgoingActivity.objects.filter(
+                pk = stranded.pk,
+                ).update(
+                        created_at = django.utils.timezone.now()-\
+                                datetime.timedelta(hours=1),
+                        )
+
+        recent = deliver(
+                activity = TEST_ACTIVITY,
+                sender = self.alice,
+                target_people = [self.carol],
+                )
+
+        dispatch_outbox()
+
+        self.assertEqual(
+                len(self.created),
+                1,
+                )
+
+        self.assertIsNotNone(
+                sombrero_models.OutgoingActivity.objects.get(
+                    pk = stranded.pk,
+                    ).dispatched_at,
+                )
+
+        self.assertIsNone(
+                sombrero_models.OutgoingActivity.objects.get(
+                    pk = recent.pk,
+                    ).dispatched_at,
+                msg = "Recent activities are left for their own task",
+                )
+
+    def test_coalesce(self):
+        self.setup_locals()
+
+        for name in ['Alice', 'Alice Liddell', 'Alice L.']:
+            with self.captureOnCommitCallbacks(execute=True):
+                deliver(
+                        activity = {
+                            'type': 'Update',
+                            'actor': 'alice@example.com',
+                            'object': {
+                                'type': 'Person',
+                                'name': name,
+                                },
+                            },
+                        sender = self.alice,
+                        target_people = [self.bob],
+                        coalesce = 'Update alice',
+                        delay = datetime.timedelta(seconds=60),
+                        )
+
+        self.assertEqual(self.created, [],
+                msg = "Nothing is sent until the window closes")
+
+        waiting = sombrero_models.OutgoingActivity.objects.get()
+
+        self.assertLessEqual(
+                waiting.not_before,
+                waiting.created_at + COALESCE_MAX,
+                )
+
+        dispatch_outbox()
+        self.assertEqual(self.created, [])
+
+        sombrero_models.OutgoingActivity.objects.update(
+                not_before = django.utils.timezone.now(),
+                )
+
+        dispatch_outbox()
+
+        self.assertEqual(
+                [x['object']['name'] for x in self.created],
+                ['Alice L.'],
+                msg = "Only the latest version is sent, once",
+                )
+
+class TestRetries(TestCase):
+
+    inbox = 'https://example.org/people/peter/inbox'
+
+    def _setup_people(self):
+        self.alice = create_local_person("alice")
+
+        self.peter = create_remote_person(
+                remote_url = 'https://example.org/people/peter',
+                name = 'peter',
+                auto_fetch = True,
+                )
+
+    def _deliver(self):
+        self._setup_people()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            deliver(
+                    activity = TEST_ACTIVITY,
+                    sender = self.alice,
+                    target_people = [self.peter],
+                    )
+
+        return sombrero_models.Delivery.objects.get(
+                inbox = self.inbox,
+                )
+
+    def _wind_clock_forward(self):
+        sombrero_models.Delivery.objects.update(
+                next_attempt = django.utils.timezone.now(),
+                )
+        sombrero_models.Instance.objects.update(
+                circuit_open_until = django.utils.timezone.now(),
+                throttled_until = django.utils.timezone.now(),
+                )
+
+    @httpretty.activate
+    def test_delivered(self):
+        mock_remote_object(self.inbox,
+                status = 202, as_post = True)
+
+        delivery = self._deliver()
+
+        self.assertEqual(delivery.state, delivery.DELIVERED)
+        self.assertEqual(delivery.attempts, 1)
+        self.assertEqual(delivery.last_status, 202)
+        self.assertEqual(delivery.activity.sender, self.alice)
+
+    @httpretty.activate
+    def test_gone(self):
+        mock_remote_object(self.inbox,
+                status = 410, as_post = True)
+
+        delivery = self._deliver()
+
+        self.assertEqual(delivery.state, delivery.FAILED)
+
+    @httpretty.activate
+    def test_retry_after(self):
+
+        httpretty.register_uri(
+                httpretty.POST,
+                self.inbox,
+                status = 503,
+                adding_headers = {
+                    'Retry-After': '7200',
+                    },
+                )
+
+        delivery = self._deliver()
+
+        self.assertEqual(delivery.state, delivery.PENDING)
+        self.assertGreater(
+                delivery.next_attempt,
+                django.utils.timezone.now() + datetime.timedelta(
+                    seconds = 7000),
+                )
+
+        retry_deliveries()
+        delivery.refresh_from_db()
+        self.assertEqual(delivery.attempts, 1,
+                msg = "Deliveries aren't retried before they're due")
+
+        self._wind_clock_forward()
+        httpretty.register_uri(
+                httpretty.POST,
+                self.inbox,
+                status = 202,
+                )
+
+        retry_deliveries()
+        delivery.refresh_from_db()
+        self.assertEqual(delivery.state, delivery.DELIVERED)
+        self.assertEqual(delivery.attempts, 2)
+
+    @httpretty.activate
+    def test_circuit_breaker(self):
+
+        attempts = []
+        mock_remote_object(self.inbox,
+                status = 500, as_post = True,
+                on_fetch = lambda: attempts.append(True),
+                )
+
+        delivery = self._deliver()
+
+        for i in range(sombrero_models.BREAKER_THRESHOLD-1):
+            self._wind_clock_forward()
+            retry_deliveries()
+
+        self.assertEqual(len(attempts),
+                sombrero_models.BREAKER_THRESHOLD)
+
+        instance = sombrero_models.Instance.objects.get(
+                hostname = 'example.org')
+        self.assertFalse(instance.is_available)
+
+        sombrero_models.Delivery.objects.update(
+                next_attempt = django.utils.timezone.now(),
+                )
+        retry_deliveries()
+
+        self.assertEqual(len(attempts),
+                sombrero_models.BREAKER_THRESHOLD,
+                msg = "Open circuit breaker stops deliveries")
+
+        self._wind_clock_forward()
+        mock_remote_object(self.inbox,
+                status = 202, as_post = True)
+        retry_deliveries()
+
+        delivery.refresh_from_db()
+        self.assertEqual(delivery.state, delivery.DELIVERED)
+
+        instance.refresh_from_db()
+        self.assertTrue(instance.is_available)
+        self.assertEqual(instance.error_streak, 0)
+
+    @httpretty.activate
+    def test_one_failure_per_round(self):
+
+        self.alice = create_local_person("alice")
+
+        people = []
+        for name in ['peter', 'quentin', 'robert']:
+            people.append(create_remote_person(
+                    remote_url = 'https://example.org/people/'+name,
+                    name = name,
+                    auto_fetch = True,
+                    ))
+
+            mock_remote_object(
+                    f'https://example.org/people/{name}/inbox',
+                    status = 503, as_post = True)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            deliver(
+                    activity = TEST_ACTIVITY,
+                    sender = self.alice,
+                    target_people = people,
+                    )
+
+        self.assertEqual(
+                sombrero_models.Delivery.objects.filter(
+                    last_status = 503).count(),
+                3)
+
+        instance = sombrero_models.Instance.objects.get(
+                hostname = 'example.org')
+        self.assertEqual(instance.error_streak, 1,
+                msg = "A failed round counts as one failure")
+
+    @httpretty.activate
+    def test_in_order(self):
+
+        httpretty.register_uri(
+                httpretty.POST,
+                self.inbox,
+                status = 503,
+                )
+
+        create = self._deliver()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            deliver(
+                    activity = {
+                        'type': 'Delete',
+                        'actor': 'alice@example.com',
+                        'object': TEST_ACTIVITY['id'],
+                        },
+                    sender = self.alice,
+                    target_people = [self.peter],
+                    )
+
+        delete = sombrero_models.Delivery.objects.exclude(
+                pk = create.pk,
+                ).get()
+
+        self.assertEqual(create.lane, delete.lane)
+        self.assertEqual(delete.attempts, 0,
+                msg = "Delete waits for the Create to be delivered")
+
+        self.assertEqual(
+                lane_depths(),
+                {(create.priority, create.lane): 2},
+                )
+
+        received = []
+
+        def receive(request, uri, headers):
+            received.append(json.loads(request.body)['type'])
+            return (202, headers, '')
+
+        self._wind_clock_forward()
+        httpretty.reset()
+        httpretty.register_uri(
+                httpretty.POST,
+                self.inbox,
+                body = receive,
+                )
+
+        retry_deliveries()
+
+        self.assertEqual(
+                received,
+                ['Create', 'Delete'],
+                )
+
+        self.assertEqual(lane_depths(), {})
+
+    @httpretty.activate
+    def test_too_many_requests(self):
+
+        httpretty.register_uri(
+                httpretty.POST,
+                self.inbox,
+                status = 429,
+                adding_headers = {
+                    'Retry-After': '600',
+                    },
+                )
+
+        delivery = self._deliver()
+
+        self.assertEqual(delivery.state, delivery.PENDING)
+
+        instance = sombrero_models.Instance.objects.get(
+                hostname = 'example.org')
+
+        self.assertEqual(instance.max_in_flight,
+                sombrero_models.DEFAULT_PER_HOST//2)
+        self.assertFalse(instance.is_available,
+                msg = "Retry-After holds the whole host")
+
+    @httpretty.activate
+    def test_interactive_overtakes_bulk(self):
+
+        received = []
+
+        def receive(request, uri, headers):
+            received.append(json.loads(request.body)['type'])
+            return (503, headers, '')
+
+        httpretty.register_uri(
+                httpretty.POST,
+                self.inbox,
+                body = receive,
+                )
+
+        bulk = self._deliver()
+        self.assertEqual(bulk.priority, sombrero_models.BULK)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            deliver(
+                    activity = {
+                        'type': 'Follow',
+                        'actor': 'alice@example.com',
+                        'object': self.peter.url,
+                        },
+                    sender = self.alice,
+                    target_people = [self.peter],
+                    )
+
+        self.assertEqual(received, ['Create', 'Follow'],
+                msg = "Interactive activities don't wait for bulk ones")
+
+    def _held_then_released(self, follow_up, priority):
+
+        with self.captureOnCommitCallbacks(execute=True):
+            message = deliver(
+                    activity = follow_up,
+                    sender = self.alice,
+                    target_people = [self.peter],
+                    )
+
+        self.assertEqual(message.priority, priority)
+
+        delivery = message.deliveries.get()
+        self.assertEqual(delivery.attempts, 0,
+                msg = "The follow-up waits for what it follows up")
+
+        received = []
+
+        def receive(request, uri, headers):
+            received.append(json.loads(request.body)['type'])
+            return (202, headers, '')
+
+        self._wind_clock_forward()
+        httpretty.reset()
+        httpretty.register_uri(
+                httpretty.POST,
+                self.inbox,
+                body = receive,
+                )
+
+        retry_deliveries()
+
+        return received
+
+    @httpretty.activate
+    def test_undo_waits_for_bulk(self):
+
+        httpretty.register_uri(
+                httpretty.POST,
+                self.inbox,
+                status = 503,
+                )
+
+        bulk = self._deliver()
+        self.assertEqual(bulk.priority, sombrero_models.BULK)
+
+        received = self._held_then_released({
+                        'type': 'Undo',
+                        'actor': 'alice@example.com',
+                        'object': {
+                            'type': 'Announce',
+                            'object': TEST_ACTIVITY['id'],
+                            },
+                        },
+                priority = sombrero_models.INTERACTIVE)
+
+        self.assertEqual(received, ['Create', 'Undo'])
+
+    @httpretty.activate
+    def test_delete_waits_for_interactive(self):
+
+        httpretty.register_uri(
+                httpretty.POST,
+                self.inbox,
+                status = 503,
+                )
+
+        self._setup_people()
+
+        reply = dict(TEST_ACTIVITY)
+        reply['object'] = dict(reply['object'],
+                inReplyTo = 'https://example.org/people/peter/1')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            interactive = deliver(
+                    activity = reply,
+                    sender = self.alice,
+                    target_people = [self.peter],
+                    )
+
+        self.assertEqual(interactive.priority,
+                sombrero_models.INTERACTIVE)
+
+        received = self._held_then_released({
+                        'type': 'Delete',
+                        'actor': 'alice@example.com',
+                        'object': TEST_ACTIVITY['id'],
+                        'to': ['https://www.w3.org/ns/activitystreams#Public'],
+                        },
+                priority = sombrero_models.BULK)
+
+        self.assertEqual(received, ['Create', 'Delete'])
+
+class TestThrottle(TestCase):
+
+    def setUp(self):
+        self.instance = sombrero_models.Instance(
+                hostname = 'example.org',
+                )
+        self.instance.save()
+
+    def test_grows_while_healthy(self):
+
+        start = self.instance.max_in_flight
+
+        for i in range(3):
+            self.instance.throttle([(202, 0.1), (202, 0.2)])
+
+        self.assertEqual(self.instance.max_in_flight, start+3)
+
+        for i in range(100):
+            self.instance.throttle([(202, 0.1)])
+
+        self.assertEqual(self.instance.max_in_flight,
+                sombrero_models.DEFAULT_PER_HOST_CEILING)
+
+    def test_shrinks_when_congested(self):
+
+        for i in range(4):
+            self.instance.throttle([(202, 0.1)])
+
+        self.assertEqual(self.instance.max_in_flight, 8)
+
+        self.instance.throttle([(202, 0.1), (503, 0.1)])
+        self.assertEqual(self.instance.max_in_flight, 4)
+
+        self.instance.throttle([(0, None)])
+        self.assertEqual(self.instance.max_in_flight, 2)
+
+        for i in range(10):
+            self.instance.throttle([(429, 0.1)])
+
+        self.assertEqual(self.instance.max_in_flight, 1)
+        self.assertTrue(self.instance.is_available,
+                msg = "Throttling without Retry-After doesn't stop us")
+
+    def test_slow(self):
+
+        start = self.instance.max_in_flight
+
+        self.instance.throttle([(202, sombrero_models.SLOW_RESPONSE*2)])
+
+        self.assertEqual(self.instance.max_in_flight, start,
+                msg = "Slow servers don't get more requests")
+
+    def test_workers_dont_clash(self):
+
+        # Two workers, each with their own copy of the Instance.
+        first = sombrero_models.Instance.objects.get(
+                hostname = 'example.org',
+                )
+        second = sombrero_models.Instance.objects.get(
+                hostname = 'example.org',
+                )
+
+        sombrero_models.Instance.objects.filter(
+                hostname = 'example.org',
+                ).update(
+                        shared_inbox = 'https://example.org/inbox',
+                        )
+
+        first.failed()
+        second.failed()
+        first.throttle([(503, 0.1)])
+        second.succeeded()
+        second.throttle([(202, 0.1)])
+
+        self.instance.refresh_from_db()
+
+        self.assertEqual(self.instance.shared_inbox,
+                'https://example.org/inbox',
+                msg = "Fields the workers didn't change are left alone")
+
+        self.assertEqual(self.instance.error_streak, 0)
+        self.assertIsNotNone(self.instance.last_failure)
+
+        first.failed()
+        self.instance.refresh_from_db()
+        self.assertEqual(self.instance.error_streak, 1,
+                msg = "Failures are counted in the database")
+
+    def test_failures_counted(self):
+
+        first = sombrero_models.Instance.objects.get(
+                hostname = 'example.org',
+                )
+        second = sombrero_models.Instance.objects.get(
+                hostname = 'example.org',
+                )
+
+        first.failed()
+        second.failed()
+
+        self.instance.refresh_from_db()
+        self.assertEqual(self.instance.error_streak, 2)
+        self.assertEqual(second.error_streak, 2)
+
+    def test_backoff_grows_per_trip(self):
+
+        sombrero_models.Instance.objects.filter(
+                hostname = 'example.org',
+                ).update(
+                        error_streak = sombrero_models.BREAKER_THRESHOLD-1,
+                        )
+        self.instance.refresh_from_db()
+
+        started = django.utils.timezone.now()
+
+        for i in range(20):
+            self.instance.failed()
+
+        self.instance.refresh_from_db()
+        self.assertEqual(self.instance.error_streak,
+                sombrero_models.BREAKER_THRESHOLD,
+                msg = "Failures while the breaker is open don't count")
+        self.assertLessEqual(self.instance.circuit_open_until,
+                django.utils.timezone.now() + sombrero_models._backoff(1),
+                msg = "The first trip gets the shortest backoff")
+
+        sombrero_models.Instance.objects.filter(
+                hostname = 'example.org',
+                ).update(
+                        circuit_open_until = started,
+                        )
+
+        self.instance.failed()
+
+        self.instance.refresh_from_db()
+        self.assertEqual(self.instance.error_streak,
+                sombrero_models.BREAKER_THRESHOLD+1)
+        self.assertGreater(self.instance.circuit_open_until,
+                django.utils.timezone.now() + sombrero_models._backoff(1),
+                msg = "The second trip gets a longer backoff")
+
+class TestLanes(TestCase):
+
+    def test_priority_of(self):
+
+        for activity, expected in [
+                (TEST_ACTIVITY, sombrero_models.BULK),
+                ({'type': 'Follow'}, sombrero_models.INTERACTIVE),
+                ({'type': 'Undo', 'object': {'type': 'Follow'}},
+                    sombrero_models.INTERACTIVE),
+                ({'type': 'Create',
+                    'to': ['https://www.w3.org/ns/activitystreams#Public'],
+                    'object': {'type': 'Note'}},
+                    sombrero_models.BULK),
+                ({'type': 'Create',
+                    'to': ['https://example.org/people/peter'],
+                    'object': {'type': 'Note'}},
+                    sombrero_models.INTERACTIVE),
+                ({'type': 'Create',
+                    'to': ['https://www.w3.org/ns/activitystreams#Public'],
+                    'object': {'type': 'Note',
+                        'inReplyTo': 'https://example.org/1'}},
+                    sombrero_models.INTERACTIVE),
+                ]:
+
+            self.assertEqual(
+                    priority_of(activity),
+                    expected,
+                    msg = str(activity),
+                    )
+
+    def test_lane_queue(self):
+
+        self.assertEqual(
+                lane_queue(sombrero_models.INTERACTIVE, 3),
+                'delivery-interactive-3',
+                )
+
+        self.assertEqual(
+                lane_queue(sombrero_models.BULK, 0),
+                'delivery-bulk-0',
+                )
+
+    def test_lane_for(self):
+
+        lanes = set()
+
+        for i in range(100):
+            hostname = 'host%d.example.org' % (i,)
+
+            lane = sombrero_models.lane_for(hostname)
+            self.assertEqual(lane,
+                    sombrero_models.lane_for(hostname.upper()))
+            lanes.add(lane)
+
+        self.assertEqual(
+                lanes,
+                set(range(sombrero_models.DEFAULT_LANES)),
+                msg = "Hosts are spread across every lane",
                 )
+
+@skipUnlessDBFeature('has_select_for_update_skip_locked')
+class TestLaneLocking(TransactionTestCase):
+
+    def test_two_workers(self):
+
+        inbox = 'https://example.org/people/peter/inbox'
+        lane = sombrero_models.lane_for('example.org')
+
+        for i in range(2):
+            activity = sombrero_models.OutgoingActivity.objects.create(
+                    content = json.dumps(TEST_ACTIVITY),
+                    )
+            sombrero_models.Delivery.objects.create(
+                    activity = activity,
+                    inbox = inbox,
+                    lane = lane,
+                    )
+
+        found = {}
+
+        def second_worker():
+            try:
+                with transaction.atomic():
+                    found['second'] = _next_in_lane(
+                            sombrero_models.BULK, lane, 10)
+            finally:
+                connection.close()
+
+        with transaction.atomic():
+            first = _next_in_lane(sombrero_models.BULK, lane, 10)
+
+            worker = threading.Thread(target=second_worker)
+            worker.start()
+            worker.join()
+
+        self.assertEqual(len(first), 1,
+                msg = "The later activity waits for the earlier one")
+        self.assertEqual(found['second'], [],
+                msg = "The second worker doesn't take the locked "
+                    "Delivery, or overtake it")
@@ -0,0 +1,287 @@
+# test_engine.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from django.test import SimpleTestCase, override_settings
+from django.conf import settings
+from unittest.mock import patch
+from kepi.sombrero_sendpub.engine import DeliveryEngine
+import kepi.sombrero_sendpub.engine as engine_module
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import requests
+import time
+
+SLOW_RESPONSE = 0.1
+INBOX_COUNT = 20
+
+class _StandIn(object):
+    """
+    A stand-in for a remote server, running on localhost.
+
+    It waits SLOW_RESPONSE seconds before replying to each
+    POST, and keeps track of how many requests it was
+    handling at once.
+    """
+
+    def __init__(self):
+
+        standin = self
+        self.received = []
+        self.received_at = []
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self.lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
+
+                with standin.lock:
+                    standin.in_flight += 1
+                    standin.most_in_flight = max(
+                            standin.most_in_flight,
+                            standin.in_flight)
+                    standin.received.append((self.path, body))
+                    standin.received_at.append(time.monotonic())
+
+                time.sleep(SLOW_RESPONSE)
+
+                with standin.lock:
+                    standin.in_flight -= 1
+
+                self.send_response(202)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % (self.server.server_port,)
+
+        self.thread = threading.Thread(
+                target = self.server.serve_forever,
+                daemon = True,
+                )
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class Tests(SimpleTestCase):
+
+    def setUp(self):
+        self.standin = _StandIn()
+        self.inboxes = [
+                '%s/users/%d/inbox' % (self.standin.url, i)
+                for i in range(INBOX_COUNT)
+                ]
+
+    def tearDown(self):
+        self.standin.close()
+
+    def test_deliver(self):
+
+        engine = DeliveryEngine(
+                max_connections = 8,
+                max_per_host = 4,
+                )
+
+        responses = engine.deliver(
+                inboxes = self.inboxes,
+                body = b'{"type": "Create"}',
+                prepare = lambda inbox: {
+                    'content-type': 'application/activity+json',
+                    },
+                )
+
+        self.assertEqual(
+                sorted(responses.keys()),
+                sorted(self.inboxes),
+                )
+
+        for inbox, response in responses.items():
+            self.assertEqual(response.status_code, 202,
+                    msg = inbox)
+
+        self.assertEqual(
+                len(self.standin.received),
+                INBOX_COUNT,
+                )
+
+        self.assertLessEqual(
+                self.standin.most_in_flight,
+                4,
+                msg = "Per-host limit was honoured",
+                )
+
+    def test_per_host(self):
+
+        engine = DeliveryEngine(
+                max_connections = 8,
+                max_per_host = 4,
+                )
+
+        engine.deliver(
+                inboxes = self.inboxes,
+                body = b'{}',
+                prepare = lambda inbox: {},
+                per_host = {
+                    '127.0.0.1:%d' % (self.standin.server.server_port,): 1,
+                    },
+                )
+
+        self.assertEqual(
+                len(self.standin.received),
+                INBOX_COUNT,
+                )
+
+        self.assertEqual(
+                self.standin.most_in_flight,
+                1,
+                msg = "Limit for the host was honoured",
+                )
+
+    def test_slow_host_doesnt_block_others(self):
+
+        other = _StandIn()
+        self.addCleanup(other.close)
+
+        engine = DeliveryEngine(
+                max_connections = 2,
+                max_per_host = 4,
+                )
+
+        started = time.monotonic()
+
+        engine.deliver(
+                inboxes = self.inboxes[:10] + [other.url+'/inbox'],
+                body = b'{}',
+                prepare = lambda inbox: {},
+                per_host = {
+                    '127.0.0.1:%d' % (self.standin.server.server_port,): 1,
+                    },
+                )
+
+        # If posts waiting for the first host held on to the
+        # overall limit, the other host would wait for all ten.
+        self.assertLess(
+                other.received_at[0] - started,
+                SLOW_RESPONSE*5,
+                )
+
+    def test_sessions_limited(self):
+
+        kepi_settings = settings.KEPI.copy()
+        kepi_settings['DELIVERY_MAX_SESSIONS'] = 2
+
+        with override_settings(KEPI=kepi_settings), \
+                patch.object(engine_module, '_sessions',
+                        engine_module.OrderedDict()):
+
+            first = engine_module._session_for('a.example', 1)
+
+            with patch.object(first, 'close') as close:
+                engine_module._session_for('b.example', 1)
+                engine_module._session_for('a.example', 1)
+                engine_module._session_for('c.example', 1)
+
+                self.assertFalse(close.called,
+                        msg = "Recently used sessions are kept")
+
+                engine_module._session_for('d.example', 1)
+
+                self.assertTrue(close.called,
+                        msg = "The least recently used session is closed")
+
+            self.assertEqual(
+                    list(engine_module._sessions.keys()),
+                    ['c.example', 'd.example'],
+                    )
+
+    def test_cannot_connect(self):
+
+        self.standin.close()
+
+        engine = DeliveryEngine()
+
+        responses = engine.deliver(
+                inboxes = self.inboxes[:2],
+                body = b'{}',
+                prepare = lambda inbox: {},
+                )
+
+        self.assertEqual(
+                responses,
+                dict([(x, None) for x in self.inboxes[:2]]),
+                )
+
+    def test_bad_inbox(self):
+
+        engine = DeliveryEngine()
+
+        bad = [
+                'ftp://127.0.0.1/inbox',
+                'https://127.0.0.1:notaport/inbox',
+                'https:///inbox',
+                ]
+
+        responses = engine.deliver(
+                inboxes = self.inboxes[:2] + bad,
+                body = b'{}',
+                prepare = lambda inbox: {},
+                )
+
+        for inbox in self.inboxes[:2]:
+            self.assertEqual(responses[inbox].status_code, 202,
+                    msg = "Good inboxes are delivered to anyway")
+
+        for inbox in bad:
+            self.assertIsNone(responses[inbox],
+                    msg = inbox)
+
+    def test_faster_than_serial(self):
+
+        started = time.monotonic()
+
+        for inbox in self.inboxes:
+            requests.post(inbox, data=b'{}')
+
+        serial = time.monotonic() - started
+
+        engine = DeliveryEngine(
+                max_connections = INBOX_COUNT,
+                max_per_host = INBOX_COUNT,
+                )
+
+        started = time.monotonic()
+
+        engine.deliver(
+                inboxes = self.inboxes,
+                body = b'{}',
+                prepare = lambda inbox: {},
+                )
+
+        parallel = time.monotonic() - started
+
+        logger.info('fan-out to %d inboxes: serial %.3fs, engine %.3fs',
+                INBOX_COUNT, serial, parallel)
+
+        # Sending them one at a time can't possibly take less
+        # than this, however fast the machine is. Comparing against
+        # the time we measured for "serial" is flaky under load.
+        self.assertLess(
+                parallel,
+                INBOX_COUNT*SLOW_RESPONSE/2,
+                )
@@ -8,17 +8,28 @@ import logging
 logger = logging.getLogger(name="kepi")
 
 from unittest import skip
+from unittest.mock import patch
 from django.conf import settings
-from kepi.sombrero_sendpub.fetch import fetch
+from django.test import override_settings
+from kepi.sombrero_sendpub.fetch import fetch, fetch_many, prefetch
+from kepi.bowler_pub.tests import create_remote_person, mock_remote_object
 from kepi.trilby_api.models import RemotePerson, Person, Status
-from kepi.trilby_api.tests import create_local_person
+from kepi.trilby_api.tests import create_local_person, create_local_status
 from kepi.sombrero_sendpub.collections import Collection
 from kepi.kepi.testing import KepiTestCase
+import kepi.sombrero_sendpub.models as sombrero_models
+import kepi.sombrero_sendpub.outbound as outbound
+import django.utils.timezone
 from . import suppress_thread_exceptions
 import httpretty
+import threading
 import requests
+import time
 
 EXAMPLE_USER_URL = "https://example.org/users/wombat"
+
+MANY_COUNT = 10
+SLOW_FETCH = 0.3
 EXAMPLE_ATSTYLE = "wombat@example.org"
 
 EXAMPLE_USER_RESULT = """{"@context":["https://www.w3.org/ns/activitystreams",
@@ -118,10 +129,12 @@ EXAMPLE_SIMPLE_COLLECTION = """{
 "orderedItems": ["apple", "banana", "coconut", "damson", "elderberry"]
 }""" % (EXAMPLE_SIMPLE_COLLECTION_URL,)
 
-EXAMPLE_COMPLEX_COLLECTION_MEMBERS = sorted([
+EXAMPLE_COMPLEX_COLLECTION_IN_ORDER = [
     "Bolton", "Bury", "Oldham", "Manchester", "Rochdale",
     "Salford", "Stockport", "Tameside", "Trafford", "Wigan"
-        ])
+        ]
+EXAMPLE_COMPLEX_COLLECTION_MEMBERS = sorted(
+        EXAMPLE_COMPLEX_COLLECTION_IN_ORDER)
 EXAMPLE_COMPLEX_COLLECTION_URL = "https://example.com/boroughs"
 EXAMPLE_COMPLEX_COLLECTION = """{
 "@context":"https://www.w3.org/ns/activitystreams",
@@ -204,6 +217,72 @@ class TestFetchRemoteUser(KepiTestCase):
                 user,
                 )
 
+    @httpretty.activate
+    def test_fetch_failure_backoff(self):
+
+        requested = []
+
+        def not_found(request, uri, headers):
+            requested.append(uri)
+            return 404, headers, 'nope'
+
+        httpretty.register_uri(
+                'GET',
+                EXAMPLE_USER_URL,
+                body = not_found,
+                )
+
+        for i in range(3):
+            self.assertIsNone(
+                    fetch(EXAMPLE_USER_URL, RemotePerson),
+                    )
+
+        self.assertEqual(len(requested), 1,
+                msg = "We don't ask again while the failure is current")
+
+        failure = sombrero_models.Failure.objects.get(
+                url = EXAMPLE_USER_URL,
+                )
+        self.assertEqual(failure.count, 1)
+        self.assertEqual(failure.status, 404)
+
+        again = sombrero_models.Failure.record(
+                url = EXAMPLE_USER_URL,
+                status = 404,
+                )
+        self.assertEqual(again.count, 2)
+        self.assertGreater(again.retry_after, failure.retry_after,
+                msg = "We wait longer after each failure")
+        self.assertEqual(
+                sombrero_models.Failure.objects.filter(
+                    url = EXAMPLE_USER_URL).count(),
+                1)
+
+        sombrero_models.Failure.objects.filter(
+                url = EXAMPLE_USER_URL,
+                ).update(
+                        retry_after = django.utils.timezone.now(),
+                        )
+
+        httpretty.reset()
+        httpretty.register_uri(
+                'GET',
+                EXAMPLE_USER_URL,
+                status=200,
+                headers = {
+                        'Content-Type': 'application/activity+json',
+                        },
+                body = EXAMPLE_USER_RESULT,
+                )
+
+        user = fetch(EXAMPLE_USER_URL, RemotePerson)
+        self._asserts_for_example_user(user)
+
+        self.assertFalse(
+                sombrero_models.Failure.objects.filter(
+                    url = EXAMPLE_USER_URL).exists(),
+                msg = "The failure is forgotten once they're back")
+
     @httpretty.activate
     def test_fetch_410(self):
         httpretty.register_uri(
@@ -223,6 +302,113 @@ class TestFetchRemoteUser(KepiTestCase):
                 user,
                 )
 
+    def test_lease(self):
+
+        FetchLease = sombrero_models.FetchLease
+
+        self.assertTrue(FetchLease.acquire(EXAMPLE_USER_URL, 'alice'))
+        self.assertFalse(FetchLease.acquire(EXAMPLE_USER_URL, 'bob'))
+        self.assertTrue(FetchLease.is_held(EXAMPLE_USER_URL))
+
+        FetchLease.release(EXAMPLE_USER_URL, 'bob')
+        self.assertTrue(FetchLease.is_held(EXAMPLE_USER_URL),
+                msg = "Only the holder can release a lease")
+
+        FetchLease.release(EXAMPLE_USER_URL, 'alice')
+        self.assertFalse(FetchLease.is_held(EXAMPLE_USER_URL))
+
+        self.assertTrue(FetchLease.acquire(EXAMPLE_USER_URL, 'alice'))
+        FetchLease.objects.update(
+                expires = django.utils.timezone.now(),
+                )
+        self.assertTrue(FetchLease.acquire(EXAMPLE_USER_URL, 'bob'),
+                msg = "Leases which have run out can be taken over")
+
+    @httpretty.activate
+    def test_fetch_leased(self):
+        httpretty.register_uri(
+                'GET',
+                EXAMPLE_USER_URL,
+                status=200,
+                headers = {
+                        'Content-Type': 'application/activity+json',
+                        },
+                body = EXAMPLE_USER_RESULT,
+                )
+
+        sombrero_models.FetchLease.acquire(EXAMPLE_USER_URL, 'elsewhere')
+
+        with patch('kepi.sombrero_sendpub.fetch.LEASE_WAIT', 0.2):
+            user = fetch(EXAMPLE_USER_URL,
+                    RemotePerson)
+
+        self._asserts_for_example_user(user)
+
+        self.assertEqual(
+                list(sombrero_models.FetchLease.objects.values_list(
+                    'holder', flat=True)),
+                ['elsewhere'],
+                msg = "We only release our own leases")
+
+        sombrero_models.FetchLease.objects.all().delete()
+
+        self.assertIsNotNone(fetch(
+            'https://example.org/users/wombat',
+            RemotePerson,
+            ))
+
+        self.assertFalse(
+                sombrero_models.FetchLease.objects.exists(),
+                msg = "Leases are released after fetching")
+
+    @httpretty.activate
+    def test_fetch_leased_failure(self):
+        httpretty.register_uri(
+                'GET',
+                EXAMPLE_USER_URL,
+                status=200,
+                headers = {
+                        'Content-Type': 'application/activity+json',
+                        },
+                body = EXAMPLE_USER_RESULT,
+                )
+
+        sombrero_models.FetchLease.acquire(EXAMPLE_USER_URL, 'elsewhere')
+
+        def other_worker_fails(address):
+            # While we wait, the holder gets a 404, and gives up.
+            sombrero_models.Failure.record(
+                    url = address,
+                    status = 404,
+                    )
+            sombrero_models.FetchLease.release(address, 'elsewhere')
+            return False
+
+        with patch.object(sombrero_models.FetchLease, 'is_held',
+                side_effect = other_worker_fails):
+            user = fetch(EXAMPLE_USER_URL,
+                    RemotePerson)
+
+        self.assertIsNone(user)
+        self.assertEqual(httpretty.latest_requests(), [],
+                msg = "We believe the Failure the holder recorded")
+
+    def test_lease_duration(self):
+
+        self.assertGreater(
+                sombrero_models.lease_duration().total_seconds(),
+                outbound.longest_get(),
+                msg = "A lease outlasts the slowest possible fetch")
+
+        kepi_settings = settings.KEPI.copy()
+        kepi_settings['OUTBOUND_TOTAL_TIMEOUT'] = 300
+
+        with override_settings(KEPI=kepi_settings):
+            self.assertGreater(
+                    sombrero_models.lease_duration().total_seconds(),
+                    300,
+                    msg = "Leases grow with the outbound timeouts")
+
     @httpretty.activate
     def test_fetch_timeout(self):
 
@@ -391,6 +577,13 @@ class TestFetchRemoteUser(KepiTestCase):
                 body = "never heard of them",
                 )
 
+        httpretty.register_uri(
+                'GET',
+                'https://example.org/.well-known/host-meta',
+                status=404,
+                body = "no host-meta either",
+                )
+
         fetch(EXAMPLE_ATSTYLE,
                 RemotePerson)
 
@@ -527,6 +720,221 @@ class TestFetchRemoteUser(KepiTestCase):
                 len(EXAMPLE_COMPLEX_COLLECTION_MEMBERS),
                 msg="Collection has a length")
 
+    def _register_complex_collection(self, page_2=None):
+
+        # Connections kept alive from earlier tests confuse httpretty.
+        outbound.close_sessions()
+
+        for suffix, body in [
+                ('', EXAMPLE_COMPLEX_COLLECTION),
+                ('/1', EXAMPLE_COMPLEX_COLLECTION_PAGE_1),
+                ('/2', page_2 or EXAMPLE_COMPLEX_COLLECTION_PAGE_2),
+                ]:
+            httpretty.register_uri(
+                    'GET',
+                    EXAMPLE_COMPLEX_COLLECTION_URL+suffix,
+                    status=200,
+                    headers = {
+                        'Content-Type': 'application/activity+json',
+                        },
+                    body = body,
+                    )
+
+        return fetch(EXAMPLE_COMPLEX_COLLECTION_URL,
+                expected_type = Collection)
+
+    def _pages_requested(self):
+        return [request.path for request in httpretty.latest_requests()
+                if request.path.startswith('/boroughs/')]
+
+    @httpretty.activate
+    def test_collection_limit(self):
+        collection = self._register_complex_collection()
+
+        self.assertEqual(
+                list(collection.iterate(limit=3)),
+                EXAMPLE_COMPLEX_COLLECTION_IN_ORDER[:3],
+                )
+
+        self.assertEqual(
+                self._pages_requested(),
+                ['/boroughs/1'],
+                msg = "Pages past the limit aren't fetched",
+                )
+
+        self.assertEqual(
+                list(collection.iterate(limit=7)),
+                EXAMPLE_COMPLEX_COLLECTION_IN_ORDER[:7],
+                )
+
+    @httpretty.activate
+    def test_collection_prefetch(self):
+
+        page_2_requested = threading.Event()
+
+        def page_2(request, uri, headers):
+            page_2_requested.set()
+            return (200, headers, EXAMPLE_COMPLEX_COLLECTION_PAGE_2)
+
+        collection = self._register_complex_collection(page_2)
+
+        # httpretty's callback bodies are written by a thread
+        # which can complain when we've already finished reading.
+        with suppress_thread_exceptions():
+            iterator = iter(collection)
+            found = [next(iterator)]
+
+            self.assertTrue(
+                    page_2_requested.wait(2),
+                    msg = "Page 2 is fetched while we're still reading page 1",
+                    )
+
+            found.extend(iterator)
+
+        self.assertEqual(found,
+                EXAMPLE_COMPLEX_COLLECTION_IN_ORDER)
+
+        self.assertEqual(
+                self._pages_requested(),
+                ['/boroughs/1', '/boroughs/2'],
+                msg = "Prefetched page isn't fetched again",
+                )
+
+    @httpretty.activate
+    def test_collection_close(self):
+        collection = self._register_complex_collection()
+
+        iterator = collection.iterate(prefetch=False)
+        self.assertEqual(next(iterator),
+                EXAMPLE_COMPLEX_COLLECTION_IN_ORDER[0])
+
+        iterator.close()
+
+        self.assertEqual(list(iterator), [])
+        self.assertEqual(self._pages_requested(), ['/boroughs/1'])
+
+    @httpretty.activate
+    def test_collection_loop(self):
+        collection = self._register_complex_collection(
+                EXAMPLE_COMPLEX_COLLECTION_PAGE_2.replace(
+                    '"prev":"%s/2"' % (EXAMPLE_COMPLEX_COLLECTION_URL,),
+                    '"next":"%s/1"' % (EXAMPLE_COMPLEX_COLLECTION_URL,),
+                    ))
+
+        with patch('kepi.sombrero_sendpub.fetch.prefetch',
+                wraps = prefetch) as prefetching:
+
+            self.assertEqual(
+                    list(collection),
+                    EXAMPLE_COMPLEX_COLLECTION_IN_ORDER,
+                    msg = "A page which points back to an earlier one "
+                        "doesn't make us go round forever",
+                    )
+
+        self.assertEqual(
+                [call.args[0] for call in prefetching.call_args_list],
+                [
+                    EXAMPLE_COMPLEX_COLLECTION_URL+'/1',
+                    EXAMPLE_COMPLEX_COLLECTION_URL+'/2',
+                    ],
+                msg = "A page we've already seen isn't prefetched again",
+                )
+
+    @httpretty.activate
+    def test_collection_not_started(self):
+        collection = self._register_complex_collection()
+
+        with patch('kepi.sombrero_sendpub.fetch.prefetch') as prefetching:
+            iterator = iter(collection)
+
+        self.assertFalse(prefetching.called,
+                msg = "Nothing is prefetched until we start iterating")
+        self.assertEqual(self._pages_requested(), [])
+
+class TestFetchMany(KepiTestCase):
+
+    def _people(self, count):
+        return ['https://example.org/users/wombat%d' % (i,)
+                for i in range(count)]
+
+    @httpretty.activate
+    def test_known(self):
+
+        people = self._people(5)
+
+        for i, url in enumerate(people):
+            create_remote_person(url, name='wombat%d' % (i,),
+                    auto_fetch = True)
+
+        with self.assertNumQueries(2):
+            found = fetch_many(people, Person)
+
+        self.assertEqual(
+                sorted([x.url for x in found.values()]),
+                sorted(people),
+                )
+
+    @httpretty.activate
+    def test_unknown(self):
+
+        people = self._people(MANY_COUNT)
+
+        lock = threading.Lock()
+        in_flight = [0]
+        most_in_flight = [0]
+
+        def slow_fetch():
+            with lock:
+                in_flight[0] += 1
+                most_in_flight[0] = max(most_in_flight[0], in_flight[0])
+
+            time.sleep(SLOW_FETCH)
+
+            with lock:
+                in_flight[0] -= 1
+
+        for i, url in enumerate(people):
+            create_remote_person(url, name='wombat%d' % (i,),
+                    on_fetch = slow_fetch)
+
+        mock_remote_object('https://example.org/users/gone',
+                status = 410)
+
+        found = fetch_many(
+                people + [None, people[0], 'https://example.org/users/gone'],
+                Person)
+
+        self.assertEqual(len(found), MANY_COUNT+1)
+        self.assertIsNone(found['https://example.org/users/gone'])
+
+        for url in people:
+            self.assertEqual(found[url].url, url)
+            self.assertTrue(RemotePerson.objects.filter(
+                remote_url = url).exists())
+
+        logger.info('fetch_many of %d people: at most %d at once',
+                MANY_COUNT, most_in_flight[0])
+
+        # Timing the whole thing is flaky under load; seeing
+        # the fetches overlap isn't.
+        self.assertGreater(most_in_flight[0], 1,
+                msg = "They were fetched in parallel")
+
+    @httpretty.activate
+    def test_failed_lately(self):
+
+        url = self._people(1)[0]
+
+        create_remote_person(url, name='wombat')
+
+        sombrero_models.Failure.record(
+                url = url,
+                status = 404,
+                )
+
+        self.assertEqual(fetch_many([url], Person),
+                {url: None})
+
 class TestFetchLocalUser(KepiTestCase):
 
     def setUp(self):
@@ -569,6 +977,18 @@ class TestFetchLocalUser(KepiTestCase):
                 None,
                 )
 
+    def test_url_one_query(self):
+
+        with patch('django.urls.resolve') as resolve, \
+                self.assertNumQueries(1):
+
+            found = fetch('https://testserver/users/alice',
+                    expected_type = Person)
+
+        self.assertEqual(found, self._alice)
+        self.assertFalse(resolve.called,
+                msg = "Local people are found without the views")
+
     @httpretty.activate
     def test_url_404(self):
         found = fetch('https://testserver/users/bob',
@@ -590,4 +1010,78 @@ class TestFetchLocalUser(KepiTestCase):
                 )
 
 class TestFetchStatus(KepiTestCase):
-    pass
+
+    def setUp(self):
+        super().setUp()
+        settings.KEPI['LOCAL_OBJECT_HOSTNAME'] = 'testserver'
+        self._alice = create_local_person(
+                name = 'alice',
+                )
+        self._status = create_local_status(
+                posted_by = self._alice,
+                )
+
+    def test_url(self):
+
+        self.assertEqual(self._status.url_denormed,
+                'https://testserver/users/alice/%d' % (self._status.id,))
+
+        with patch('django.urls.resolve') as resolve, \
+                self.assertNumQueries(1):
+
+            found = fetch(self._status.url,
+                    expected_type = Status)
+
+        self.assertEqual(found, self._status)
+        self.assertFalse(resolve.called,
+                msg = "Local statuses are found without the views")
+
+    def test_url_404(self):
+
+        found = fetch('https://testserver/users/alice/%d' % (
+            self._status.id+1000,),
+            expected_type = Status)
+
+        self.assertIsNone(found)
+
+    def test_url_wrong_user(self):
+
+        create_local_person(name = 'bob')
+
+        found = fetch('https://testserver/users/bob/%d' % (
+            self._status.id,),
+            expected_type = Status)
+
+        self.assertIsNone(found)
+
+    def test_url_wrong_type(self):
+
+        found = fetch(self._status.url,
+                expected_type = Person)
+
+        self.assertIsNone(found)
+
+    def test_lookup(self):
+
+        with self.assertNumQueries(1):
+            self.assertEqual(Status.lookup(self._status.url),
+                    self._status)
+
+        remote = Status(
+                remote_url = 'https://example.org/statuses/1',
+                account = self._alice,
+                content_source = 'Hello world',
+                )
+        remote.save()
+
+        self.assertEqual(remote.url_denormed, remote.remote_url)
+        self.assertEqual(Status.lookup(remote.remote_url), remote)
+        self.assertIsNone(Status.lookup('https://example.org/statuses/2'))
+
+    def test_username_changed(self):
+
+        self._alice.username = 'alicia'
+
+        self.assertEqual(Status.lookup(
+            'https://testserver/users/alicia/%d' % (self._status.id,)),
+            self._status)
@@ -0,0 +1,100 @@
+# test_flight.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from django.test import SimpleTestCase
+from kepi.sombrero_sendpub.flight import SingleFlight
+import threading
+import time
+
+THREAD_COUNT = 10
+
+class Tests(SimpleTestCase):
+
+    def _run_together(self, flights, fn):
+
+        results = []
+        errors = []
+
+        def caller():
+            try:
+                results.append(flights.do('wombat', fn))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=caller)
+                for i in range(THREAD_COUNT)]
+
+        for thread in threads:
+            thread.start()
+
+        return threads, results, errors
+
+    def _wait_for_waiters(self, flights):
+        for i in range(100):
+            if flights.shared == THREAD_COUNT-1:
+                return
+            time.sleep(0.01)
+
+        self.fail("Callers didn't all arrive")
+
+    def test_shared_result(self):
+
+        flights = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def work():
+            calls.append(1)
+            release.wait()
+            return 'numbat'
+
+        threads, results, errors = self._run_together(flights, work)
+        self._wait_for_waiters(flights)
+        self.assertEqual(flights.in_flight(), 1)
+
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['numbat']*THREAD_COUNT)
+        self.assertEqual(errors, [])
+        self.assertEqual(flights.in_flight(), 0)
+
+    def test_shared_exception(self):
+
+        flights = SingleFlight()
+        release = threading.Event()
+
+        def work():
+            release.wait()
+            raise ValueError('no wombats here')
+
+        threads, results, errors = self._run_together(flights, work)
+        self._wait_for_waiters(flights)
+
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), THREAD_COUNT)
+
+    def test_one_after_another(self):
+
+        flights = SingleFlight()
+        calls = []
+
+        def work():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(flights.do('wombat', work), 1)
+        self.assertEqual(flights.do('wombat', work), 2,
+                msg = "Only calls at the same time are shared")
@@ -0,0 +1,241 @@
+# test_keys.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+import logging
+logger = logging.getLogger(name="kepi")
+
+from django.test import TransactionTestCase
+from kepi.bowler_pub.tests import create_remote_person, \
+        mock_remote_object, remote_user
+from kepi.bowler_pub.utils import as_json
+from kepi.sombrero_sendpub.keys import KeyCache, key_cache
+from kepi.sombrero_sendpub.cache import fetch_cache
+from kepi.sombrero_sendpub.fetch import fetch
+from kepi.trilby_api.models import RemotePerson
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+from Crypto.Hash import SHA256
+import httpretty
+import json
+
+REMOTE_FRED = 'https://remote.example.org/users/fred'
+FREDS_KEY = REMOTE_FRED+'#main-key'
+
+def _keys(number):
+    return json.load(open(
+        'kepi/bowler_pub/tests/keys/keys-%04d.json' % (number,), 'r'))
+
+def _made_by(key, private):
+    """
+    Returns True iff the VerificationKey "key" is the public half
+    of the PEM-encoded private key "private".
+    """
+    digest = SHA256.new(b'Wombats are marsupials.')
+    signed = PKCS1_v1_5.new(RSA.importKey(private)).sign(digest)
+    return key.verifier.verify(digest, signed)
+
+class Tests(TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        fetch_cache.clear()
+        key_cache.clear()
+
+    @httpretty.activate
+    def test_cached(self):
+
+        create_remote_person(
+                remote_url = REMOTE_FRED,
+                name = 'fred',
+                publicKey = _keys(1)['public'],
+                )
+
+        cache = KeyCache(size=10)
+
+        key = cache.get(FREDS_KEY)
+        self.assertEqual(key.owner, REMOTE_FRED)
+        self.assertTrue(_made_by(key, _keys(1)['private']))
+
+        httpretty.latest_requests().clear()
+
+        with self.assertNumQueries(0):
+            self.assertIs(cache.get(FREDS_KEY), key,
+                    msg = "The second lookup comes from the cache")
+
+        self.assertEqual(httpretty.latest_requests(), [])
+
+    @httpretty.activate
+    def test_key_elsewhere(self):
+
+        key_id = 'https://remote.example.org/keys/fred'
+
+        fields = remote_user(
+                remote_url = REMOTE_FRED,
+                name = 'fred',
+                publicKey = _keys(1)['public'],
+                )
+        fields['publicKey']['id'] = key_id
+
+        mock_remote_object(
+                remote_url = REMOTE_FRED,
+                content = as_json(fields),
+                )
+
+        cache = KeyCache(size=10)
+
+        self.assertIsNone(cache.get(key_id),
+                msg = "We can't find a key by itself if we don't know "
+                    "who owns it")
+
+        key = cache.get(key_id,
+                actor = REMOTE_FRED,
+                )
+        self.assertEqual(key.owner, REMOTE_FRED)
+
+        cache.clear()
+
+        key = cache.get(key_id)
+        self.assertEqual(key.owner, REMOTE_FRED,
+                msg = "Once we know who owns a key, we can find it again")
+
+    @httpretty.activate
+    def test_wrong_key(self):
+
+        create_remote_person(
+                remote_url = REMOTE_FRED,
+                name = 'fred',
+                )
+
+        cache = KeyCache(size=10)
+
+        self.assertIsNone(cache.get(REMOTE_FRED+'#some-other-key'))
+
+    @httpretty.activate
+    def test_refresh(self):
+
+        create_remote_person(
+                remote_url = REMOTE_FRED,
+                name = 'fred',
+                publicKey = _keys(1)['public'],
+                auto_fetch = True,
+                )
+
+        cache = KeyCache(size=10)
+
+        self.assertTrue(_made_by(cache.get(FREDS_KEY),
+            _keys(1)['private']))
+
+        create_remote_person(
+                remote_url = REMOTE_FRED,
+                name = 'fred',
+                publicKey = _keys(2)['public'],
+                )
+
+        self.assertTrue(_made_by(cache.get(FREDS_KEY),
+            _keys(1)['private']),
+            msg = "Without refresh, we use the key we know")
+
+        key = cache.get(FREDS_KEY,
+                refresh = True,
+                )
+        self.assertTrue(_made_by(key, _keys(2)['private']),
+                msg = "With refresh, we find the new key")
+
+        self.assertTrue(_made_by(cache.get(FREDS_KEY),
+            _keys(2)['private']),
+            msg = "The new key is cached")
+
+    @httpretty.activate
+    def test_refresh_limited(self):
+
+        create_remote_person(
+                remote_url = REMOTE_FRED,
+                name = 'fred',
+                auto_fetch = True,
+                )
+
+        cache = KeyCache(size=10,
+                refetch_interval = 60,
+                )
+
+        httpretty.latest_requests().clear()
+
+        cache.get(FREDS_KEY, refresh=True)
+        cache.get(FREDS_KEY, refresh=True)
+
+        self.assertEqual(len(httpretty.latest_requests()), 1,
+                msg = "We don't keep asking whether a key has changed")
+
+    @httpretty.activate
+    def test_forgotten_when_saved(self):
+
+        fred = create_remote_person(
+                remote_url = REMOTE_FRED,
+                name = 'fred',
+                publicKey = _keys(1)['public'],
+                auto_fetch = True,
+                )
+
+        key_cache.get(FREDS_KEY)
+
+        fred.publicKey = _keys(2)['public']
+        fred.save()
+
+        self.assertTrue(_made_by(key_cache.get(FREDS_KEY),
+            _keys(2)['private']))
+
+    @httpretty.activate
+    def test_key_claimed_by_someone_else(self):
+
+        mallory = RemotePerson.objects.create(
+                remote_url = 'https://remote.example.org/users/mallory',
+                username = 'mallory',
+                key_name = FREDS_KEY,
+                publicKey = _keys(2)['public'],
+                )
+
+        create_remote_person(
+                remote_url = REMOTE_FRED,
+                name = 'fred',
+                publicKey = _keys(1)['public'],
+                )
+
+        cache = KeyCache(size=10)
+
+        self.assertEqual(
+                cache.get(FREDS_KEY, actor=mallory.url).owner,
+                mallory.url)
+
+        key = cache.get(FREDS_KEY,
+                actor = REMOTE_FRED,
+                )
+        self.assertEqual(key.owner, REMOTE_FRED,
+                msg = "Nobody else's claim on a key hides the actor's")
+        self.assertTrue(_made_by(key, _keys(1)['private']))
+
+    @httpretty.activate
+    def test_key_on_another_host(self):
+
+        mallory_url = 'https://elsewhere.example.net/users/mallory'
+
+        fields = remote_user(
+                remote_url = mallory_url,
+                name = 'mallory',
+                publicKey = _keys(2)['public'],
+                )
+        fields['publicKey']['id'] = FREDS_KEY
+
+        mock_remote_object(
+                remote_url = mallory_url,
+                content = as_json(fields),
+                )
+
+        self.assertIsNone(fetch(mallory_url, RemotePerson),
+                msg = "Nobody can claim a key on someone else's host")
+
+        self.assertFalse(RemotePerson.objects.filter(
+            key_name = FREDS_KEY,
+            ).exists())
@@ -0,0 +1,202 @@
+# test_mirror.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+import logging
+logger = logging.getLogger(name="kepi")
+
+from kepi.bowler_pub.tests import create_remote_person, \
+        create_remote_collection, mock_remote_object
+from kepi.sombrero_sendpub.mirror import sync, sync_mirrors
+from kepi.sombrero_sendpub.cache import fetch_cache
+from kepi.kepi.testing import KepiTestCase
+import kepi.sombrero_sendpub.models as sombrero_models
+import django.utils.timezone
+import datetime
+import httpretty
+
+OWNER_URL = 'https://example.org/users/wombat'
+FOLLOWERS_URL = OWNER_URL+'/followers'
+PAGE_SIZE = 10
+
+def member_url(i):
+    return 'https://example.org/users/numbat%d' % (i,)
+
+class Tests(KepiTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        # Anything cached by one test would outlive its rollback.
+        fetch_cache.clear()
+        self.addCleanup(fetch_cache.clear)
+
+        httpretty.enable()
+        self.addCleanup(httpretty.disable)
+        self.addCleanup(httpretty.reset)
+
+        self._serve(range(25))
+
+        self.owner = create_remote_person(
+                remote_url = OWNER_URL,
+                name = 'wombat',
+                auto_fetch = True,
+                )
+
+    def _serve(self, members):
+        """
+        Serves the owner's followers collection, containing
+        numbats with the given numbers, newest first.
+        """
+
+        # As if our cached copy of the collection had expired.
+        fetch_cache.clear()
+
+        httpretty.reset()
+
+        create_remote_person(
+                remote_url = OWNER_URL,
+                name = 'wombat',
+                )
+
+        items = [member_url(i) for i in members]
+
+        for url in items:
+            create_remote_person(
+                    remote_url = url,
+                    name = url.split('/')[-1],
+                    )
+
+        create_remote_collection(
+                FOLLOWERS_URL,
+                items,
+                number_per_page = PAGE_SIZE,
+                )
+
+    def _pages_requested(self):
+        return [request.querystring.get('page', [None])[0]
+                for request in httpretty.latest_requests()
+                if request.path.startswith('/users/wombat/followers')
+                and 'page' in request.querystring]
+
+    def _followers(self):
+        return sorted([x.url for x in self.owner.followers])
+
+    def _first_read(self):
+        """
+        Reads the followers for the first time, and then
+        runs the sync which that queues.
+        """
+
+        with self.captureOnCommitCallbacks(execute=True):
+            result = self._followers()
+
+        return result
+
+    def test_first_read(self):
+
+        self.assertEqual(self._first_read(), [],
+                msg = "The first read doesn't wait for the sync")
+
+        self.assertEqual(self._followers(),
+                sorted([member_url(i) for i in range(25)]))
+
+        mirror = sombrero_models.MirroredCollection.objects.get(
+                url = FOLLOWERS_URL,
+                )
+        self.assertEqual(mirror.total_items, 25)
+        self.assertIsNotNone(mirror.synced)
+        self.assertIsNotNone(mirror.walked)
+
+    def test_reads_from_mirror(self):
+
+        self._first_read()
+        httpretty.latest_requests().clear()
+
+        self.assertEqual(len(self._followers()), 25)
+        self.assertEqual(httpretty.latest_requests(), [],
+                msg = "Once we have a mirror, reading it is local")
+
+    def test_new_members(self):
+
+        self._first_read()
+
+        self._serve([100, 101] + list(range(25)))
+        sync(FOLLOWERS_URL, walk=False)
+
+        self.assertEqual(self._pages_requested(), ['1'],
+                msg = "Only the new part is read")
+
+        self.assertEqual(self._followers(),
+                sorted([member_url(i) for i in [100, 101]+list(range(25))]))
+
+    def test_members_left(self):
+
+        self._first_read()
+
+        # One new member, and two who've left.
+        self._serve([100] + list(range(2, 25)))
+        sync(FOLLOWERS_URL, walk=False)
+
+        self.assertEqual(self._pages_requested(), ['1', '2', '3'],
+                msg = "If totalItems doesn't add up, we read everything")
+
+        self.assertEqual(self._followers(),
+                sorted([member_url(i) for i in [100]+list(range(2, 25))]))
+
+    def test_page_missing(self):
+
+        self._first_read()
+
+        self._serve([100] + list(range(2, 25)))
+        mock_remote_object(
+                FOLLOWERS_URL+'?page=2',
+                status = 404,
+                )
+
+        sync(FOLLOWERS_URL, walk=True)
+
+        self.assertIn(member_url(0), self._followers(),
+                msg = "Nobody is dropped unless we saw the whole collection")
+        self.assertIn(member_url(100), self._followers())
+
+    def test_queued_once(self):
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            self._followers()
+            self._followers()
+
+        self.assertEqual(len(callbacks), 1,
+                msg = "Reading an unsynced mirror again doesn't "
+                    "queue another sync")
+
+    def test_lost_sync(self):
+
+        with self.captureOnCommitCallbacks():
+            self._followers()
+
+        sync_mirrors()
+
+        self.assertEqual(len(self._followers()), 25,
+                msg = "Mirrors which were never synced are synced "
+                    "by sync_mirrors()")
+
+    def test_sync_mirrors(self):
+
+        self._first_read()
+
+        self._serve([100] + list(range(25)))
+        sync_mirrors()
+
+        self.assertNotIn(member_url(100), self._followers(),
+                msg = "Fresh mirrors are left alone")
+
+        sombrero_models.MirroredCollection.objects.update(
+                synced = django.utils.timezone.now() - \
+                        datetime.timedelta(days=1),
+                )
+        sync_mirrors()
+
+        self.assertIn(member_url(100), self._followers())
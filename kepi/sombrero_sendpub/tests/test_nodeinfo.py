@@ -0,0 +1,108 @@
+# test_nodeinfo.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from django.test import TestCase
+from kepi.sombrero_sendpub.nodeinfo import refresh_instances, \
+        get_nodeinfo
+import kepi.sombrero_sendpub.models as sombrero_models
+import httpretty
+import json
+
+NODEINFO_SCHEMA = 'http://nodeinfo.diaspora.software/ns/schema/2.0'
+
+class Tests(TestCase):
+
+    @httpretty.activate
+    def test_refresh_instances(self):
+
+        httpretty.register_uri(
+                httpretty.GET,
+                'https://example.org/.well-known/nodeinfo',
+                status = 200,
+                body = json.dumps({
+                    'links': [
+                        {
+                            'rel': NODEINFO_SCHEMA,
+                            'href': 'https://example.org/nodeinfo/2.0',
+                            },
+                        ],
+                    }),
+                )
+
+        httpretty.register_uri(
+                httpretty.GET,
+                'https://example.org/nodeinfo/2.0',
+                status = 200,
+                body = json.dumps({
+                    'version': '2.0',
+                    'software': {
+                        'name': 'mastodon',
+                        'version': '3.2.1',
+                        },
+                    }),
+                )
+
+        httpretty.register_uri(
+                httpretty.GET,
+                'https://example.com/.well-known/nodeinfo',
+                status = 404,
+                body = 'Not found',
+                )
+
+        for hostname in ['example.org', 'example.com']:
+            sombrero_models.Instance(hostname=hostname).save()
+
+        refresh_instances()
+
+        found = sombrero_models.Instance.objects.get(
+                hostname = 'example.org',
+                )
+        self.assertEqual(found.software, 'mastodon')
+        self.assertEqual(found.software_version, '3.2.1')
+        self.assertIsNotNone(found.nodeinfo_checked)
+
+        missing = sombrero_models.Instance.objects.get(
+                hostname = 'example.com',
+                )
+        self.assertEqual(missing.software, '')
+        self.assertIsNotNone(missing.nodeinfo_checked,
+                msg = "We don't ask again straight away")
+
+    @httpretty.activate
+    def test_leaves_other_fields_alone(self):
+
+        httpretty.register_uri(
+                httpretty.GET,
+                'https://example.org/.well-known/nodeinfo',
+                status = 404,
+                body = 'Not found',
+                )
+
+        sombrero_models.Instance(hostname='example.org').save()
+
+        instance = sombrero_models.Instance.objects.get(
+                hostname = 'example.org',
+                )
+
+        # Meanwhile, someone else finds out more about it.
+        sombrero_models.Instance.objects.filter(
+                hostname = 'example.org',
+                ).update(
+                        shared_inbox = 'https://example.org/inbox',
+                        error_streak = 3,
+                        )
+
+        get_nodeinfo(instance)
+
+        found = sombrero_models.Instance.objects.get(
+                hostname = 'example.org',
+                )
+        self.assertEqual(found.shared_inbox, 'https://example.org/inbox')
+        self.assertEqual(found.error_streak, 3)
+        self.assertIsNotNone(found.nodeinfo_checked)
@@ -0,0 +1,237 @@
+# test_outbound.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from django.test import SimpleTestCase, override_settings
+from django.conf import settings
+import kepi.sombrero_sendpub.outbound as outbound
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest.mock import patch
+import threading
+import socket
+import requests
+import time
+
+READ_TIMEOUT = 0.2
+TOTAL_TIMEOUT = 0.5
+MAX_SIZE = 64*1024
+
+TEST_KEPI = settings.KEPI.copy()
+TEST_KEPI.update({
+    'OUTBOUND_READ_TIMEOUT': READ_TIMEOUT,
+    'OUTBOUND_TOTAL_TIMEOUT': TOTAL_TIMEOUT,
+    'OUTBOUND_MAX_SIZE': MAX_SIZE,
+    })
+
+class _StandIn(object):
+    """
+    A stand-in for a badly-behaved remote server, running on localhost.
+
+    What it does depends on the path you ask for:
+        /ok     -- replies at once, with a small body.
+        /hang   -- never replies at all.
+        /huge   -- says it's sending ten megabytes.
+        /flood  -- sends data without saying how much, until
+                   we hang up.
+        /drip   -- sends its body one byte at a time, slowly.
+    """
+
+    def __init__(self):
+
+        standin = self
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                with standin.lock:
+                    standin.connections += 1
+
+            def do_GET(self):
+
+                if self.path=='/hang':
+                    standin.stop.wait(5)
+                    return
+
+                if self.path=='/huge':
+                    self.send_response(200)
+                    self.send_header('Content-Length', str(10*1024*1024))
+                    self.end_headers()
+                    self.wfile.write(b'x'*1024)
+                    return
+
+                if self.path=='/flood':
+                    self.send_response(200)
+                    self.send_header('Connection', 'close')
+                    self.end_headers()
+                    self.close_connection = True
+
+                    try:
+                        while not standin.stop.is_set():
+                            self.wfile.write(b'x'*4096)
+                    except OSError:
+                        pass
+                    return
+
+                if self.path=='/drip':
+                    self.send_response(200)
+                    self.send_header('Content-Length', '1000')
+                    self.end_headers()
+
+                    try:
+                        for i in range(1000):
+                            if standin.stop.is_set():
+                                break
+                            self.wfile.write(b'x')
+                            self.wfile.flush()
+                            time.sleep(READ_TIMEOUT/4)
+                    except OSError:
+                        pass
+                    return
+
+                body = b'{"name": "Fred"}'
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_port
+        self.url = 'http://127.0.0.1:%d' % (self.port,)
+
+        self.thread = threading.Thread(
+                target = self.server.serve_forever,
+                kwargs = {'poll_interval': 0.05},
+                daemon = True,
+                )
+        self.thread.start()
+
+    def close(self):
+        self.stop.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+@override_settings(KEPI=TEST_KEPI)
+class Tests(SimpleTestCase):
+
+    def setUp(self):
+        self.standin = _StandIn()
+        outbound.close_sessions()
+        outbound.dns_cache.clear()
+
+    def tearDown(self):
+        outbound.close_sessions()
+        self.standin.close()
+
+    def test_ok(self):
+        response = outbound.get(self.standin.url+'/ok')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'name': 'Fred'})
+
+    def test_keep_alive(self):
+        for i in range(3):
+            outbound.get(self.standin.url+'/ok')
+
+        self.assertEqual(self.standin.connections, 1)
+
+    def test_hang(self):
+        started = time.monotonic()
+
+        with self.assertRaises(requests.Timeout):
+            outbound.get(self.standin.url+'/hang')
+
+        self.assertLess(time.monotonic()-started, 2)
+
+    def test_huge(self):
+        with self.assertRaises(outbound.ResponseTooLarge):
+            outbound.get(self.standin.url+'/huge')
+
+    def test_flood(self):
+        with self.assertRaises(outbound.ResponseTooLarge):
+            outbound.get(self.standin.url+'/flood')
+
+    def test_max_size(self):
+        response = outbound.get(self.standin.url+'/ok',
+                max_size = 100)
+        self.assertEqual(response.status_code, 200)
+
+        with self.assertRaises(outbound.ResponseTooLarge):
+            outbound.get(self.standin.url+'/ok',
+                    max_size = 10)
+
+    def test_drip(self):
+        started = time.monotonic()
+
+        with self.assertRaises(requests.Timeout,
+                msg = "Each byte arrives in time, but the whole doesn't"):
+            outbound.get(self.standin.url+'/drip')
+
+        self.assertLess(time.monotonic()-started, 2)
+
+    def test_cannot_connect(self):
+        self.standin.close()
+
+        with self.assertRaises(requests.ConnectionError):
+            outbound.get(self.standin.url+'/ok')
+
+    def test_dns_cache(self):
+        url = 'http://standin.example:%d/ok' % (self.standin.port,)
+        looked_up = []
+
+        def fake_getaddrinfo(host, port, *args):
+            # urllib3 passes the address we found back in here,
+            # but that's not a DNS lookup.
+            if host!='127.0.0.1':
+                looked_up.append(host)
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                ('127.0.0.1', port))]
+
+        with patch('socket.getaddrinfo', fake_getaddrinfo):
+            for i in range(3):
+                outbound.close_sessions()
+                outbound.get(url)
+
+        self.assertEqual(self.standin.connections, 3)
+        self.assertEqual(looked_up, ['standin.example'])
+
+    def test_sessions_limited(self):
+
+        kepi_settings = TEST_KEPI.copy()
+        kepi_settings['OUTBOUND_MAX_SESSIONS'] = 2
+
+        with override_settings(KEPI=kepi_settings):
+
+            first = outbound._session_for('a.example')
+
+            with patch.object(first, 'close') as close:
+                outbound._session_for('b.example')
+                outbound._session_for('a.example')
+                outbound._session_for('c.example')
+
+                self.assertFalse(close.called,
+                        msg = "Recently used sessions are kept")
+
+                outbound._session_for('d.example')
+
+                self.assertTrue(close.called,
+                        msg = "The least recently used session is closed")
+
+            self.assertEqual(
+                    list(outbound._sessions.keys()),
+                    ['c.example', 'd.example'],
+                    )
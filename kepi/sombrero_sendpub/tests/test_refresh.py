@@ -0,0 +1,148 @@
+# test_refresh.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+import logging
+logger = logging.getLogger(name="kepi")
+
+from unittest.mock import patch
+from django.conf import settings
+from django.test import override_settings
+from kepi.sombrero_sendpub.fetch import fetch
+from kepi.sombrero_sendpub.refresh import refresh_remote_people
+from kepi.trilby_api.models import RemotePerson
+from kepi.kepi.testing import KepiTestCase
+from .test_fetch import EXAMPLE_USER_URL, EXAMPLE_USER_RESULT
+import kepi.bowler_pub.create as bowler_create
+import django.utils.timezone
+import datetime
+import httpretty
+
+EXAMPLE_ETAG = '"wombat-1"'
+CHANGED_ETAG = '"wombat-2"'
+
+class Tests(KepiTestCase):
+
+    def _serve(self, etag, body=EXAMPLE_USER_RESULT):
+        """
+        Serves the example user, with the given ETag, and
+        answers 304 to anyone who already has that ETag.
+
+        Returns a list which will be filled with the headers
+        of each request made.
+        """
+
+        seen = []
+
+        def serve(request, uri, headers):
+            seen.append(request.headers)
+
+            headers['ETag'] = etag
+
+            if request.headers.get('If-None-Match', None)==etag:
+                return (304, headers, '')
+
+            return (200, headers, body)
+
+        httpretty.reset()
+        httpretty.register_uri(
+                'GET',
+                EXAMPLE_USER_URL,
+                content_type = 'application/activity+json',
+                body = serve,
+                )
+
+        return seen
+
+    def _make_stale(self):
+        RemotePerson.objects.filter(
+                remote_url = EXAMPLE_USER_URL,
+                ).update(
+                        found_at = django.utils.timezone.now() - \
+                                datetime.timedelta(days=30),
+                        )
+
+    @httpretty.activate
+    def test_validators_stored(self):
+        self._serve(EXAMPLE_ETAG)
+
+        user = fetch(EXAMPLE_USER_URL, RemotePerson)
+
+        user = RemotePerson.objects.get(pk=user.pk)
+        self.assertEqual(user.etag, EXAMPLE_ETAG)
+        self.assertIsNotNone(user.found_at)
+
+    @httpretty.activate
+    def test_not_modified(self):
+        self._serve(EXAMPLE_ETAG)
+        user = fetch(EXAMPLE_USER_URL, RemotePerson)
+        self._make_stale()
+
+        seen = self._serve(EXAMPLE_ETAG)
+
+        with patch.object(bowler_create, 'on_person') as on_person:
+            refresh_remote_people()
+
+        self.assertEqual(len(seen), 1)
+        self.assertEqual(seen[0].get('If-None-Match'), EXAMPLE_ETAG)
+
+        self.assertFalse(on_person.called,
+                msg = "Unchanged person wasn't processed again")
+
+        user = RemotePerson.objects.get(pk=user.pk)
+        self.assertGreater(user.found_at,
+                django.utils.timezone.now() - datetime.timedelta(hours=1))
+
+    @httpretty.activate
+    def test_modified(self):
+        self._serve(EXAMPLE_ETAG)
+        user = fetch(EXAMPLE_USER_URL, RemotePerson)
+        self.assertEqual(user.display_name, 'The Wombat')
+        self._make_stale()
+
+        self._serve(CHANGED_ETAG,
+                body = EXAMPLE_USER_RESULT.replace(
+                    'The Wombat', 'The Wombat Formerly Known As Fred'))
+
+        refresh_remote_people()
+
+        user = RemotePerson.objects.get(pk=user.pk)
+        self.assertEqual(user.display_name,
+                'The Wombat Formerly Known As Fred')
+        self.assertEqual(user.etag, CHANGED_ETAG)
+
+    @httpretty.activate
+    def test_fresh_left_alone(self):
+        self._serve(EXAMPLE_ETAG)
+        fetch(EXAMPLE_USER_URL, RemotePerson)
+
+        seen = self._serve(EXAMPLE_ETAG)
+
+        refresh_remote_people()
+
+        self.assertEqual(seen, [],
+                msg = "People we fetched lately aren't checked again")
+
+    def test_batch_size(self):
+
+        for name in ['wombat', 'numbat', 'quokka']:
+            RemotePerson.objects.create(
+                    remote_url = 'https://%s.example.org/users/%s' % (
+                        name, name),
+                    username = name,
+                    )
+
+        kepi_settings = settings.KEPI.copy()
+        kepi_settings['REFRESH_BATCH_SIZE'] = 2
+
+        with override_settings(KEPI=kepi_settings), \
+                patch('kepi.sombrero_sendpub.refresh._revalidate'), \
+                patch('kepi.sombrero_sendpub.refresh.refresh_person') \
+                as refresh_person:
+
+            refresh_remote_people()
+
+        self.assertEqual(refresh_person.call_count, 2,
+                msg = "The batch size comes from settings.py")
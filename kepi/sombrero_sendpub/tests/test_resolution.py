@@ -0,0 +1,82 @@
+# test_resolution.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+import logging
+logger = logging.getLogger(name="kepi")
+
+from kepi.sombrero_sendpub.resolution import Resolution, resolving, current
+from kepi.sombrero_sendpub.fetch import fetch, fetch_many
+from kepi.bowler_pub.tests import create_remote_person
+from kepi.trilby_api.models import Person, RemotePerson, Status
+from kepi.kepi.testing import KepiTestCase
+import httpretty
+
+REMOTE_FRED = 'https://example.org/users/fred'
+REMOTE_JIM = 'https://example.org/users/jim'
+
+class Tests(KepiTestCase):
+
+    def test_identity_map(self):
+
+        resolution = Resolution()
+        fred = RemotePerson(remote_url=REMOTE_FRED)
+
+        self.assertEqual(resolution.get(REMOTE_FRED, RemotePerson),
+                (False, None))
+
+        resolution.put(REMOTE_FRED, RemotePerson, fred)
+
+        self.assertEqual(resolution.get(REMOTE_FRED, RemotePerson),
+                (True, fred))
+        self.assertEqual(resolution.get(REMOTE_FRED, Person),
+                (True, fred),
+                msg = "Subclasses of what we want will do")
+        self.assertEqual(resolution.get(REMOTE_FRED, Status),
+                (False, None))
+
+        resolution.put(REMOTE_JIM, Person, None)
+
+        self.assertEqual(resolution.get(REMOTE_JIM, Person),
+                (True, None),
+                msg = "Misses are remembered")
+        self.assertEqual(resolution.get(REMOTE_JIM, RemotePerson),
+                (False, None))
+
+    def test_nesting(self):
+
+        self.assertIsNone(current())
+
+        with resolving() as outer:
+            self.assertIs(current(), outer)
+
+            with resolving() as inner:
+                self.assertIs(inner, outer,
+                        msg = "Nested resolutions are shared")
+
+            self.assertIs(current(), outer)
+
+        self.assertIsNone(current())
+
+    @httpretty.activate
+    def test_fetch(self):
+
+        create_remote_person(
+                remote_url = REMOTE_FRED,
+                name = 'fred',
+                auto_fetch = True,
+                )
+
+        with resolving() as resolution:
+            fred = fetch(REMOTE_FRED, Person)
+
+            with self.assertNumQueries(0):
+                self.assertIs(fetch(REMOTE_FRED, Person), fred)
+                self.assertIs(fetch(REMOTE_FRED, RemotePerson), fred)
+                self.assertEqual(fetch_many([REMOTE_FRED], Person),
+                        {REMOTE_FRED: fred})
+
+        self.assertIsNot(fetch(REMOTE_FRED, Person), fred,
+                msg = "Nothing is remembered afterwards")
@@ -10,8 +10,12 @@ logger = logging.getLogger(name='kepi')
 from unittest import skip
 from django.test import TestCase
 from kepi.sombrero_sendpub.webfinger import get_webfinger
+import kepi.sombrero_sendpub.models as sombrero_models
+import django.utils.timezone
+import datetime
 from . import suppress_thread_exceptions
 import httpretty
+import requests
 
 EXAMPLE_USERNAME = "wombat"
 EXAMPLE_HOSTNAME = "example.org"
@@ -56,6 +60,11 @@ EXAMPLE_WEBFINGER_RESULT_NO_USER = f"""{{"subject":"acct:{EXAMPLE_USERNAME}@{EXA
 {{"rel":"http://ostatus.org/schema/1.0/subscribe",
 "template":"https://{EXAMPLE_HOSTNAME}/authorize_interaction?uri={{uri}}"}}]}}"""
 
+EXAMPLE_HOST_META = f"""<?xml version="1.0" encoding="UTF-8"?>
+<XRD xmlns="http://docs.oasis-open.org/ns/xri/xrd-1.0">
+  <Link rel="lrdd" template="https://{EXAMPLE_HOSTNAME}/fediverse/webfinger?resource={{uri}}"/>
+</XRD>"""
+
 class TestWebfinger(TestCase):
 
     @httpretty.activate
@@ -94,6 +103,13 @@ class TestWebfinger(TestCase):
                 body = "never heard of them",
                 )
 
+        httpretty.register_uri(
+                'GET',
+                'https://example.org/.well-known/host-meta',
+                status=404,
+                body = "no host-meta either",
+                )
+
         webfinger = get_webfinger(
                 EXAMPLE_USERNAME,
                 EXAMPLE_HOSTNAME,
@@ -203,3 +219,140 @@ class TestWebfinger(TestCase):
                 webfinger.url,
                 None,
                 )
+
+    @httpretty.activate
+    def test_cached(self):
+
+        looked_up = []
+
+        def found(request, uri, headers):
+            looked_up.append(uri)
+            return 200, headers, EXAMPLE_WEBFINGER_RESULT
+
+        httpretty.register_uri(
+                'GET',
+                EXAMPLE_WEBFINGER_URL,
+                body = found,
+                )
+
+        for i in range(3):
+            webfinger = get_webfinger(
+                    EXAMPLE_USERNAME,
+                    EXAMPLE_HOSTNAME,
+                    )
+
+            self.assertEqual(webfinger.url, EXAMPLE_USER_URL)
+
+        self.assertEqual(len(looked_up), 1)
+
+        sombrero_models.WebfingerUser.objects.update(
+                fetched = django.utils.timezone.now() - \
+                        datetime.timedelta(days=2),
+                )
+
+        webfinger = get_webfinger(
+                EXAMPLE_USERNAME,
+                EXAMPLE_HOSTNAME,
+                )
+
+        self.assertEqual(webfinger.url, EXAMPLE_USER_URL)
+        self.assertEqual(len(looked_up), 2,
+                msg = "Expired lookups are refreshed")
+        self.assertEqual(
+                sombrero_models.WebfingerUser.objects.count(), 1,
+                msg = "Refreshing updates the existing record")
+
+    @httpretty.activate
+    def test_negative_cached(self):
+
+        looked_up = []
+
+        def gone(request, uri, headers):
+            looked_up.append(uri)
+            return 410, headers, "this bird has flown"
+
+        httpretty.register_uri(
+                'GET',
+                EXAMPLE_WEBFINGER_URL,
+                body = gone,
+                )
+
+        for i in range(3):
+            webfinger = get_webfinger(
+                    EXAMPLE_USERNAME,
+                    EXAMPLE_HOSTNAME,
+                    )
+
+            self.assertIsNone(webfinger.url)
+
+        self.assertEqual(len(looked_up), 1)
+
+        sombrero_models.WebfingerUser.objects.update(
+                fetched = django.utils.timezone.now() - \
+                        datetime.timedelta(hours=1),
+                )
+
+        get_webfinger(
+                EXAMPLE_USERNAME,
+                EXAMPLE_HOSTNAME,
+                )
+
+        self.assertEqual(len(looked_up), 2,
+                msg = "Failures are forgotten sooner")
+
+    @httpretty.activate
+    def test_host_meta(self):
+
+        httpretty.register_uri(
+                'GET',
+                EXAMPLE_WEBFINGER_URL,
+                status=404,
+                body = "not here",
+                )
+
+        httpretty.register_uri(
+                'GET',
+                f'https://{EXAMPLE_HOSTNAME}/.well-known/host-meta',
+                status=200,
+                headers = {
+                    'Content-Type': 'application/xrd+xml',
+                    },
+                body = EXAMPLE_HOST_META,
+                )
+
+        httpretty.register_uri(
+                'GET',
+                f'https://{EXAMPLE_HOSTNAME}/fediverse/webfinger',
+                status=200,
+                headers = {
+                    'Content-Type': 'application/jrd+json',
+                    },
+                body = EXAMPLE_WEBFINGER_RESULT,
+                )
+
+        webfinger = get_webfinger(
+                EXAMPLE_USERNAME,
+                EXAMPLE_HOSTNAME,
+                )
+
+        self.assertEqual(webfinger.url, EXAMPLE_USER_URL)
+
+        host = sombrero_models.WebfingerHost.objects.get(
+                hostname = EXAMPLE_HOSTNAME,
+                )
+
+        self.assertEqual(host.template,
+                f'https://{EXAMPLE_HOSTNAME}/fediverse/webfinger?resource={{uri}}')
+
+        httpretty.latest_requests().clear()
+
+        get_webfinger(
+                'quokka',
+                EXAMPLE_HOSTNAME,
+                )
+
+        self.assertEqual(
+                [r.path for r in httpretty.latest_requests()],
+                ['/fediverse/webfinger?resource=acct:quokka@example.org'],
+                msg = "The template is remembered for the host",
+                )
@@ -4,55 +4,204 @@
 # Copyright (c) 2018-2020 Marnanel Thurman.
 # Licensed under the GNU Public License v2.
 
+"""
+This looks up remote users by their atstyle names
+("username@hostname"), using webfinger: RFC 7033.
+
+Results are stored as WebfingerUsers, and reused
+until they expire; see WebfingerUser.is_fresh.
+
+Most servers answer webfinger lookups at /.well-known/webfinger.
+If a server doesn't, we ask for its host-meta (RFC 6415),
+which may tell us where it does answer them. We remember that
+as a WebfingerHost.
+"""
+
 import logging
 logger = logging.getLogger(name="kepi")
 
 import requests
+import django.utils.timezone
+import django.db.utils
+from django.db import transaction
+from urllib.parse import quote
+from xml.etree import ElementTree
+import kepi.sombrero_sendpub.outbound as outbound
 import kepi.sombrero_sendpub.models as sombrero_models
 
+DEFAULT_TEMPLATE = 'https://%s/.well-known/webfinger?resource={uri}'
+
+XRD_NAMESPACE = '{http://docs.oasis-open.org/ns/xri/xrd-1.0}'
+
 def get_webfinger(username, hostname):
 
-    result = sombrero_models.WebfingerUser(
+    """
+    Returns a WebfingerUser for username@hostname.
+
+    If we looked them up lately, that's what you get. Otherwise,
+    we ask the remote server, and update the WebfingerUser.
+    If the lookup failed, the WebfingerUser's "url" is None.
+    """
+
+    result = sombrero_models.WebfingerUser.objects.filter(
             username = username,
             hostname = hostname,
-            )
+            ).first()
 
-    url = f'https://{hostname}/.well-known/'+\
-            f'webfinger?acct={username}'
+    if result is not None and result.is_fresh:
+        logger.debug("webfinger: %s is still fresh", result)
+        return result
 
-    try:
-        response = requests.get(
-                url,
-                headers = {
-                    'Accept': 'application/activity+json',
-                    },
+    if result is None:
+        result = sombrero_models.WebfingerUser(
+                username = username,
+                hostname = hostname,
                 )
-    except requests.ConnectionError:
-        logger.info("webfinger: Connection to %s failed",
-                hostname)
+
+    template = sombrero_models.WebfingerHost.objects.filter(
+            hostname = hostname,
+            ).values_list('template', flat=True).first()
+
+    if template is None:
+        template = DEFAULT_TEMPLATE % (hostname,)
+
+    response = _lookup(template, username, hostname)
+
+    if getattr(response, 'status_code', None)==404:
+        # Maybe they answer webfinger somewhere else.
+        better = _discover_template(hostname)
+
+        if better is not None and better!=template:
+            response = _lookup(better, username, hostname)
+
+    result.fetched = django.utils.timezone.now()
+
+    if isinstance(response, requests.RequestException):
+        logger.info("webfinger: Connection to %s failed: %s",
+                hostname, response)
+
+        # If we knew where they were before, they're
+        # probably still there.
         result.status = 0
-        result.save()
+        _save(result)
         return result
 
     result.status = response.status_code
+    result.url = None
 
     if response.status_code!=200:
-        result.save()
+        _save(result)
         logger.info("webfinger: Unexpected status code %d from lookup of %s@%s",
                 response.status_code,
                 username, hostname)
         return result
 
-    self_link = [x for x in response.json()['links']
-        if x.get("type",'') == "application/activity+json"]
+    try:
+        self_link = [x for x in response.json()['links']
+            if x.get("type",'') == "application/activity+json"]
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        logger.info("webfinger: retrieved %s@%s, which made no sense: %s",
+                username, hostname, e)
+        self_link = []
 
     if not self_link:
-        result.save()
+        _save(result)
         logger.info("webfinger: retrieved %s@%s, which has no activity information",
                 username, hostname)
         return result
 
     result.url = self_link[0]['href']
-    result.save()
+    _save(result)
 
     return result
+
+def _lookup(template, username, hostname):
+    """
+    Asks the webfinger endpoint described by "template" about
+    username@hostname. Returns the response, or the exception
+    if that didn't work.
+    """
+
+    url = template.replace('{uri}',
+            quote(f'acct:{username}@{hostname}', safe=':@'))
+
+    try:
+        return outbound.get(
+                url,
+                headers = {
+                    'Accept': 'application/jrd+json, application/json',
+                    },
+                )
+    except requests.RequestException as re:
+        return re
+
+def _save(webfinger_user):
+    """
+    Saves "webfinger_user". If someone else has looked up
+    the same user meanwhile, updates theirs instead.
+    """
+
+    try:
+        with transaction.atomic():
+            webfinger_user.save()
+    except django.db.utils.IntegrityError:
+        sombrero_models.WebfingerUser.objects.filter(
+                username = webfinger_user.username,
+                hostname = webfinger_user.hostname,
+                ).update(
+                        url = webfinger_user.url,
+                        status = webfinger_user.status,
+                        fetched = webfinger_user.fetched,
+                        )
+
+def _discover_template(hostname):
+    """
+    Asks "hostname" for its host-meta, and returns the webfinger
+    template it gives, or None if we couldn't find one.
+
+    We only ask each host once in a while; if we've asked lately,
+    this returns None without asking again.
+    """
+
+    host = sombrero_models.WebfingerHost.objects.filter(
+            hostname = hostname,
+            ).first()
+
+    if host is not None and host.is_fresh:
+        return None
+
+    template = None
+
+    try:
+        response = outbound.get(
+                f'https://{hostname}/.well-known/host-meta',
+                headers = {
+                    'Accept': 'application/xrd+xml',
+                    },
+                )
+
+        if response.status_code==200:
+            xrd = ElementTree.fromstring(response.content)
+
+            for link in xrd.iter(XRD_NAMESPACE+'Link'):
+                if link.get('rel', '')=='lrdd' and \
+                        '{uri}' in link.get('template', ''):
+                    template = link.get('template')
+                    break
+
+    except (requests.RequestException, ElementTree.ParseError) as e:
+        logger.info("webfinger: host-meta for %s failed: %s",
+                hostname, e)
+
+    logger.info("webfinger: host-meta for %s gave template %s",
+            hostname, template)
+
+    sombrero_models.WebfingerHost.objects.update_or_create(
+            hostname = hostname,
+            defaults = {
+                'template': template or DEFAULT_TEMPLATE % (hostname,),
+                'fetched': django.utils.timezone.now(),
+                },
+            )
+
+    return template
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trilby_api', '0029_auto_20210216_1914'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='remoteperson',
+            name='found_at',
+            field=models.DateTimeField(db_index=True, default=None, help_text="When we last fetched this person, or checked that they hadn't changed.", null=True),
+        ),
+        migrations.AddField(
+            model_name='remoteperson',
+            name='etag',
+            field=models.CharField(blank=True, default='', help_text='The ETag header from when we last fetched this person.', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='remoteperson',
+            name='last_modified',
+            field=models.CharField(blank=True, default='', help_text='The Last-Modified header from when we last fetched this person.', max_length=255),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:02
+
+from django.conf import settings
+from django.db import migrations, models
+
+def fill_url_denormed(apps, schema_editor):
+    # Historical models don't have Status.url, so we work it out
+    # the same way here.
+    Status = apps.get_model('trilby_api', 'Status')
+    LocalPerson = apps.get_model('trilby_api', 'LocalPerson')
+
+    usernames = dict(LocalPerson.objects.values_list(
+        'pk', 'local_user__username'))
+
+    for pk, remote_url, account_id in Status.objects.values_list(
+            'pk', 'remote_url', 'account_id'):
+
+        if remote_url is not None:
+            url = remote_url
+        elif account_id in usernames:
+            url = 'https://{}{}'.format(
+                    settings.KEPI['LOCAL_OBJECT_HOSTNAME'],
+                    settings.KEPI['STATUS_LINK'] % {
+                        'username': usernames[account_id],
+                        'id': pk,
+                        })
+        else:
+            continue
+
+        Status.objects.filter(pk=pk).update(url_denormed=url)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trilby_api', '0030_remoteperson_validators'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='status',
+            name='url_denormed',
+            field=models.URLField(default=None, editable=False, help_text='Canonical URL of this status, so that we can look it up. Do not edit!', max_length=255, null=True, unique=True),
+        ),
+        migrations.RunPython(fill_url_denormed,
+            reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trilby_api', '0031_status_url_denormed'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='remoteperson',
+            name='key_name',
+            field=models.CharField(blank=True, db_index=True, default='', help_text="The ID of this person's public key.", max_length=255, null=True),
+        ),
+    ]
@@ -157,6 +157,25 @@ class RemotePerson(Person):
     found_at = models.DateTimeField(
             null = True,
             default = None,
+            db_index = True,
+            help_text = "When we last fetched this person, "+\
+                    "or checked that they hadn't changed.",
+            )
+
+    etag = models.CharField(
+            max_length = 255,
+            blank = True,
+            default = '',
+            help_text = "The ETag header from when we last fetched "+\
+                    "this person.",
+            )
+
+    last_modified = models.CharField(
+            max_length = 255,
+            blank = True,
+            default = '',
+            help_text = "The Last-Modified header from when we last "+\
+                    "fetched this person.",
             )
 
     username = models.CharField(
@@ -219,6 +238,8 @@ class RemotePerson(Person):
             null = True,
             blank = True,
             default = '',
+            db_index = True,
+            help_text = "The ID of this person's public key.",
             )
 
     acct = models.CharField(
@@ -283,85 +304,22 @@ class RemotePerson(Person):
 
     @property
     def followers(self):
-        return self._get_remote_collection(
-                self.followers_url,
-                )
+        """
+        A QuerySet of this person's followers, as of when we
+        last synced their followers collection. See
+        kepi.sombrero_sendpub.mirror.
+        """
+        from kepi.sombrero_sendpub.mirror import members
+        return members(self.followers_url)
 
     @property
     def following(self):
-        return self._get_remote_collection(
-                self.following_url,
-                )
-
-    def _get_remote_collection(self, url):
-        from kepi.sombrero_sendpub.fetch import fetch
-        from kepi.sombrero_sendpub.collections import Collection
-
-        class RemotePersonCollection(object):
-            def __init__(self, address):
-                logger.debug(
-                        "%s RemotePerson: initialising",
-                        address,
-                        )
-
-                self.collection = None
-                self.address = address
-
-            def __iter__(self):
-
-                remote_collection = fetch(
-                        self.address,
-                        Collection,
-                        )
-
-                if remote_collection is None:
-                    logger.debug(
-                            "%s RemotePerson: could not retrieve collection",
-                            self.address,
-                            )
-                    self.collection = [].__iter__()
-                    return self
-
-                self.collection = remote_collection.__iter__()
-
-                logger.debug(
-                        "%s: retrieved collection %s",
-                        self.address,
-                        self.collection,
-                        )
-
-                return self
-
-            def __next__(self):
-
-                logger.debug("%s RemotePerson: finding next...",
-                        self.address,
-                        )
-
-                url = self.collection.__next__()
-
-                logger.debug("%s RemotePerson: next is at %s",
-                        self.address,
-                        url,
-                        )
-
-                person = fetch(
-                        url,
-                        Person,
-                        )
-
-                logger.debug("%s RemotePerson:  -- which is %s",
-                        url,
-                        person,
-                        )
-
-                return person
-
-        result = RemotePersonCollection(
-                url,
-                )
-
-        return result
+        """
+        A QuerySet of the people this person follows, as of when
+        we last synced their following collection.
+        """
+        from kepi.sombrero_sendpub.mirror import members
+        return members(self.following_url)
 
 ########################################
 
@@ -498,6 +456,15 @@ class LocalPerson(Person):
         self.local_user.username = newname
         self.local_user.save()
 
+        # Our statuses' URLs contain our username.
+        import kepi.trilby_api.models as trilby_models
+
+        for status in trilby_models.Status.objects.filter(
+                account = self,
+                remote_url = None,
+                ):
+            status.update_url_denormed()
+
     @property
     def is_local(self):
         return True
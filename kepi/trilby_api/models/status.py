@@ -18,6 +18,7 @@ import kepi.trilby_api.signals as trilby_signals
 from django.utils.timezone import now
 from django.core.exceptions import ValidationError
 from polymorphic.models import PolymorphicModel
+from urllib.parse import urlparse
 import markdown
 
 PUBLIC = "https://www.w3.org/ns/activitystreams#Public"
@@ -45,6 +46,16 @@ class Status(PolymorphicModel):
             unique = True,
             )
 
+    url_denormed = models.URLField(
+            max_length = 255,
+            null = True,
+            unique = True,
+            editable = False,
+            default = None,
+            help_text = 'Canonical URL of this status, so that we '+\
+                    'can look it up. Do not edit!',
+            )
+
     account = models.ForeignKey(
             'Person',
             related_name = 'poster',
@@ -244,11 +255,35 @@ class Status(PolymorphicModel):
         if self.remote_url is not None:
             return self.remote_url
 
+        if self.url_denormed is not None:
+            return self.url_denormed
+
+        return self._local_url()
+
+    def _local_url(self):
         return uri_to_url(settings.KEPI['STATUS_LINK'] % {
                 'username': self.account.username,
                 'id': self.id,
                 })
 
+    def update_url_denormed(self):
+        """
+        Stores our URL in url_denormed. You only need to call this
+        if our URL has changed, such as when our account's username
+        changes; save() calls it for new statuses.
+        """
+
+        if self.remote_url is not None:
+            url = self.remote_url
+        else:
+            url = self._local_url()
+
+        if url!=self.url_denormed:
+            Status.objects.filter(pk=self.pk).update(
+                    url_denormed = url,
+                    )
+            self.url_denormed = url
+
     @property
     def activity_url(self):
         if self.remote_url is not None:
@@ -334,8 +369,16 @@ class Status(PolymorphicModel):
                         self)
                 self.spoiler_as_html_denormed = None
 
+        if self.remote_url is not None:
+            self.url_denormed = self.remote_url
+
         super().save(*args, **kwargs)
 
+        if self.url_denormed is None:
+            # Local URLs contain our id, so this has to wait
+            # until we have one.
+            self.update_url_denormed()
+
         if send_signal and newly_made:
 
             if self.reblog_of is None:
@@ -352,59 +395,24 @@ class Status(PolymorphicModel):
     @classmethod
     def lookup(cls, url):
 
-        # TODO: not yet tested
-        # FIXME: if url is local, parse and return local <-- current breakage XXX
         # FIXME: if remote is not found, *possibly* create and return?
 
         if is_local(url):
+            # The hostname might be any of our ALLOWED_HOSTS.
+            url = uri_to_url(urlparse(url).path)
 
-            view = trilby_utils.find_local_view(
-                    url,
-                    )
-
-            view = trilby_utils.find_local_view(
-                    url,
-                    which_views = ['StatusView'],
-                    )
-
-            if view is None:
-                return None
-
-            statusid = int(view.kwargs['status'])
-
-            try:
-                result = cls.objects.get(
-                        id=statusid,
-                        )
-            except cls.DoesNotExist:
-                logger.debug('%s is local but does not exist',
-                        url)
-                return None
-
-            if result.account.local_user.username != view.kwargs['username']:
-                logger.debug('%s is local but the username doesn\'t match',
-                        url)
-                return None
-
-            logger.debug('%s is local and exists: %s',
-                    url, result)
-            return result
+        result = cls.objects.filter(
+                url_denormed = url,
+                ).first()
 
-        # so, it's remote
-
-        try:
-            result = cls.objects.get(remote_url = url)
-            logger.debug('%s is remote and exists: %s',
+        if result is None:
+            logger.debug('%s is unknown',
+                    url)
+        else:
+            logger.debug('%s exists: %s',
                     url, result)
 
-            return result
-        except cls.DoesNotExist:
-            pass
-
-        logger.debug('%s is unknown',
-                url)
-
-        return None
+        return result
 
     @property
     def is_reply(self):
@@ -15,3 +15,4 @@ followed = Signal()
 unfollowed = Signal()
 posted = Signal()
 reblogged = Signal()
+updated = Signal()
@@ -4,6 +4,8 @@ from kepi.trilby_api.views import *
 from kepi.trilby_api.tests import *
 from kepi.trilby_api.models import *
 from django.conf import settings
+import kepi.sombrero_sendpub.models as sombrero_models
+import json
 
 # Tests for accounts. API docs are here:
 # https://docs.joinmastodon.org/methods/accounts/
@@ -138,6 +140,30 @@ class TestAccountCredentials(TrilbyTestCase):
                             expected,
                             ))
 
+    def test_update_credentials_sends_one_update(self):
+
+        alice = create_local_person(name='alice')
+
+        for name in ['Thomas the Rhymer', 'Tam Lin', 'Kate Crackernuts']:
+            self.patch(
+                    f'/api/v1/accounts/update_credentials',
+                    data = {
+                        'display_name': name,
+                        },
+                    as_user = alice,
+                    )
+
+        updates = sombrero_models.OutgoingActivity.objects.all()
+
+        self.assertEqual(len(updates), 1,
+                msg = "Updates in quick succession are merged")
+
+        activity = json.loads(updates[0].content)
+        self.assertEqual(activity['type'], 'Update')
+        self.assertEqual(activity['object']['name'], 'Kate Crackernuts')
+        self.assertIsNone(updates[0].dispatched_at,
+                msg = "The update waits for the window to close")
+
 class TestAccountDetails(TrilbyTestCase):
 
     def test_account_followers(self):
@@ -3,6 +3,9 @@ from kepi.trilby_api.views import *
 from kepi.trilby_api.tests import *
 from kepi.trilby_api.models import *
 from django.conf import settings
+import kepi.sombrero_sendpub.models as sombrero_models
+import django.utils.timezone
+import datetime
 
 # Tests for methods for the instance as a whole. API docs are here:
 # https://docs.joinmastodon.org/methods/instance/
@@ -31,3 +34,26 @@ class TestInstance(TrilbyTestCase):
                 content,
                 [],
                 )
+
+    def test_get_peers(self):
+
+        for hostname, streak in [
+                ('example.org', 0),
+                ('example.com', 1),
+                ('dead.example.net', sombrero_models.BREAKER_THRESHOLD),
+                ]:
+            sombrero_models.Instance(
+                    hostname = hostname,
+                    error_streak = streak,
+                    first_seen = django.utils.timezone.now() - \
+                            datetime.timedelta(days=30),
+                    ).save()
+
+        content = self.get(
+                '/api/v1/instance/peers',
+                )
+
+        self.assertEqual(
+                content,
+                ['example.com', 'example.org'],
+                )
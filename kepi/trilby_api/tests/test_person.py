@@ -75,6 +75,11 @@ class TestPerson(TrilbyTestCase):
                 content=REMOTE_FOLLOWERS_COLLECTION,
                 )
 
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(list(peter.followers), [],
+                    msg = "Remote followers aren't known until "
+                        "the mirror has synced")
+
         followers = sorted(list(
             [x.url for x in peter.followers]))
 
@@ -9,8 +9,9 @@ logger = logging.getLogger(name='kepi')
 
 import django.test
 import httpretty
-from kepi.trilby_api.models import Follow
-from kepi.trilby_api.tests import create_local_person, create_local_status
+from kepi.trilby_api.models import Follow, Status
+from kepi.trilby_api.tests import create_local_person, create_local_status, \
+        TrilbyTestCase
 from kepi.bowler_pub.tests import create_remote_person, mock_remote_object
 
 class Tests(django.test.TestCase):
@@ -49,11 +50,38 @@ class Tests(django.test.TestCase):
 
         Follow(following=self.alice, follower=self.bob).save()
 
-        create_local_status(
-                posted_by = self.alice,
-                content = "I'll tell you the tale of the sweet nightingale.",
-                send_signal = True,
-                )
+        with self.captureOnCommitCallbacks(execute=True):
+            create_local_status(
+                    posted_by = self.alice,
+                    content = "I'll tell you the tale of the sweet nightingale.",
+                    send_signal = True,
+                    )
 
         self.assertTrue(self.seen_message,
                 msg="The remote server received the message.")
+
+class TestLocalDelivery(TrilbyTestCase):
+
+    def test_local_follower(self):
+
+        """
+        Tests whether a local status, delivered to a local
+        follower, is not created a second time.
+        """
+
+        alice = create_local_person("alice")
+        bob = create_local_person("bob")
+
+        Follow(following=alice, follower=bob).save()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            status = create_local_status(
+                    posted_by = alice,
+                    content = "A hundred years I will not go there more.",
+                    send_signal = True,
+                    )
+
+        self.assertEqual(
+                list(Status.objects.all()),
+                [status],
+                )
@@ -11,6 +11,7 @@ urlpatterns = [
 
     path('api/v1/instance', views.Instance.as_view()),
     path('api/v1/instance/', views.Instance.as_view()), # keep tootstream happy
+    path('api/v1/instance/peers', views.Peers.as_view()),
     path('api/v1/apps', views.Apps.as_view()),
 
     path('api/v1/accounts/verify_credentials', views.VerifyCredentials.as_view()),
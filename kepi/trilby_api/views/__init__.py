@@ -20,6 +20,7 @@ __all__ = [
         'HomeTimeline',
         'Instance',
         'Notifications',
+        'Peers',
         'PublicTimeline',
         'Reblog',
         'Search',
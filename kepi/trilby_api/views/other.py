@@ -19,6 +19,7 @@ from django.core.exceptions import SuspiciousOperation
 from django.conf import settings
 import kepi.trilby_api.models as trilby_models
 import kepi.trilby_api.utils as trilby_utils
+import kepi.sombrero_sendpub.models as sombrero_models
 from kepi.trilby_api.serializers import *
 from rest_framework import generics, response, mixins
 from rest_framework.permissions import IsAuthenticated, \
@@ -48,6 +49,19 @@ class Instance(View):
 
         return JsonResponse(result)
 
+class Peers(View):
+
+    def get(self, request, *args, **kwargs):
+
+        result = sombrero_models.Instance.objects.alive().order_by(
+                'hostname',
+                ).values_list(
+                        'hostname', flat=True,
+                        )
+
+        return JsonResponse(list(result),
+                safe=False)
+
 class Emojis(View):
     # FIXME
     def get(self, request, *args, **kwargs):
@@ -19,6 +19,7 @@ from django.core.exceptions import SuspiciousOperation
 from django.conf import settings
 import kepi.trilby_api.models as trilby_models
 import kepi.trilby_api.utils as trilby_utils
+import kepi.trilby_api.signals as trilby_signals
 from kepi.trilby_api.serializers import *
 from rest_framework import generics, response, mixins
 from rest_framework.permissions import IsAuthenticated, \
@@ -287,6 +288,7 @@ class UpdateCredentials(generics.GenericAPIView):
             raise Http404(f"some fields do not exist: {unknown_fields}")
 
         who.save()
+        trilby_signals.updated.send(sender=who)
         logger.info('  -- done.')
 
         serializer = UserSerializerWithSource(